@@ -1,12 +1,27 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog
+import os
+import sys
 import sqlite3
-import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import matplotlib
 matplotlib.use('Agg')
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+
+# Данные, проверки и пароли — общий ClinicService третьей недели. Связь через sys.path
+# намеренная: вторая неделя — тонкий tkinter-интерфейс над тем же clinic.py, чтобы схема,
+# миграции и проверки ввода не расходились между версиями; папки запускаются из этого репозитория
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "3 неделя", "practica pitonchik"))
+from clinic import (
+    DATA_VIEW_LIMIT, DATA_VIEWS, TAB_ROLES, ClinicService, KeysetPager, SessionExpiredError, format_parameters,
+    split_parameters
+)
+
+# Подсказки пациентов запрашиваются после паузы в наборе, а не на каждую клавишу
+PATIENT_LOOKUP_DEBOUNCE_MS = 250
+PATIENTS_PAGE_SIZE = 50
 
 class MedicalApp:
     def __init__(self, root):
@@ -14,152 +29,58 @@ class MedicalApp:
         self.root.title("Медицинская информационная система")
         self.root.geometry("1200x800")
         
-        # Инициализация базы данных
-        self.conn = sqlite3.connect('medical.db')
-        self.cursor = self.conn.cursor()
+        # Инициализация базы данных: схема, тестовые пользователи и данные
+        try:
+            self.service = ClinicService.open('medical.db', profile="production")
+        except sqlite3.Error as e:
+            messagebox.showerror("Ошибка БД", f"Ошибка открытия базы данных: {str(e)}")
+            raise
+        
+        # Один график на всё время работы: Figure без pyplot не копится в его реестре
+        self.age_figure = None
+        self.age_axes = None
         
-        # Создание таблиц
-        self.create_tables()
-        self.add_default_users()
-        self.add_sample_data()
+        # Запросы выполняются в фоновых потоках, результат забирается через root.after
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="db")
+        self.task_generations = {}
+        self.pending_tasks = 0
+        self.patient_lookup_job = None
         
-        # Текущий пользователь
+        # Текущий пользователь: токен сеанса и (id, роль)
+        self.session_token = None
         self.current_user = None
         
         # Создание интерфейса
         self.create_login_screen()
 
-    def create_tables(self):
-        """Создание таблиц в базе данных"""
-        tables = [
-            """CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                role TEXT NOT NULL CHECK(role IN ('admin', 'doctor', 'nurse', 'patient'))
-            )""",
-            """CREATE TABLE IF NOT EXISTS patients (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                age INTEGER CHECK(age > 0 AND age < 120),
-                gender TEXT CHECK(gender IN ('М', 'Ж')),
-                admission_date TEXT,
-                treatment_type TEXT
-            )""",
-            """CREATE TABLE IF NOT EXISTS treatment_sessions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                patient_id INTEGER NOT NULL,
-                session_date TEXT NOT NULL,
-                diagnosis TEXT NOT NULL,
-                FOREIGN KEY (patient_id) REFERENCES patients(id) ON DELETE CASCADE
-            )""",
-            """CREATE TABLE IF NOT EXISTS session_procedures (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id INTEGER NOT NULL,
-                procedure_name TEXT NOT NULL,
-                parameters TEXT,
-                FOREIGN KEY (session_id) REFERENCES treatment_sessions(id) ON DELETE CASCADE
-            )"""
-        ]
-        
-        for table in tables:
-            try:
-                self.cursor.execute(table)
-            except sqlite3.Error as e:
-                messagebox.showerror("Ошибка БД", f"Ошибка создания таблицы: {str(e)}")
-                raise
-        self.conn.commit()
-
-    def add_default_users(self):
-        """Добавление тестовых пользователей"""
-        users = [
-            ('admin', 'admin123', 'admin'),
-            ('doctor', 'doctor123', 'doctor'),
-            ('nurse', 'nurse123', 'nurse'),
-            ('patient', 'patient123', 'patient')
-        ]
+    def run_in_background(self, work, on_done, key=None, on_error=None):
+        """Выполнение work в пуле потоков и передача результата в on_done в потоке интерфейса"""
+        # Более новая задача с тем же ключом делает результат предыдущей ненужным
+        generation = None
+        if key is not None:
+            generation = self.task_generations[key] = self.task_generations.get(key, 0) + 1
+        future = self.executor.submit(work)
+        self.pending_tasks += 1
+        self.root.config(cursor="watch")
+        
+        def poll():
+            if not future.done():
+                self.root.after(50, poll)
+                return
+            self.pending_tasks -= 1
+            if not self.pending_tasks:
+                self.root.config(cursor="")
+            if key is not None and self.task_generations[key] != generation:
+                return
+            error = future.exception()
+            if error is None:
+                on_done(future.result())
+            elif on_error is not None:
+                on_error(error)
+            else:
+                raise error
         
-        for username, password, role in users:
-            try:
-                self.cursor.execute("SELECT 1 FROM users WHERE username = ?", (username,))
-                if not self.cursor.fetchone():
-                    hashed_password = hashlib.sha256(password.encode()).hexdigest()
-                    self.cursor.execute(
-                        "INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
-                        (username, hashed_password, role)
-                    )
-            except sqlite3.Error as e:
-                messagebox.showerror("Ошибка БД", f"Ошибка добавления пользователя: {str(e)}")
-                raise
-        self.conn.commit()
-
-    def add_sample_data(self):
-        """Добавление тестовых данных"""
-        try:
-            # Добавляем пациентов, если их нет
-            self.cursor.execute("SELECT COUNT(*) FROM patients")
-            if self.cursor.fetchone()[0] == 0:
-                patients = [
-                    ("Иванов Иван", 45, "М", "2023-01-10", "Терапия"),
-                    ("Петрова Анна", 32, "Ж", "2023-01-15", "Хирургия"),
-                    ("Сидоров Владимир", 28, "М", "2023-02-05", "Диагностика")
-                ]
-                self.cursor.executemany(
-                    "INSERT INTO patients (name, age, gender, admission_date, treatment_type) VALUES (?, ?, ?, ?, ?)",
-                    patients
-                )
-                self.conn.commit()
-
-            # Получаем ID всех пациентов
-            self.cursor.execute("SELECT id FROM patients ORDER BY id")
-            patient_ids = [row[0] for row in self.cursor.fetchall()]
-            
-            # Добавляем тестовые сеансы, если их нет
-            self.cursor.execute("SELECT COUNT(*) FROM treatment_sessions")
-            if self.cursor.fetchone()[0] == 0 and patient_ids:
-                sessions = []
-                if len(patient_ids) >= 1:
-                    sessions.append((patient_ids[0], "2023-01-12 10:00", "Гипертония"))
-                if len(patient_ids) >= 2:
-                    sessions.append((patient_ids[1], "2023-01-16 11:00", "Аппендицит"))
-                if len(patient_ids) >= 3:
-                    sessions.append((patient_ids[2], "2023-02-06 09:30", "Обследование"))
-                
-                if sessions:
-                    self.cursor.executemany(
-                        "INSERT INTO treatment_sessions (patient_id, session_date, diagnosis) VALUES (?, ?, ?)",
-                        sessions
-                    )
-                    self.conn.commit()
-
-            # Получаем ID всех сеансов
-            self.cursor.execute("SELECT id FROM treatment_sessions ORDER BY id")
-            session_ids = [row[0] for row in self.cursor.fetchall()]
-            
-            # Добавляем тестовые процедуры, если их нет
-            self.cursor.execute("SELECT COUNT(*) FROM session_procedures")
-            if self.cursor.fetchone()[0] == 0 and session_ids:
-                procedures = []
-                if len(session_ids) >= 1:
-                    procedures.extend([
-                        (session_ids[0], "УЗИ брюшной полости", "Область: печень, параметры: норма"),
-                        (session_ids[0], "Электрокардиография", "Давление: 120/80")
-                    ])
-                if len(session_ids) >= 2:
-                    procedures.append((session_ids[1], "МРТ", "Область: брюшная полость"))
-                if len(session_ids) >= 3:
-                    procedures.append((session_ids[2], "Физиотерапия", "Курс: 10 сеансов"))
-                
-                if procedures:
-                    self.cursor.executemany(
-                        "INSERT INTO session_procedures (session_id, procedure_name, parameters) VALUES (?, ?, ?)",
-                        procedures
-                    )
-                    self.conn.commit()
-
-        except sqlite3.Error as e:
-            messagebox.showerror("Ошибка БД", f"Ошибка добавления тестовых данных: {str(e)}")
-            raise
+        self.root.after(50, poll)
 
     def create_login_screen(self):
         """Создание экрана авторизации"""
@@ -188,22 +109,19 @@ class MedicalApp:
             messagebox.showerror("Ошибка", "Введите логин и пароль")
             return
         
-        hashed_password = hashlib.sha256(password.encode()).hexdigest()
-        
-        try:
-            self.cursor.execute(
-                "SELECT id, role FROM users WHERE username = ? AND password = ?",
-                (username, hashed_password)
-            )
-            user = self.cursor.fetchone()
-            
-            if user:
-                self.current_user = {'id': user[0], 'role': user[1]}
+        def done(token):
+            if token:
+                self.session_token = token
+                self.current_user = self.service.current_user(token)
                 self.create_main_interface()
             else:
                 messagebox.showerror("Ошибка", "Неверный логин или пароль")
-        except sqlite3.Error as e:
-            messagebox.showerror("Ошибка БД", f"Ошибка аутентификации: {str(e)}")
+        
+        self.run_in_background(
+            lambda: self.service.login(username, password),
+            done,
+            on_error=lambda e: messagebox.showerror("Ошибка БД", f"Ошибка аутентификации: {str(e)}")
+        )
 
     def create_main_interface(self):
         """Создание основного интерфейса"""
@@ -213,19 +131,48 @@ class MedicalApp:
         self.notebook = ttk.Notebook(self.root)
         self.notebook.pack(fill="both", expand=True)
         
-        # Добавление вкладок в зависимости от роли
-        if self.current_user['role'] != 'patient':
-            self.create_patients_tab()
-            self.create_procedures_tab()
-            self.create_view_data_tab()
-        
-        if self.current_user['role'] in ['admin', 'doctor']:
-            self.create_stats_tab()
+        # Добавление вкладок в зависимости от роли (общая таблица TAB_ROLES)
+        tabs = [
+            ("Пациенты", self.create_patients_tab),
+            ("Лечебные процедуры", self.create_procedures_tab),
+            ("Просмотр данных", self.create_view_data_tab),
+            ("Статистика", self.create_stats_tab),
+        ]
+        for title, create_tab in tabs:
+            if self.current_user.role in TAB_ROLES[title]:
+                create_tab()
+        self.notebook.bind("<<NotebookTabChanged>>", lambda e: self.authorize_tab())
         
         # Кнопка выхода
-        logout_btn = ttk.Button(self.root, text="Выйти", command=self.create_login_screen)
+        logout_btn = ttk.Button(self.root, text="Выйти", command=self.logout)
         logout_btn.pack(pady=10)
 
+    def authorize(self, roles):
+        """Проверка токена сеанса перед действием: истёкший или отозванный сеанс возвращает на вход"""
+        try:
+            self.current_user = self.service.require_user(self.session_token, roles)
+            return True
+        except SessionExpiredError as e:
+            self.session_token = None
+            self.current_user = None
+            messagebox.showwarning("Сеанс", str(e))
+            self.create_login_screen()
+        except PermissionError as e:
+            messagebox.showerror("Ошибка", str(e))
+        return False
+
+    def authorize_tab(self):
+        """Проверка сеанса при переходе на вкладку"""
+        title = self.notebook.tab(self.notebook.select(), "text")
+        self.authorize(TAB_ROLES[title])
+
+    def logout(self):
+        """Выход: токен сеанса отзывается"""
+        self.service.logout(self.session_token)
+        self.session_token = None
+        self.current_user = None
+        self.create_login_screen()
+
     def create_patients_tab(self):
         """Вкладка работы с пациентами"""
         tab = ttk.Frame(self.notebook)
@@ -259,6 +206,14 @@ class MedicalApp:
         ttk.Button(btn_frame, text="Добавить", command=self.show_add_patient_dialog).pack(side="left", padx=5)
         ttk.Button(btn_frame, text="Удалить", command=self.delete_patient).pack(side="left", padx=5)
         ttk.Button(btn_frame, text="Обновить", command=self.update_patients_list).pack(side="left", padx=5)
+        ttk.Button(btn_frame, text="История", command=self.show_patient_timeline).pack(side="left", padx=5)
+        
+        # Список читается страницами по ключу id, а не целиком
+        self.patients_pager = KeysetPager(self.service.patients_page, page_size=PATIENTS_PAGE_SIZE)
+        self.patients_next_btn = ttk.Button(btn_frame, text="Вперёд", command=lambda: self.update_patients_list(self.patients_pager.next))
+        self.patients_next_btn.pack(side="right", padx=5)
+        self.patients_prev_btn = ttk.Button(btn_frame, text="Назад", command=lambda: self.update_patients_list(self.patients_pager.prev))
+        self.patients_prev_btn.pack(side="right", padx=5)
         
         # Первоначальная загрузка данных
         self.update_patients_list()
@@ -274,7 +229,7 @@ class MedicalApp:
             ("Возраст:", ttk.Entry(dialog)),
             ("Пол:", ttk.Combobox(dialog, values=["М", "Ж"], state="readonly")),
             ("Дата поступления:", ttk.Entry(dialog)),
-            ("Тип лечения:", ttk.Combobox(dialog, values=["Терапия", "Хирургия", "Диагностика"], state="readonly"))
+            ("Тип лечения:", ttk.Combobox(dialog, values=self.service.treatment_types(), state="readonly"))
         ]
         
         for i, (label, widget) in enumerate(fields):
@@ -293,34 +248,45 @@ class MedicalApp:
 
     def add_patient(self, name, age, gender, admission_date, treatment_type):
         """Добавление нового пациента в БД"""
-        try:
-            if not name or not age or not gender:
-                raise ValueError("Заполните обязательные поля")
-            
-            self.cursor.execute(
-                "INSERT INTO patients (name, age, gender, admission_date, treatment_type) VALUES (?, ?, ?, ?, ?)",
-                (name, age, gender, admission_date, treatment_type)
-            )
-            self.conn.commit()
+        if not self.authorize(TAB_ROLES["Пациенты"]):
+            return
+        def show_error(e):
+            messagebox.showerror("Ошибка", f"Ошибка добавления пациента: {str(e)}")
+        
+        def done(_):
             messagebox.showinfo("Успех", "Пациент добавлен")
             self.update_patients_list()
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Ошибка добавления пациента: {str(e)}")
-
-    def update_patients_list(self):
-        """Обновление списка пациентов"""
-        for item in self.patients_tree.get_children():
-            self.patients_tree.delete(item)
+            self.update_patient_combobox()
         
-        try:
-            self.cursor.execute("SELECT id, name, age, gender, admission_date FROM patients ORDER BY id")  # Сортируем по ID
-            for row in self.cursor.fetchall():
-                self.patients_tree.insert("", "end", values=row)  # Добавляем в конец списка
-        except sqlite3.Error as e:
-            messagebox.showerror("Ошибка БД", f"Ошибка загрузки пациентов: {str(e)}")
+        # Проверка полей — в ClinicService, ошибка приходит в show_error
+        self.run_in_background(
+            lambda: self.service.add_patient(name, age, gender, admission_date, treatment_type),
+            done,
+            on_error=show_error
+        )
+
+    def update_patients_list(self, move=None):
+        """Обновление списка пациентов: текущая страница или соседняя (move — метод KeysetPager)"""
+        if not self.authorize(TAB_ROLES["Пациенты"]):
+            return
+        def done(rows):
+            self.patients_tree.delete(*self.patients_tree.get_children())
+            for row in rows:
+                self.patients_tree.insert("", "end", values=row[:5])  # По возрастанию ID
+            self.patients_prev_btn.state(["!disabled" if self.patients_pager.has_prev else "disabled"])
+            self.patients_next_btn.state(["!disabled" if self.patients_pager.has_next else "disabled"])
+        
+        self.run_in_background(
+            move or self.patients_pager.reload,
+            done,
+            key="patients_list",
+            on_error=lambda e: messagebox.showerror("Ошибка БД", f"Ошибка загрузки пациентов: {str(e)}")
+        )
 
     def delete_patient(self):
         """Удаление выбранного пациента"""
+        if not self.authorize(TAB_ROLES["Пациенты"]):
+            return
         selected = self.patients_tree.selection()
         if not selected:
             messagebox.showwarning("Ошибка", "Выберите пациента для удаления")
@@ -328,15 +294,66 @@ class MedicalApp:
         
         patient_id = self.patients_tree.item(selected[0])['values'][0]
         
-        if messagebox.askyesno("Подтверждение", "Удалить этого пациента и все связанные данные?"):
-            try:
-                self.cursor.execute("DELETE FROM patients WHERE id=?", (patient_id,))
-                self.conn.commit()
+        if messagebox.askyesno("Подтверждение", "Удалить пациента из списков? История сеансов сохранится"):
+            def done(_):
                 self.update_patients_list()
+                self.update_patient_combobox()
                 messagebox.showinfo("Успех", "Пациент удален")
-            except Exception as e:
-                messagebox.showerror("Ошибка", f"Не удалось удалить пациента: {str(e)}")
-                self.conn.rollback()
+            
+            self.run_in_background(
+                lambda: self.service.delete_patient(patient_id), done,
+                on_error=lambda e: messagebox.showerror("Ошибка", f"Не удалось удалить пациента: {str(e)}")
+            )
+
+    def show_patient_timeline(self):
+        """Окно истории выбранного пациента: сеансы с процедурами от новых к старым"""
+        if not self.authorize(TAB_ROLES["Пациенты"]):
+            return
+        selected = self.patients_tree.selection()
+        if not selected:
+            messagebox.showwarning("Ошибка", "Выберите пациента")
+            return
+        
+        patient_id, name = self.patients_tree.item(selected[0])['values'][:2]
+        window = tk.Toplevel(self.root)
+        window.title(f"История: {patient_id} - {name}")
+        window.geometry("700x500")
+        
+        # Сеансы — узлы дерева, процедуры — их дочерние строки
+        tree = ttk.Treeview(window, columns=("details",))
+        tree.heading("#0", text="Дата / процедура")
+        tree.heading("details", text="Диагноз / параметры")
+        tree.column("#0", width=250)
+        tree.column("details", width=400)
+        tree.pack(fill="both", expand=True, padx=10, pady=5)
+        
+        more_btn = ttk.Button(window, text="Показать ещё")
+        more_btn.pack(pady=5)
+        state = {"cursor": None}
+        
+        def done(result):
+            sessions, state["cursor"] = result
+            for session in sessions:
+                node = tree.insert("", "end", text=session.session_date, values=(session.diagnosis,), open=True)
+                for procedure in session.procedures:
+                    tree.insert(node, "end", text=procedure.procedure_name, values=(procedure.parameters,))
+            if state["cursor"] is None:
+                more_btn.pack_forget()
+        
+        def load_page():
+            # Страница за запрос; следующая начинается после последнего показанного сеанса
+            if not self.authorize(TAB_ROLES["Пациенты"]):
+                return
+            cursor = state["cursor"]
+            self.run_in_background(
+                lambda: self.service.patient_timeline(patient_id, cursor),
+                done,
+                key=("timeline", str(window)),
+                on_error=lambda e: messagebox.showerror("Ошибка БД", f"Ошибка загрузки истории: {str(e)}")
+            )
+        
+        more_btn.configure(command=load_page)
+        load_page()
 
     def create_procedures_tab(self):
         """Вкладка лечебных процедур"""
@@ -351,10 +368,11 @@ class MedicalApp:
         left_frame = ttk.LabelFrame(main_frame, text="Информация о сеансе")
         left_frame.pack(side="left", fill="y", padx=5, pady=5)
         
-        # Выбор пациента
+        # Выбор пациента: начало ФИО или ID, подсказки в выпадающем списке
         ttk.Label(left_frame, text="Пациент:").pack(anchor="w")
-        self.patient_combobox = ttk.Combobox(left_frame, state="readonly")
+        self.patient_combobox = ttk.Combobox(left_frame)
         self.patient_combobox.pack(fill="x", pady=2)
+        self.patient_combobox.bind("<KeyRelease>", lambda e: self.schedule_patient_lookup())
         
         # Дата сеанса
         ttk.Label(left_frame, text="Дата и время:").pack(anchor="w")
@@ -381,6 +399,7 @@ class MedicalApp:
         self.procedures_tree.column("procedure", width=200)
         self.procedures_tree.column("params", width=300)
         self.procedures_tree.pack(fill="both", expand=True)
+        self.pending_parameters = {}  # строка таблицы -> [(ключ, значение)]
         
         # Полоса прокрутки
         scrollbar = ttk.Scrollbar(right_frame, orient="vertical", command=self.procedures_tree.yview)
@@ -392,16 +411,13 @@ class MedicalApp:
         add_frame.pack(fill="x", pady=5)
         
         ttk.Label(add_frame, text="Процедура:").grid(row=0, column=0, padx=2)
-        self.procedure_name_combobox = ttk.Combobox(add_frame, state="readonly")
-        self.procedure_name_combobox['values'] = [
-            "УЗИ брюшной полости",
-            "Электрокардиография",
-            "МРТ",
-            "Физиотерапия",
-            "Лазерная терапия"
-        ]
+        # Список перечитывается перед раскрытием, если справочник процедур изменился
+        self.procedure_options_version = None
+        self.procedure_name_combobox = ttk.Combobox(add_frame, state="readonly", postcommand=self.refresh_procedure_combobox)
         self.procedure_name_combobox.grid(row=0, column=1, padx=2, sticky="ew")
+        self.refresh_procedure_combobox()
         
+        # Формат "Ключ: значение" через точку с запятой, например "Давление: 120/80; Температура: 37,5"
         ttk.Label(add_frame, text="Параметры:").grid(row=1, column=0, padx=2)
         self.procedure_params_entry = ttk.Entry(add_frame)
         self.procedure_params_entry.grid(row=1, column=1, padx=2, sticky="ew")
@@ -410,20 +426,38 @@ class MedicalApp:
         
         # Кнопка сохранения сеанса
         ttk.Button(right_frame, text="Сохранить сеанс", command=self.save_treatment_session).pack(pady=5)
-        
-        # Обновление списка пациентов
-        self.update_patient_combobox()
+
+    def refresh_procedure_combobox(self):
+        """Обновление списка процедур по версии справочника"""
+        version = self.service.reference_version("procedures")
+        if version == self.procedure_options_version:
+            return
+        self.procedure_name_combobox['values'] = self.service.procedure_catalog()
+        self.procedure_options_version = version
+
+    def schedule_patient_lookup(self):
+        """Запрос подсказок после паузы в наборе"""
+        if self.patient_lookup_job is not None:
+            self.root.after_cancel(self.patient_lookup_job)
+        self.patient_lookup_job = self.root.after(PATIENT_LOOKUP_DEBOUNCE_MS, self.update_patient_combobox)
 
     def update_patient_combobox(self):
-        """Обновление списка пациентов в combobox"""
-        try:
-            self.cursor.execute("SELECT id, name FROM patients ORDER BY name")
-            patients = [f"{row[0]} - {row[1]}" for row in self.cursor.fetchall()]
-            self.patient_combobox['values'] = patients
-            if patients:
-                self.patient_combobox.current(0)
-        except sqlite3.Error as e:
-            messagebox.showerror("Ошибка БД", f"Ошибка загрузки пациентов: {str(e)}")
+        """Подсказки пациентов по введённому началу ФИО или ID"""
+        self.patient_lookup_job = None
+        if not self.authorize(TAB_ROLES["Лечебные процедуры"]):
+            return
+        # Выбранная подсказка "ID - ФИО" ищется по ID
+        text = self.patient_combobox.get().split(" - ")[0]
+        
+        def done(patients):
+            self.patient_combobox['values'] = [f"{patient.id} - {patient.name}" for patient in patients]
+        
+        self.run_in_background(
+            lambda: self.service.find_patients(text),
+            done,
+            key="patient_combobox",
+            on_error=lambda e: messagebox.showerror("Ошибка БД", f"Ошибка загрузки пациентов: {str(e)}")
+        )
 
     def add_procedure_to_list(self):
         """Добавление процедуры в список"""
@@ -434,18 +468,33 @@ class MedicalApp:
             messagebox.showwarning("Ошибка", "Выберите процедуру")
             return
         
-        self.procedures_tree.insert("", "end", values=(procedure, params))
+        # В сеанс уходят пары ключ -> значение, в таблице — их нормализованный текст
+        params = split_parameters(params)
+        try:
+            params_text = format_parameters(params)
+        except ValueError as e:
+            messagebox.showwarning("Ошибка", str(e))
+            return
+        item = self.procedures_tree.insert("", "end", values=(procedure, params_text))
+        self.pending_parameters[item] = params
         self.procedure_name_combobox.set('')
         self.procedure_params_entry.delete(0, tk.END)
 
     def save_treatment_session(self):
         """Сохранение лечебного сеанса"""
+        if not self.authorize(TAB_ROLES["Лечебные процедуры"]):
+            return
+        def show_error(e):
+            messagebox.showerror("Ошибка", f"Ошибка сохранения сеанса: {str(e)}")
+        
         try:
             # Проверка данных
             if not self.patient_combobox.get():
                 raise ValueError("Выберите пациента")
             
-            patient_id = int(self.patient_combobox.get().split(" - ")[0])
+            patient_id, _, name = self.patient_combobox.get().partition(" - ")
+            if not name or not patient_id.isdigit():
+                raise ValueError("Выберите пациента из подсказок")
             session_date = self.session_date_entry.get()
             diagnosis = self.diagnosis_entry.get()
             
@@ -455,23 +504,20 @@ class MedicalApp:
                 raise ValueError("Введите диагноз")
             if not self.procedures_tree.get_children():
                 raise ValueError("Добавьте хотя бы одну процедуру")
-            
-            # Сохранение сеанса
-            self.cursor.execute(
-                "INSERT INTO treatment_sessions (patient_id, session_date, diagnosis) VALUES (?, ?, ?)",
-                (patient_id, session_date, diagnosis)
-            )
-            session_id = self.cursor.lastrowid
-            
-            # Сохранение процедур
-            for item in self.procedures_tree.get_children():
-                procedure = self.procedures_tree.item(item)['values']
-                self.cursor.execute(
-                    "INSERT INTO session_procedures (session_id, procedure_name, parameters) VALUES (?, ?, ?)",
-                    (session_id, procedure[0], procedure[1])
-                )
-            
-            self.conn.commit()
+        except Exception as e:
+            show_error(e)
+            return
+        
+        # Значения виджетов читаются здесь, фоновый поток работает только с БД
+        procedures = [
+            (self.procedures_tree.item(item)['values'][0], self.pending_parameters.get(item, []))
+            for item in self.procedures_tree.get_children()
+        ]
+        
+        def save():
+            return self.service.save_session(patient_id, session_date, diagnosis, procedures)
+        
+        def done(_):
             messagebox.showinfo("Успех", "Сеанс сохранен")
             
             # Очистка формы
@@ -479,10 +525,9 @@ class MedicalApp:
             self.session_date_entry.insert(0, datetime.now().strftime("%Y-%m-%d %H:%M"))
             self.diagnosis_entry.delete(0, tk.END)
             self.procedures_tree.delete(*self.procedures_tree.get_children())
-            
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Ошибка сохранения сеанса: {str(e)}")
-            self.conn.rollback()
+            self.pending_parameters.clear()
+        
+        self.run_in_background(save, done, on_error=show_error)
 
     def create_view_data_tab(self):
         """Вкладка просмотра данных"""
@@ -497,8 +542,11 @@ class MedicalApp:
         self.data_type_combobox = ttk.Combobox(filter_frame, values=["Пациенты", "Сеансы", "Процедуры"], state="readonly")
         self.data_type_combobox.current(0)
         self.data_type_combobox.grid(row=0, column=1, padx=5)
+        self.data_type_combobox.bind("<<ComboboxSelected>>", lambda e: self.update_data_view())
         
         ttk.Button(filter_frame, text="Обновить", command=self.update_data_view).grid(row=0, column=2, padx=5)
+        self.data_status_label = ttk.Label(filter_frame, text="")
+        self.data_status_label.grid(row=0, column=3, padx=5)
         
         # Таблица данных
         self.data_tree = ttk.Treeview(tab)
@@ -514,74 +562,38 @@ class MedicalApp:
 
     def update_data_view(self):
         """Обновление данных в таблице"""
+        if not self.authorize(TAB_ROLES["Просмотр данных"]):
+            return
         data_type = self.data_type_combobox.get()
         self.data_tree.delete(*self.data_tree.get_children())
         self.data_tree["columns"] = []
         
-        if data_type == "Пациенты":
-            self.show_patients_data()
-        elif data_type == "Сеансы":
-            self.show_sessions_data()
-        elif data_type == "Процедуры":
-            self.show_procedures_data()
-
-    def show_patients_data(self):
-        """Отображение данных о пациентах"""
-        columns = ("ID", "ФИО", "Возраст", "Пол", "Дата поступления", "Тип лечения")
-        self.data_tree["columns"] = columns
-        
-        for col in columns:
-            self.data_tree.heading(col, text=col)
-            self.data_tree.column(col, width=100)
-        
-        try:
-            self.cursor.execute("SELECT * FROM patients ORDER BY id")  # Сортируем по ID
-            for row in self.cursor.fetchall():
-                self.data_tree.insert("", "end", values=row)
-        except sqlite3.Error as e:
-            messagebox.showerror("Ошибка БД", f"Ошибка загрузки пациентов: {str(e)}")
-
-    def show_sessions_data(self):
-        """Отображение данных о сеансах"""
-        columns = ("ID", "ID пациента", "Пациент", "Дата сеанса", "Диагноз")
+        # Столбцы и запрос — из общего описания DATA_VIEWS
+        columns = [title for title, _ in DATA_VIEWS[data_type]["columns"]]
         self.data_tree["columns"] = columns
         
         for col in columns:
             self.data_tree.heading(col, text=col)
             self.data_tree.column(col, width=100)
         
-        try:
-            self.cursor.execute("""
-                SELECT s.id, s.patient_id, p.name, s.session_date, s.diagnosis 
-                FROM treatment_sessions s
-                JOIN patients p ON s.patient_id = p.id
-                ORDER BY s.session_date DESC
-            """)
-            for row in self.cursor.fetchall():
-                self.data_tree.insert("", "end", values=row)
-        except sqlite3.Error as e:
-            messagebox.showerror("Ошибка БД", f"Ошибка загрузки сеансов: {str(e)}")
+        self.load_data_tree(data_type)
 
-    def show_procedures_data(self):
-        """Отображение данных о процедурах"""
-        columns = ("ID", "ID сеанса", "Дата сеанса", "Процедура", "Параметры")
-        self.data_tree["columns"] = columns
-        
-        for col in columns:
-            self.data_tree.heading(col, text=col)
-            self.data_tree.column(col, width=100)
-        
-        try:
-            self.cursor.execute("""
-                SELECT p.id, p.session_id, s.session_date, p.procedure_name, p.parameters
-                FROM session_procedures p
-                JOIN treatment_sessions s ON p.session_id = s.id
-                ORDER BY p.id
-            """)
-            for row in self.cursor.fetchall():
+    def load_data_tree(self, data_type):
+        """Фоновая загрузка строк в таблицу просмотра данных"""
+        # Ключ общий для всех типов: при смене типа ответ старого запроса отбрасывается
+        # Читаются не больше DATA_VIEW_LIMIT строк: таблица не растёт вместе с базой
+        def done(rows):
+            for row in rows:
                 self.data_tree.insert("", "end", values=row)
-        except sqlite3.Error as e:
-            messagebox.showerror("Ошибка БД", f"Ошибка загрузки процедур: {str(e)}")
+            limited = f" (не более {DATA_VIEW_LIMIT})" if len(rows) >= DATA_VIEW_LIMIT else ""
+            self.data_status_label.configure(text=f"Показано строк: {len(rows)}{limited}")
+        
+        self.run_in_background(
+            lambda: self.service.data_view(data_type, limit=DATA_VIEW_LIMIT),
+            done,
+            key="data_view",
+            on_error=lambda e: messagebox.showerror("Ошибка БД", f"Ошибка загрузки данных ({data_type}): {str(e)}")
+        )
 
     def create_stats_tab(self):
         """Вкладка статистики"""
@@ -617,34 +629,53 @@ class MedicalApp:
         self.age_stats_container = ttk.Frame(age_frame)
         self.age_stats_container.pack(fill="both", expand=True)
         
+        if self.age_figure is None:
+            self.age_figure = Figure(figsize=(8, 4))
+            self.age_axes = self.age_figure.add_subplot()
+        self.age_canvas = FigureCanvasTkAgg(self.age_figure, master=self.age_stats_container)
+        self.age_stats_label = ttk.Label(self.age_stats_container, text="")
+        
         # Первоначальная загрузка статистики
         self.update_age_stats()
 
     def update_age_stats(self):
         """Обновление статистики по возрастам"""
-        # Очищаем контейнер
-        for widget in self.age_stats_container.winfo_children():
-            widget.destroy()
+        if not self.authorize(TAB_ROLES["Статистика"]):
+            return
+        self.run_in_background(
+            self.service.age_histogram,
+            self.draw_age_stats,
+            key="age_stats",
+            on_error=self.show_age_stats_error
+        )
+
+    def show_age_stats_error(self, e):
+        """Сообщение об ошибке загрузки статистики"""
+        messagebox.showerror("Ошибка БД", f"Ошибка загрузки статистики: {str(e)}")
+        self.show_age_stats_message("Ошибка загрузки данных")
+
+    def draw_age_stats(self, counts):
+        """Отрисовка гистограммы возрастов"""
+        if not any(counts):
+            self.show_age_stats_message("Нет данных для отображения")
+            return
         
-        try:
-            self.cursor.execute("SELECT age FROM patients WHERE age IS NOT NULL")
-            ages = [row[0] for row in self.cursor.fetchall()]
-            
-            if ages:
-                fig, ax = plt.subplots(figsize=(8, 4))
-                ax.hist(ages, bins=range(0, 101, 10), edgecolor='black')
-                ax.set_xlabel('Возраст')
-                ax.set_ylabel('Количество пациентов')
-                ax.set_title('Распределение пациентов по возрастам')
-                
-                canvas = FigureCanvasTkAgg(fig, master=self.age_stats_container)
-                canvas.draw()
-                canvas.get_tk_widget().pack(fill="both", expand=True)
-            else:
-                ttk.Label(self.age_stats_container, text="Нет данных для отображения").pack()
-        except sqlite3.Error as e:
-            messagebox.showerror("Ошибка БД", f"Ошибка загрузки статистики: {str(e)}")
-            ttk.Label(self.age_stats_container, text="Ошибка загрузки данных").pack()
+        # Перерисовываем тот же график вместо создания новой фигуры
+        ax = self.age_axes
+        ax.clear()
+        ax.bar(range(0, 100, 10), counts, width=10, align='edge', edgecolor='black')
+        ax.set_xlabel('Возраст')
+        ax.set_ylabel('Количество пациентов')
+        ax.set_title('Распределение пациентов по возрастам')
+        self.age_canvas.draw_idle()
+        self.age_stats_label.pack_forget()
+        self.age_canvas.get_tk_widget().pack(fill="both", expand=True)
+
+    def show_age_stats_message(self, text):
+        """Сообщение вместо графика"""
+        self.age_canvas.get_tk_widget().pack_forget()
+        self.age_stats_label.configure(text=text)
+        self.age_stats_label.pack()
 
     def clear_window(self):
         """Очистка окна"""
@@ -653,8 +684,10 @@ class MedicalApp:
 
     def __del__(self):
         """Закрытие соединения с БД"""
-        if hasattr(self, 'conn'):
-            self.conn.close()
+        if hasattr(self, 'executor'):
+            self.executor.shutdown(wait=True, cancel_futures=True)
+        if hasattr(self, 'service'):
+            self.service.close()
 
 if __name__ == "__main__":
     root = tk.Tk()
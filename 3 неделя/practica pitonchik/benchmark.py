@@ -0,0 +1,280 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+from clinic import (
+    DATA_VIEWS, DEFAULT_PROCEDURES, TREATMENT_TYPES, ClinicService, FilePeer, default_archive_name, fold_name
+)
+
+# Нагрузочные замеры ClinicService на синтетической клинике (без интерфейса, flet не нужен).
+# Данные зависят только от --patients и --seed, поэтому прогоны на разных
+# коммитах сравнимы: python benchmark.py --out before.json, затем --compare before.json
+
+SURNAMES = [
+    "Иванов", "Петров", "Сидоров", "Смирнов", "Кузнецов", "Попов", "Васильев", "Соколов",
+    "Михайлов", "Новиков", "Фёдоров", "Морозов", "Волков", "Алексеев", "Лебедев", "Семёнов",
+    "Егоров", "Павлов", "Козлов", "Степанов", "Николаев", "Орлов", "Андреев", "Макаров",
+]
+MALE_NAMES = ["Иван", "Пётр", "Алексей", "Сергей", "Дмитрий", "Андрей", "Михаил", "Николай", "Артём", "Владимир"]
+FEMALE_NAMES = ["Анна", "Мария", "Елена", "Ольга", "Татьяна", "Наталья", "Ирина", "Светлана", "Дарья", "Алёна"]
+DIAGNOSES = {
+    "Терапия": ["Гипертония", "Бронхит", "Гастрит", "Остеохондроз", "Пневмония", "Сахарный диабет"],
+    "Хирургия": ["Аппендицит", "Грыжа", "Желчнокаменная болезнь", "Перелом", "Варикоз"],
+    "Диагностика": ["Обследование", "Профосмотр", "Контроль после лечения"],
+}
+PROCEDURE_PARAMETERS = {
+    "УЗИ брюшной полости": ["Область: печень", "Область: почки", "Область: желчный пузырь"],
+    "Электрокардиография": ["Давление: 120/80", "Давление: 140/90", "Пульс: 72"],
+    "МРТ": ["Область: брюшная полость", "Область: позвоночник", "Контраст: да"],
+    "Физиотерапия": ["Курс: 10 сеансов", "Курс: 5 сеансов", "Магнитотерапия"],
+    "Лазерная терапия": ["Мощность: 5 Вт", "Мощность: 10 Вт", "Курс: 7 сеансов"],
+}
+FIRST_ADMISSION = date(2023, 1, 1)
+ADMISSION_DAYS = 730
+ARCHIVE_TODAY = date(2025, 7, 1)  # "сегодня" для замера архива: горизонт делит данные примерно пополам
+
+class ClinicGenerator:
+    # Детерминированный генератор: пациенты, у каждого 0-8 сеансов (в среднем ~3),
+    # в сеансе 1-4 процедуры. Строки выдаются порциями для execute_many
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+
+    def patient(self):
+        rng = self.rng
+        gender = rng.choice("МЖ")
+        surname = rng.choice(SURNAMES) + ("" if gender == "М" else "а")
+        first = rng.choice(MALE_NAMES if gender == "М" else FEMALE_NAMES)
+        # Возраст смещён к пожилым пациентам, как в стационаре
+        age = min(119, max(1, int(rng.triangular(1, 100, 65))))
+        admitted = FIRST_ADMISSION + timedelta(days=rng.randrange(ADMISSION_DAYS))
+        return f"{surname} {first}", age, gender, admitted.isoformat(), rng.choice(TREATMENT_TYPES)
+
+    def sessions(self, patient_id, admission_date, treatment_type):
+        rng = self.rng
+        count = min(8, int(rng.expovariate(1 / 3)))
+        day = datetime.fromisoformat(admission_date)
+        for _ in range(count):
+            day += timedelta(days=rng.randint(0, 14), hours=rng.randint(8, 17), minutes=rng.choice((0, 15, 30, 45)))
+            yield patient_id, day.strftime("%Y-%m-%d %H:%M"), rng.choice(DIAGNOSES[treatment_type])
+
+    def procedures(self):
+        rng = self.rng
+        names = rng.sample([name for name, _ in DEFAULT_PROCEDURES], rng.randint(1, 4))
+        return [(name, rng.choice(PROCEDURE_PARAMETERS[name])) for name in names]
+
+    def populate(self, db, patients, chunk_size=10000):
+        # Заполнение пустой базы; возвращает число строк по таблицам
+        counts = {"patients": 0, "sessions": 0, "procedures": 0}
+        next_patient = db.execute_query("SELECT COALESCE(MAX(id), 0) + 1 FROM patients", fetch_one=True)[0]
+        next_session = db.execute_query("SELECT COALESCE(MAX(id), 0) + 1 FROM treatment_sessions", fetch_one=True)[0]
+        for start in range(0, patients, chunk_size):
+            patient_rows, session_rows, procedure_rows = [], [], []
+            for patient_id in range(next_patient + start, next_patient + min(start + chunk_size, patients)):
+                patient = self.patient()
+                patient_rows.append((patient_id,) + patient + (fold_name(patient[0]),))
+                for session in self.sessions(patient_id, patient[3], patient[4]):
+                    session_rows.append((next_session,) + session)
+                    procedure_rows.extend((next_session, name, params) for name, params in self.procedures())
+                    next_session += 1
+            with db.transaction():
+                db.execute_many(
+                    "INSERT INTO patients (id, name, age, gender, admission_date, treatment_type, name_folded) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    patient_rows, commit=True
+                )
+                db.execute_many(
+                    "INSERT INTO treatment_sessions (id, patient_id, session_date, diagnosis) VALUES (?, ?, ?, ?)",
+                    session_rows, commit=True
+                )
+                db.execute_many(
+                    "INSERT INTO session_procedures (session_id, procedure_name, parameters) VALUES (?, ?, ?)",
+                    procedure_rows, commit=True
+                )
+                if session_rows:
+                    db.index_procedure_parameters(
+                        "session_id BETWEEN ? AND ?", (session_rows[0][0], session_rows[-1][0])
+                    )
+            counts["patients"] += len(patient_rows)
+            counts["sessions"] += len(session_rows)
+            counts["procedures"] += len(procedure_rows)
+        return counts
+
+def measure(operation, repeat):
+    # Время каждого вызова в мс; operation(i) получает номер повтора
+    timings = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        operation(i)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        "repeat": repeat,
+        "min_ms": round(timings[0], 4),
+        "median_ms": round(statistics.median(timings), 4),
+        "mean_ms": round(statistics.fmean(timings), 4),
+        "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 4),
+        "max_ms": round(timings[-1], 4),
+    }
+
+def run_benchmarks(service, generator, repeat, workdir):
+    # Замеряются те же вызовы ClinicService, что делают обработчики интерфейса
+    db = service.db
+    results = {}
+    patient_ids = [row[0] for row in db.execute_query("SELECT id FROM patients ORDER BY id", fetch_all=True)]
+    rng = generator.rng
+
+    results["patient_insert"] = measure(lambda i: service.add_patient(*generator.patient()), repeat)
+
+    def save_session(i):
+        patient_id = rng.choice(patient_ids)
+        session_date = f"{FIRST_ADMISSION + timedelta(days=rng.randrange(ADMISSION_DAYS))} 10:00"
+        service.save_session(patient_id, session_date, rng.choice(DIAGNOSES["Терапия"]), generator.procedures())
+    results["session_save"] = measure(save_session, repeat)
+
+    for data_type in DATA_VIEWS:
+        results[f"data_view[{data_type}]"] = measure(lambda i, data_type=data_type: service.data_view(data_type), repeat)
+    # Отбор по месяцу — типичный фильтр вкладки "Просмотр данных"
+    results["data_view[Сеансы, месяц]"] = measure(
+        lambda i: service.data_view("Сеансы", date_from="2024-03-01", date_to="2024-04-01"), repeat
+    )
+
+    # История пациента с самым длинным списком сеансов: первая страница одним запросом
+    busiest = db.execute_query(
+        "SELECT patient_id FROM treatment_sessions GROUP BY patient_id ORDER BY COUNT(*) DESC, patient_id LIMIT 1",
+        fetch_one=True
+    )
+    if busiest:
+        results["patient_timeline"] = measure(lambda i: service.patient_timeline(busiest[0]), repeat)
+
+    # Клинический отбор по значению параметра идёт по индексу procedure_parameters
+    results["procedure_parameter_range"] = measure(
+        lambda i: service.procedures_by_parameter("Давление", low=130), repeat
+    )
+
+    # Удаление: у жертв есть сеансы и процедуры. Сначала мягкое (пациент скрывается из списков),
+    # затем окончательное каскадом; каждый пациент удаляется один раз
+    victims = [
+        row[0] for row in db.execute_query(
+            "SELECT DISTINCT patient_id FROM treatment_sessions ORDER BY patient_id LIMIT ?", (repeat * 10,), fetch_all=True
+        )
+    ]
+    victims = rng.sample(victims, min(repeat, len(victims)))
+    if victims:
+        results["soft_delete"] = measure(lambda i: service.delete_patient(victims[i]), len(victims))
+        results["cascade_delete"] = measure(lambda i: service.purge_patient(victims[i]), len(victims))
+
+    results["age_stats"] = measure(lambda i: service.age_histogram(), repeat)
+
+    # Архив: половина пациентов выписана в день поступления, перенос одним прогоном
+    # с фиксированной датой, затем история уже из двух файлов
+    db.execute_query("UPDATE patients SET discharge_date = admission_date WHERE id % 2 = 0", commit=True)
+    results["archive"] = measure(lambda i: service.archive(today=ARCHIVE_TODAY), 1)
+    archived = db.execute_query(
+        "SELECT patient_id FROM archive.treatment_sessions GROUP BY patient_id ORDER BY COUNT(*) DESC, patient_id LIMIT 1",
+        fetch_one=True
+    )
+    if archived:
+        results["patient_timeline[архив]"] = measure(lambda i: service.patient_timeline(archived[0]), repeat)
+
+    # Синхронизация с пустым узлом-партнёром в файле: первая передаёт всю базу,
+    # следующие — только новый сеанс (с процедурами), их цена от размера базы не зависит
+    db.set_site(1)
+    peer = FilePeer(os.path.join(workdir, "peer.db"), site=2)
+    try:
+        results["sync_full"] = measure(lambda i: db.sync_with(peer), 1)
+
+        def sync_one_session(i):
+            save_session(i)
+            db.sync_with(peer)
+        results["sync_incremental"] = measure(sync_one_session, repeat)
+    finally:
+        peer.close()
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(current, baseline_path):
+    with open(baseline_path, encoding="utf-8") as source:
+        baseline = json.load(source)["results"]
+    print(f"{'операция':32} {'было, мс':>10} {'стало, мс':>10} {'x':>6}")
+    for name, result in current.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f"{name:32} {'—':>10} {result['median_ms']:>10.3f}")
+            continue
+        ratio = result["median_ms"] / before["median_ms"] if before["median_ms"] else float("inf")
+        print(f"{name:32} {before['median_ms']:>10.3f} {result['median_ms']:>10.3f} {ratio:>6.2f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Замеры ClinicService на синтетических данных клиники")
+    parser.add_argument("--patients", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=50, help="повторов каждой операции")
+    parser.add_argument("--profile", default="production", help="профиль подключения DatabaseManager")
+    parser.add_argument("--db", help="новый файл базы (по умолчанию временный, удаляется после прогона)")
+    parser.add_argument("--out", default="benchmark.json")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения медиан")
+    args = parser.parse_args(argv)
+    # Замеры выписывают, архивируют и удаляют пациентов и назначают узел синхронизации,
+    # поэтому в существующую базу (и её архив) они не пишут
+    if args.db:
+        for path in (args.db, default_archive_name(args.db)):
+            if os.path.exists(path) and os.path.getsize(path) > 0:
+                parser.error(f"{path} уже существует; укажите новый файл для --db")
+
+    # Во временном каталоге лежит и база узла-партнёра для замера синхронизации
+    workdir = tempfile.TemporaryDirectory()
+    db_path = args.db or os.path.join(workdir.name, "benchmark.db")
+    service = ClinicService.open(db_path, profile=args.profile, sample_data=False)
+    try:
+        generator = ClinicGenerator(args.seed)
+        started = time.perf_counter()
+        counts = generator.populate(service.db, args.patients)
+        load_seconds = time.perf_counter() - started
+        print(f"Сгенерировано за {load_seconds:.1f} с: {counts}", flush=True)
+        results = run_benchmarks(service, generator, args.repeat, workdir.name)
+    finally:
+        service.close()
+        workdir.cleanup()
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "patients": args.patients,
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "profile": args.profile,
+            "rows": counts,
+            "load_seconds": round(load_seconds, 3),
+        },
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as target:
+        json.dump(report, target, ensure_ascii=False, indent=2)
+    for name, result in results.items():
+        print(f"{name:32} медиана {result['median_ms']:.3f} мс, p95 {result['p95_ms']:.3f} мс")
+    print(f"Результаты: {os.path.abspath(args.out)}")
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2775 @@
+import bisect
+import csv
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import secrets
+import socket
+import socketserver
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from typing import NamedTuple, Optional
+
+# Слой данных клиники без интерфейса: схема и миграции, DatabaseManager и ClinicService.
+# Им пользуются оба интерфейса (flet и tkinter), импорт и нагрузочные замеры
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet-экспорт доступен только с pyarrow
+    pa = None
+
+def sql_fold_yo(expression):
+    # fold_yo() встроенными функциями SQLite — для триггеров search_index
+    return f"replace(replace({expression}, 'ё', 'е'), 'Ё', 'Е')"
+
+# Триггеры полнотекстового индекса (миграция 4, см. SEARCH_KINDS)
+SEARCH_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS trg_search_patients_ai AFTER INSERT ON patients BEGIN
+        INSERT INTO search_index(rowid, body) VALUES (new.id * 4 + 1, {sql_fold_yo('new.name')});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_search_patients_au AFTER UPDATE OF name ON patients BEGIN
+        UPDATE search_index SET body = {sql_fold_yo('new.name')} WHERE rowid = old.id * 4 + 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_search_patients_ad AFTER DELETE ON patients BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 4 + 1;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_search_sessions_ai AFTER INSERT ON treatment_sessions BEGIN
+        INSERT INTO search_index(rowid, body) VALUES (new.id * 4 + 2, {sql_fold_yo('new.diagnosis')});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_search_sessions_au AFTER UPDATE OF diagnosis ON treatment_sessions BEGIN
+        UPDATE search_index SET body = {sql_fold_yo('new.diagnosis')} WHERE rowid = old.id * 4 + 2;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_search_sessions_ad AFTER DELETE ON treatment_sessions BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 4 + 2;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_search_procedures_ai AFTER INSERT ON session_procedures BEGIN
+        INSERT INTO search_index(rowid, body)
+        VALUES (new.id * 4 + 3, {sql_fold_yo("new.procedure_name || ' ' || COALESCE(new.parameters, '')")});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_search_procedures_au AFTER UPDATE OF procedure_name, parameters ON session_procedures BEGIN
+        UPDATE search_index SET body = {sql_fold_yo("new.procedure_name || ' ' || COALESCE(new.parameters, '')")}
+        WHERE rowid = old.id * 4 + 3;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_search_procedures_ad AFTER DELETE ON session_procedures BEGIN
+        DELETE FROM search_index WHERE rowid = old.id * 4 + 3;
+    END""",
+]
+
+# Миграции схемы: i-й элемент переводит базу с PRAGMA user_version = i на i + 1.
+# В схеме (триггеры, столбцы) только встроенные функции SQLite: базу открывают и другие
+# клиенты, а функции Python из ConnectionPool.open() нужны лишь миграциям и запросам приложения.
+# Новые изменения схемы добавляются только в конец списка.
+MIGRATIONS = [
+    # 1: индексы для JOIN'ов "Сеансы"/"Процедуры", каскадного удаления и списка пациентов
+    [
+        "CREATE INDEX IF NOT EXISTS idx_sessions_patient_date ON treatment_sessions(patient_id, session_date)",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_date_cover ON treatment_sessions(session_date, patient_id, diagnosis)",
+        "CREATE INDEX IF NOT EXISTS idx_procedures_session ON session_procedures(session_id, procedure_name)",
+        "CREATE INDEX IF NOT EXISTS idx_patients_name ON patients(name)",
+    ],
+    # 2: чистка сирот, оставшихся от удалений без PRAGMA foreign_keys
+    [
+        "DELETE FROM treatment_sessions WHERE patient_id NOT IN (SELECT id FROM patients)",
+        "DELETE FROM session_procedures WHERE session_id NOT IN (SELECT id FROM treatment_sessions)",
+    ],
+    # 3: индексы под фильтры вкладки "Просмотр данных"
+    [
+        "CREATE INDEX IF NOT EXISTS idx_patients_treatment ON patients(treatment_type)",
+        "CREATE INDEX IF NOT EXISTS idx_patients_admission ON patients(admission_date)",
+        "CREATE INDEX IF NOT EXISTS idx_procedures_name ON session_procedures(procedure_name)",
+    ],
+    # 4: полнотекстовый индекс по ФИО, диагнозам и процедурам (см. SEARCH_KINDS)
+    [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+        "body, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+        *SEARCH_TRIGGERS,
+        f"INSERT INTO search_index(rowid, body) SELECT id * 4 + 1, {sql_fold_yo('name')} FROM patients",
+        f"INSERT INTO search_index(rowid, body) SELECT id * 4 + 2, {sql_fold_yo('diagnosis')} FROM treatment_sessions",
+        f"""INSERT INTO search_index(rowid, body)
+            SELECT id * 4 + 3, {sql_fold_yo("procedure_name || ' ' || COALESCE(parameters, '')")} FROM session_procedures""",
+    ],
+    # 5: сводные таблицы статистики, которые ведут триггеры (см. STATS_REBUILD)
+    [
+        """CREATE TABLE IF NOT EXISTS stats_daily_sessions (
+            day TEXT NOT NULL,
+            treatment_type TEXT NOT NULL,
+            sessions INTEGER NOT NULL,
+            PRIMARY KEY (day, treatment_type)
+        ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS stats_procedures (
+            procedure_name TEXT PRIMARY KEY,
+            uses INTEGER NOT NULL
+        ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS stats_demographics (
+            age_bucket INTEGER NOT NULL,
+            gender TEXT NOT NULL,
+            patients INTEGER NOT NULL,
+            PRIMARY KEY (age_bucket, gender)
+        ) WITHOUT ROWID""",
+        # Сеансы по дням и типам лечения. Тип берётся у пациента, поэтому при
+        # каскадном удалении пациента его сеансы списывает BEFORE DELETE на patients:
+        # к моменту удаления сеансов строки пациента уже нет
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_sessions_ai AFTER INSERT ON treatment_sessions BEGIN
+            INSERT INTO stats_daily_sessions(day, treatment_type, sessions)
+            SELECT substr(new.session_date, 1, 10), COALESCE(treatment_type, ''), 1 FROM patients WHERE id = new.patient_id
+            ON CONFLICT(day, treatment_type) DO UPDATE SET sessions = sessions + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_sessions_ad AFTER DELETE ON treatment_sessions BEGIN
+            UPDATE stats_daily_sessions SET sessions = sessions - 1
+            WHERE day = substr(old.session_date, 1, 10)
+              AND treatment_type = (SELECT COALESCE(treatment_type, '') FROM patients WHERE id = old.patient_id);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_sessions_au AFTER UPDATE OF session_date, patient_id ON treatment_sessions BEGIN
+            UPDATE stats_daily_sessions SET sessions = sessions - 1
+            WHERE day = substr(old.session_date, 1, 10)
+              AND treatment_type = (SELECT COALESCE(treatment_type, '') FROM patients WHERE id = old.patient_id);
+            INSERT INTO stats_daily_sessions(day, treatment_type, sessions)
+            SELECT substr(new.session_date, 1, 10), COALESCE(treatment_type, ''), 1 FROM patients WHERE id = new.patient_id
+            ON CONFLICT(day, treatment_type) DO UPDATE SET sessions = sessions + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_patients_bd BEFORE DELETE ON patients BEGIN
+            UPDATE stats_daily_sessions SET sessions = sessions - (
+                SELECT COUNT(*) FROM treatment_sessions
+                WHERE patient_id = old.id AND substr(session_date, 1, 10) = stats_daily_sessions.day
+            )
+            WHERE treatment_type = COALESCE(old.treatment_type, '')
+              AND day IN (SELECT substr(session_date, 1, 10) FROM treatment_sessions WHERE patient_id = old.id);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_patients_type_au AFTER UPDATE OF treatment_type ON patients BEGIN
+            UPDATE stats_daily_sessions SET sessions = sessions - (
+                SELECT COUNT(*) FROM treatment_sessions
+                WHERE patient_id = old.id AND substr(session_date, 1, 10) = stats_daily_sessions.day
+            )
+            WHERE treatment_type = COALESCE(old.treatment_type, '')
+              AND day IN (SELECT substr(session_date, 1, 10) FROM treatment_sessions WHERE patient_id = old.id);
+            INSERT INTO stats_daily_sessions(day, treatment_type, sessions)
+            SELECT substr(session_date, 1, 10), COALESCE(new.treatment_type, ''), COUNT(*)
+            FROM treatment_sessions WHERE patient_id = new.id GROUP BY 1
+            ON CONFLICT(day, treatment_type) DO UPDATE SET sessions = sessions + excluded.sessions;
+        END""",
+        # Частота процедур
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_procedures_ai AFTER INSERT ON session_procedures BEGIN
+            INSERT INTO stats_procedures(procedure_name, uses) VALUES (new.procedure_name, 1)
+            ON CONFLICT(procedure_name) DO UPDATE SET uses = uses + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_procedures_ad AFTER DELETE ON session_procedures BEGIN
+            UPDATE stats_procedures SET uses = uses - 1 WHERE procedure_name = old.procedure_name;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_procedures_au AFTER UPDATE OF procedure_name ON session_procedures BEGIN
+            UPDATE stats_procedures SET uses = uses - 1 WHERE procedure_name = old.procedure_name;
+            INSERT INTO stats_procedures(procedure_name, uses) VALUES (new.procedure_name, 1)
+            ON CONFLICT(procedure_name) DO UPDATE SET uses = uses + 1;
+        END""",
+        # Пациенты по десятилетиям возраста и полу; пустые значения — bucket -1 и пол ''
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_demographics_ai AFTER INSERT ON patients BEGIN
+            INSERT INTO stats_demographics(age_bucket, gender, patients)
+            VALUES (COALESCE(new.age / 10, -1), COALESCE(new.gender, ''), 1)
+            ON CONFLICT(age_bucket, gender) DO UPDATE SET patients = patients + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_demographics_ad AFTER DELETE ON patients BEGIN
+            UPDATE stats_demographics SET patients = patients - 1
+            WHERE age_bucket = COALESCE(old.age / 10, -1) AND gender = COALESCE(old.gender, '');
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_demographics_au AFTER UPDATE OF age, gender ON patients BEGIN
+            UPDATE stats_demographics SET patients = patients - 1
+            WHERE age_bucket = COALESCE(old.age / 10, -1) AND gender = COALESCE(old.gender, '');
+            INSERT INTO stats_demographics(age_bucket, gender, patients)
+            VALUES (COALESCE(new.age / 10, -1), COALESCE(new.gender, ''), 1)
+            ON CONFLICT(age_bucket, gender) DO UPDATE SET patients = patients + 1;
+        END""",
+    ],
+    # 6: контрольные точки импорта, фиксируются в одной транзакции с порцией строк
+    [
+        """CREATE TABLE IF NOT EXISTS import_checkpoints (
+            source TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            imported INTEGER NOT NULL,
+            rejected INTEGER NOT NULL,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (source, kind)
+        )""",
+    ],
+    # 7: справочник процедур (по образцу таблицы procedures из clinic.db), заполняется ниже
+    [
+        """CREATE TABLE IF NOT EXISTS procedures (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            category TEXT
+        )""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_procedures_catalog_name ON procedures(name)",
+    ],
+    # 8: ФИО без учёта регистра и "ё" (fold_name) для подбора пациента по началу строки.
+    # lower() в SQLite не сворачивает кириллицу, поэтому столбец заполняет приложение
+    # (см. DatabaseManager.fold_patient_names)
+    [
+        "ALTER TABLE patients ADD COLUMN name_folded TEXT",
+        "UPDATE patients SET name_folded = fold_name(name)",
+        "CREATE INDEX IF NOT EXISTS idx_patients_name_folded ON patients(name_folded, id)",
+    ],
+    # 9: параметры процедур по ключам (см. parse_parameters). session_procedures.parameters
+    # остаётся исходным текстом, таблицу ведёт приложение (DatabaseManager.index_procedure_parameters);
+    # числа ищутся по индексу диапазоном
+    [
+        """CREATE TABLE IF NOT EXISTS procedure_parameters (
+            procedure_id INTEGER NOT NULL REFERENCES session_procedures(id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            value TEXT NOT NULL,
+            value_num REAL,
+            PRIMARY KEY (procedure_id, name)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS idx_procedure_parameters_num ON procedure_parameters(name, value_num)",
+        "CREATE INDEX IF NOT EXISTS idx_procedure_parameters_text ON procedure_parameters(name, value)",
+        """INSERT INTO procedure_parameters(procedure_id, name, value, value_num)
+           SELECT sp.id, json_extract(p.value, '$[0]'), json_extract(p.value, '$[1]'), json_extract(p.value, '$[2]')
+           FROM session_procedures sp, json_each(parse_parameters(sp.parameters)) p""",
+    ],
+    # 10: даты, введённые до проверки формата, приводятся к ISO-8601 (см. normalize_date).
+    # Сводка stats_daily_sessions правится триггером на UPDATE session_date
+    [
+        "UPDATE patients SET admission_date = iso_date(admission_date) WHERE admission_date IS NOT iso_date(admission_date)",
+        "UPDATE treatment_sessions SET session_date = iso_datetime(session_date) "
+        "WHERE session_date IS NOT iso_datetime(session_date)",
+    ],
+    # 11: мягкое удаление и выписка. Удалённый пациент (deleted_at) пропадает из списков,
+    # подбора и поиска, но история у него остаётся; сеансы выписанных и удалённых
+    # пациентов со временем уходят в архив (см. DatabaseManager.archive_sessions)
+    [
+        "ALTER TABLE patients ADD COLUMN deleted_at TEXT",
+        "ALTER TABLE patients ADD COLUMN discharge_date TEXT",
+    ],
+    # 12: журнал изменений для синхронизации рабочих мест (триггеры и начальное
+    # заполнение — ниже, см. SYNC_TABLES), номер узла со счётчиками id его блока
+    # и отметки по каждому узлу-партнёру
+    [
+        """CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            origin INTEGER
+        )""",
+        """CREATE TABLE IF NOT EXISTS change_context (
+            id INTEGER PRIMARY KEY CHECK(id = 1),
+            origin INTEGER
+        )""",
+        "INSERT OR IGNORE INTO change_context (id, origin) VALUES (1, NULL)",
+        """CREATE TABLE IF NOT EXISTS sync_site (
+            id INTEGER PRIMARY KEY CHECK(id = 1),
+            site INTEGER NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS sync_sequences (
+            name TEXT PRIMARY KEY,
+            seq INTEGER NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS sync_peers (
+            site INTEGER PRIMARY KEY,
+            sent_seq INTEGER NOT NULL DEFAULT 0,
+            received_seq INTEGER NOT NULL DEFAULT 0,
+            synced_at TEXT
+        )""",
+    ],
+    # 13: name_folded не должен расходиться с name, если ФИО правит другой клиент SQLite.
+    # Свернуть кириллицу встроенными функциями нельзя, поэтому триггер только сбрасывает
+    # устаревшее значение, а заново его заполняет приложение (DatabaseManager.fold_patient_names)
+    [
+        """CREATE TRIGGER IF NOT EXISTS trg_patients_name_folded_au AFTER UPDATE OF name ON patients
+           WHEN new.name_folded IS old.name_folded BEGIN
+            UPDATE patients SET name_folded = NULL WHERE id = new.id;
+        END""",
+        "UPDATE patients SET name_folded = fold_name(name) WHERE name_folded IS NOT fold_name(name)",
+    ],
+    # 14: параметры процедур разбираются заново: запятая внутри значения ("Температура: 37,5")
+    # больше не разделяет пары (см. split_parameters)
+    [
+        "DELETE FROM procedure_parameters",
+        """INSERT INTO procedure_parameters(procedure_id, name, value, value_num)
+           SELECT sp.id, json_extract(p.value, '$[0]'), json_extract(p.value, '$[1]'), json_extract(p.value, '$[2]')
+           FROM session_procedures sp, json_each(parse_parameters(sp.parameters)) p""",
+    ],
+    # 15: удалённые пациенты (deleted_at) не входят в stats_demographics: мягкое удаление
+    # списывает пациента из сводки, восстановление возвращает. Сводка пересчитывается
+    # (STATS_DEMOGRAPHICS_REBUILD, ниже)
+    [
+        "DROP TRIGGER IF EXISTS trg_stats_demographics_ai",
+        "DROP TRIGGER IF EXISTS trg_stats_demographics_ad",
+        "DROP TRIGGER IF EXISTS trg_stats_demographics_au",
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_demographics_ai AFTER INSERT ON patients
+           WHEN new.deleted_at IS NULL BEGIN
+            INSERT INTO stats_demographics(age_bucket, gender, patients)
+            VALUES (COALESCE(new.age / 10, -1), COALESCE(new.gender, ''), 1)
+            ON CONFLICT(age_bucket, gender) DO UPDATE SET patients = patients + 1;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_demographics_ad AFTER DELETE ON patients
+           WHEN old.deleted_at IS NULL BEGIN
+            UPDATE stats_demographics SET patients = patients - 1
+            WHERE age_bucket = COALESCE(old.age / 10, -1) AND gender = COALESCE(old.gender, '');
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_stats_demographics_au AFTER UPDATE OF age, gender, deleted_at ON patients BEGIN
+            UPDATE stats_demographics SET patients = patients - 1
+            WHERE old.deleted_at IS NULL
+              AND age_bucket = COALESCE(old.age / 10, -1) AND gender = COALESCE(old.gender, '');
+            INSERT INTO stats_demographics(age_bucket, gender, patients)
+            SELECT COALESCE(new.age / 10, -1), COALESCE(new.gender, ''), 1 WHERE new.deleted_at IS NULL
+            ON CONFLICT(age_bucket, gender) DO UPDATE SET patients = patients + 1;
+        END""",
+        "DELETE FROM stats_demographics",
+    ],
+]
+
+# Полный пересчёт сводных таблиц: начальное заполнение и ручная сверка
+STATS_REBUILD = [
+    "DELETE FROM stats_daily_sessions",
+    "DELETE FROM stats_procedures",
+    "DELETE FROM stats_demographics",
+    """INSERT INTO stats_daily_sessions(day, treatment_type, sessions)
+       SELECT substr(s.session_date, 1, 10), COALESCE(p.treatment_type, ''), COUNT(*)
+       FROM treatment_sessions s JOIN patients p ON p.id = s.patient_id GROUP BY 1, 2""",
+    """INSERT INTO stats_procedures(procedure_name, uses)
+       SELECT procedure_name, COUNT(*) FROM session_procedures GROUP BY 1""",
+]
+# Миграция 5 идёт раньше столбца deleted_at (миграция 11) и считает всех пациентов,
+# с миграции 15 удалённые в сводку не входят
+MIGRATIONS[4].extend(STATS_REBUILD)
+MIGRATIONS[4].append(
+    """INSERT INTO stats_demographics(age_bucket, gender, patients)
+       SELECT COALESCE(age / 10, -1), COALESCE(gender, ''), COUNT(*) FROM patients GROUP BY 1, 2"""
+)
+STATS_DEMOGRAPHICS_REBUILD = """INSERT INTO stats_demographics(age_bucket, gender, patients)
+   SELECT COALESCE(age / 10, -1), COALESCE(gender, ''), COUNT(*) FROM patients
+   WHERE deleted_at IS NULL GROUP BY 1, 2"""
+STATS_REBUILD.append(STATS_DEMOGRAPHICS_REBUILD)
+MIGRATIONS[14].append(STATS_DEMOGRAPHICS_REBUILD)
+
+# Записи search_index: rowid = id * 4 + вид, поэтому триггеры находят и удаляют
+# строку индекса по первичному ключу, а одна выборка ранжирует все виды сразу
+SEARCH_KINDS = {1: "Пациент", 2: "Сеанс", 3: "Процедура"}
+SEARCH_LIMIT = 50
+
+def fold_yo(text):
+    # unicode61 сворачивает регистр кириллицы, но не считает "ё" вариантом "е"
+    if text is None:
+        return None
+    return text.replace("ё", "е").replace("Ё", "Е")
+
+def search_match(text):
+    # Выражение MATCH для search_index: каждое слово запроса ищется как префикс, все слова обязательны
+    terms = re.findall(r"\w+", fold_yo(text or ""))
+    return " ".join(f'"{term}"*' for term in terms)
+
+def fold_name(text):
+    # Ключ поиска пациента: casefold() работает и для кириллицы, в отличие от lower() в SQLite
+    if text is None:
+        return None
+    return fold_yo(text.casefold())
+
+def prefix_upper_bound(prefix):
+    # Наименьшая строка, большая всех строк с этим началом: name_folded >= prefix AND < bound
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+PATIENT_LOOKUP_LIMIT = 20
+TIMELINE_PAGE_SIZE = 50  # сеансов на страницу истории пациента
+
+# Параметры процедуры в тексте: пары "Ключ: значение" через точку с запятой или с новой
+# строки, например "Давление: 120/80; Температура: 37,5". В старом тексте без ";" пары
+# разделены запятыми — тогда делит только запятая перед следующим "Ключ:", а запятая
+# внутри значения остаётся. Часть без двоеточия хранится под ключом PARAMETER_NOTE.
+# В числах допустима десятичная запятая
+PARAMETER_NOTE = "примечание"
+PARAMETER_NUMBER = re.compile(r"[-+]?\d+(?:[.,]\d+)?")
+PARAMETER_RATIO = re.compile(r"^\s*(\d+(?:[.,]\d+)?)\s*/\s*(\d+(?:[.,]\d+)?)")
+PARAMETER_SEPARATOR = re.compile(r"[;\n]")
+PARAMETER_LEGACY_SEPARATOR = re.compile(r",(?=\s*[^\W\d_][^,;:\n]*:)")
+
+def parameter_number(text):
+    return float(text.replace(",", "."))
+
+def split_parameters(text):
+    # [(ключ, значение)] как введены; пустые части пропускаются
+    text = text or ""
+    separator = PARAMETER_SEPARATOR if PARAMETER_SEPARATOR.search(text) else PARAMETER_LEGACY_SEPARATOR
+    pairs = []
+    for part in separator.split(text):
+        key, sep, value = part.partition(":")
+        key, value = key.strip(), value.strip()
+        if not sep:
+            key, value = PARAMETER_NOTE, key
+        if value:
+            pairs.append((key or PARAMETER_NOTE, value))
+    return pairs
+
+def parse_parameters(text):
+    # [(ключ, значение, число или None)] для procedure_parameters: ключ без регистра и "ё",
+    # число — первое в значении ("10 сеансов" -> 10). У дроби "120/80" второе число
+    # хранится отдельно под ключом с суффиксом ".2" (давление: систолическое и диастолическое).
+    # Повтор ключа заменяет прежнее значение
+    parsed = {}
+    for key, value in split_parameters(text):
+        key = fold_name(key)
+        number = PARAMETER_NUMBER.search(value)
+        parsed[key] = (key, value, parameter_number(number.group()) if number else None)
+        ratio = PARAMETER_RATIO.match(value)
+        if ratio:
+            parsed[f"{key}.2"] = (f"{key}.2", ratio.group(2), parameter_number(ratio.group(2)))
+    return list(parsed.values())
+
+def parameters_json(text):
+    # parse_parameters для миграции 9: SQL-функция parse_parameters возвращает JSON-массив
+    return json.dumps(parse_parameters(text), ensure_ascii=False)
+
+def format_parameters(parameters):
+    # Обратное к split_parameters: текст для session_procedures.parameters из пар
+    # (ключ, значение) или dict; строка возвращается как есть. Примечание с двоеточием
+    # ("10:30") пишется с ключом, одиночная пара с запятыми закрывается ";", чтобы
+    # при разборе она не распалась по старому правилу
+    if parameters is None or isinstance(parameters, str):
+        return parameters or ""
+    items = parameters.items() if isinstance(parameters, dict) else parameters
+    parts = []
+    for key, value in items:
+        key, value = str(key).strip(), str(value).strip()
+        note = not key or key == PARAMETER_NOTE
+        if PARAMETER_SEPARATOR.search(key + value) or ":" in key:
+            raise ValueError(f"Параметр «{key or value}»: лишняя точка с запятой или двоеточие")
+        if value:
+            parts.append(value if note and ":" not in value else f"{key or PARAMETER_NOTE}: {value}")
+    text = "; ".join(parts)
+    if len(parts) == 1 and len(split_parameters(text)) > 1:
+        text += ";"
+    return text
+
+# Хранение паролей: users.password = "алгоритм$параметры$соль$хеш".
+# Строки без "$" — старый несолёный SHA-256, они перехешируются при входе
+class ScryptHasher:
+    algorithm = "scrypt"
+
+    def __init__(self, n=2 ** 14, r=8, p=1):
+        self.n, self.r, self.p = n, r, p
+
+    def derive(self, password, salt, n, r, p):
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=32)
+
+    def encode(self, password):
+        salt = secrets.token_bytes(16)
+        digest = self.derive(password, salt, self.n, self.r, self.p)
+        return f"{self.algorithm}${self.n}${self.r}${self.p}${salt.hex()}${digest.hex()}"
+
+    def verify(self, password, encoded):
+        _, n, r, p, salt, digest = encoded.split("$")
+        return hmac.compare_digest(self.derive(password, bytes.fromhex(salt), int(n), int(r), int(p)).hex(), digest)
+
+    def needs_rehash(self, encoded):
+        return encoded.split("$")[1:4] != [str(self.n), str(self.r), str(self.p)]
+
+class Pbkdf2Hasher:
+    algorithm = "pbkdf2_sha256"
+
+    def __init__(self, iterations=600000):
+        self.iterations = iterations
+
+    def derive(self, password, salt, iterations):
+        return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+
+    def encode(self, password):
+        salt = secrets.token_bytes(16)
+        digest = self.derive(password, salt, self.iterations)
+        return f"{self.algorithm}${self.iterations}${salt.hex()}${digest.hex()}"
+
+    def verify(self, password, encoded):
+        _, iterations, salt, digest = encoded.split("$")
+        return hmac.compare_digest(self.derive(password, bytes.fromhex(salt), int(iterations)).hex(), digest)
+
+    def needs_rehash(self, encoded):
+        return int(encoded.split("$")[1]) < self.iterations
+
+class LegacySha256Hasher:
+    # Только проверка: новые пароли в этом формате не сохраняются
+    algorithm = "sha256"
+
+    def encode(self, password):
+        raise ValueError("SHA-256 без соли не используется для новых паролей")
+
+    def verify(self, password, encoded):
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), encoded)
+
+    def needs_rehash(self, encoded):
+        return True
+
+PASSWORD_HASHERS = {hasher.algorithm: hasher for hasher in (ScryptHasher(), Pbkdf2Hasher(), LegacySha256Hasher())}
+# scrypt есть не в каждой сборке OpenSSL, тогда пароли хешируются PBKDF2
+DEFAULT_PASSWORD_HASHER = PASSWORD_HASHERS["scrypt" if hasattr(hashlib, "scrypt") else "pbkdf2_sha256"]
+
+def check_password(password, encoded, preferred=DEFAULT_PASSWORD_HASHER):
+    # Возвращает (пароль верен, хеш пора заменить на preferred)
+    algorithm = encoded.split("$", 1)[0] if "$" in encoded else "sha256"
+    hasher = PASSWORD_HASHERS.get(algorithm)
+    if hasher is None or not hasher.verify(password, encoded):
+        return False, False
+    return True, hasher is not preferred or hasher.needs_rehash(encoded)
+
+CREDENTIAL_CACHE_TTL = 300  # секунд, повторный вход тем же паролем без KDF
+SESSION_TTL = 1800  # секунд бездействия до истечения токена сеанса
+
+# Вкладки интерфейсов и роли, которым они доступны: у пациента вкладок нет,
+# статистика — только администратору и врачу. По ним же проверяются действия на вкладке
+STAFF_ROLES = ("admin", "doctor", "nurse")
+TAB_ROLES = {
+    "Пациенты": STAFF_ROLES,
+    "Лечебные процедуры": STAFF_ROLES,
+    "Просмотр данных": STAFF_ROLES,
+    "Статистика": ("admin", "doctor"),
+    "Диагностика": ("admin",),
+}
+
+# Профили подключения: PRAGMA, выполняемые в connect() в указанном порядке.
+# foreign_keys включён везде, иначе ON DELETE CASCADE не срабатывает.
+CONNECTION_PROFILES = {
+    "default": [
+        ("journal_mode", "DELETE"),
+        ("synchronous", "FULL"),
+        ("foreign_keys", "ON"),
+    ],
+    "production": [
+        ("journal_mode", "WAL"),
+        ("synchronous", "NORMAL"),
+        ("cache_size", -64000),  # ~64 МБ страничного кэша
+        ("mmap_size", 268435456),  # 256 МБ
+        ("temp_store", "MEMORY"),
+        ("foreign_keys", "ON"),
+    ],
+}
+
+# Холодный архив: сеансы с процедурами у пациентов, выписанных или удалённых раньше
+# ARCHIVE_HORIZON_DAYS дней назад, переносятся в отдельный файл (по умолчанию
+# <база>_archive.db). Он подключается к каждому соединению через ATTACH DATABASE как
+# схема archive, поэтому рабочие таблицы ежедневных экранов остаются маленькими, а история
+# видна через временные представления sessions_history и procedures_history.
+# id сохраняются при переносе: AUTOINCREMENT не выдаёт их повторно, и ключи не пересекаются.
+# Параметры архивных процедур остаются текстом, procedure_parameters их не содержит.
+# Архивный сеанс хранит тип лечения пациента на момент переноса: триггер смены типа
+# видит только рабочие таблицы, и архивные сеансы остаются в сводке под прежним типом
+ARCHIVE_HORIZON_DAYS = 365
+ARCHIVE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS archive.treatment_sessions (
+        id INTEGER PRIMARY KEY,
+        patient_id INTEGER NOT NULL,
+        session_date TEXT NOT NULL,
+        diagnosis TEXT NOT NULL,
+        archived_at TEXT NOT NULL,
+        treatment_type TEXT NOT NULL DEFAULT ''
+    )""",
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_sessions_patient_date ON treatment_sessions(patient_id, session_date)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_sessions_date ON treatment_sessions(session_date)",
+    """CREATE TABLE IF NOT EXISTS archive.session_procedures (
+        id INTEGER PRIMARY KEY,
+        session_id INTEGER NOT NULL,
+        procedure_name TEXT NOT NULL,
+        parameters TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_procedures_session ON session_procedures(session_id)",
+    """CREATE TEMP VIEW IF NOT EXISTS sessions_history AS
+       SELECT id, patient_id, session_date, diagnosis FROM main.treatment_sessions
+       UNION ALL
+       SELECT id, patient_id, session_date, diagnosis FROM archive.treatment_sessions""",
+    """CREATE TEMP VIEW IF NOT EXISTS procedures_history AS
+       SELECT id, session_id, procedure_name, parameters FROM main.session_procedures
+       UNION ALL
+       SELECT id, session_id, procedure_name, parameters FROM archive.session_procedures""",
+]
+# Сводки stats_* считают всю историю, и рабочую, и архивную. Перенос в архив удаляет
+# сеансы из рабочих таблиц, и триггеры их списывают: вклад сеансов из temp.archive_batch
+# возвращается со знаком +1, а перед окончательным удалением из архива снимается с -1
+ARCHIVE_STATS_ADJUST = [
+    """INSERT INTO stats_daily_sessions(day, treatment_type, sessions)
+       SELECT substr(session_date, 1, 10), treatment_type, ? * COUNT(*) FROM archive.treatment_sessions
+       WHERE id IN (SELECT id FROM temp.archive_batch) GROUP BY 1, 2
+       ON CONFLICT(day, treatment_type) DO UPDATE SET sessions = sessions + excluded.sessions""",
+    """INSERT INTO stats_procedures(procedure_name, uses)
+       SELECT procedure_name, ? * COUNT(*) FROM archive.session_procedures
+       WHERE session_id IN (SELECT id FROM temp.archive_batch) GROUP BY 1
+       ON CONFLICT(procedure_name) DO UPDATE SET uses = uses + excluded.uses""",
+]
+
+# Синхронизация рабочих мест. Триггеры пишут в change_log только ключ изменённой строки,
+# поэтому узлу-партнёру уходит текущее состояние строки (или её удаление) один раз,
+# сколько бы правок ни было, а цена синхронизации зависит от числа изменений, а не от
+# размера базы. origin — номер узла, от которого пришла правка (NULL — своя): партнёру
+# его же правки не возвращаются. Перенос в архив (origin ARCHIVE_ORIGIN) не журналируется.
+# Узел N выдаёт id от N * SITE_ID_BLOCK (счётчики sync_sequences), поэтому строки разных
+# рабочих мест не совпадают по ключу и переносятся без перенумерации. Данные, заведённые
+# до настройки синхронизации, имеют маленькие id: их стоит вести на одном рабочем месте
+SITE_ID_BLOCK = 10 ** 9
+ARCHIVE_ORIGIN = 0
+SYNC_BATCH_SIZE = 1000  # записей журнала за один обмен
+SYNC_PORT = 8765
+SYNC_TIMEOUT = 60  # секунд на ответ узла по сети
+# Сообщения по сети подписываются HMAC-SHA256 общим секретом рабочих мест (см. seal_sync_message).
+# Метка времени внутри подписи ограничивает повтор перехваченного сообщения SYNC_MAX_SKEW секундами
+SYNC_SECRET_ENV = "MEDICAL_SYNC_SECRET"
+SYNC_MIN_SECRET = 16  # символов
+SYNC_MAX_SKEW = 300
+SYNC_MAX_MESSAGE = 64 * 1024 * 1024  # байт в одной строке запроса
+# Таблицы в порядке зависимостей: родитель строки (таблица, столбец) применяется раньше неё.
+# source — откуда читается состояние строки: сеансы и процедуры бывают и в архиве
+SYNC_TABLES = {
+    "patients": {
+        "columns": ["id", "name", "age", "gender", "admission_date", "treatment_type", "deleted_at", "discharge_date"],
+        "parent": None,
+        "source": "patients",
+    },
+    "treatment_sessions": {
+        "columns": ["id", "patient_id", "session_date", "diagnosis"],
+        "parent": ("patients", "patient_id"),
+        "source": "sessions_history",
+    },
+    "session_procedures": {
+        "columns": ["id", "session_id", "procedure_name", "parameters"],
+        "parent": ("treatment_sessions", "session_id"),
+        "source": "procedures_history",
+    },
+}
+# Источник правки триггеры берут из change_context: DatabaseManager.changes_from задаёт его
+# внутри своей транзакции, остальные соединения и клиенты видят NULL. Обновление журналируется,
+# только если меняет передаваемые столбцы (а не, например, name_folded)
+CHANGE_LOG_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS trg_change_log_{table}_{suffix} AFTER {event} ON {table}
+        WHEN (SELECT origin FROM change_context) IS NOT {ARCHIVE_ORIGIN} BEGIN
+            INSERT INTO change_log(table_name, row_id, origin)
+            VALUES ('{table}', {row}.id, (SELECT origin FROM change_context));
+        END"""
+    for table, spec in SYNC_TABLES.items()
+    for suffix, event, row in (
+        ("ai", "INSERT", "new"), ("au", f"UPDATE OF {', '.join(spec['columns'])}", "new"), ("ad", "DELETE", "old")
+    )
+]
+MIGRATIONS[11].extend(CHANGE_LOG_TRIGGERS)
+# Уже существующие строки (и архивные) попадают в журнал, чтобы первая синхронизация передала всё
+MIGRATIONS[11].extend(
+    f"INSERT INTO change_log(table_name, row_id) SELECT '{table}', id FROM {spec['source']} ORDER BY id"
+    for table, spec in SYNC_TABLES.items()
+)
+
+def sync_upsert_query(table):
+    # Вставка или обновление строки от партнёра. Строка без родителя пропускается, сеанс и
+    # процедура, уже перенесённые здесь в архив, не трогаются. Строка, совпадающая с
+    # имеющейся, не обновляется и не попадает в журнал, так что правки не ходят по кругу
+    spec = SYNC_TABLES[table]
+    columns = spec["columns"]
+    conditions = ["true"]
+    if spec["parent"]:
+        conditions.append(f"EXISTS (SELECT 1 FROM {spec['parent'][0]} WHERE id = ?)")
+        conditions.append(f"NOT EXISTS (SELECT 1 FROM archive.{table} WHERE id = ?)")
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)}) SELECT {', '.join('?' for _ in columns)} "
+        f"WHERE {' AND '.join(conditions)} "
+        f"ON CONFLICT(id) DO UPDATE SET {', '.join(f'{column} = excluded.{column}' for column in columns[1:])} "
+        f"WHERE {' OR '.join(f'{column} IS NOT excluded.{column}' for column in columns[1:])}"
+    )
+
+# Поля запросов handle_sync_request: имя -> тип. limit у changes необязателен
+SYNC_REQUESTS = {
+    "hello": {"site": int},
+    "changes": {"site": int, "since": int},
+    "apply": {"site": int, "changes": dict},
+}
+
+def validate_sync_request(request):
+    # Запрос от узла-партнёра проверяется целиком до обращения к базе; ошибка — ValueError
+    if not isinstance(request, dict):
+        raise ValueError("Запрос синхронизации должен быть JSON-объектом")
+    op = request.get("op")
+    fields = SYNC_REQUESTS.get(op) if isinstance(op, str) else None
+    if fields is None:
+        raise ValueError(f"Неизвестная операция синхронизации: {op}")
+    for name, kind in fields.items():
+        if not isinstance(request.get(name), kind) or isinstance(request.get(name), bool):
+            raise ValueError(f"Запрос {op}: поле {name} отсутствует или не {kind.__name__}")
+    if request["site"] < 1:
+        raise ValueError("Номер узла — целое число от 1")
+    if op == "changes":
+        limit = request.get("limit", SYNC_BATCH_SIZE)
+        if not is_positive_int(limit) or request["since"] < 0:
+            raise ValueError("Запрос changes: since и limit — неотрицательное и положительное целые")
+    if op == "apply":
+        validate_changes(request["changes"])
+
+def validate_changes(changes):
+    # Пакет changes_since: строки известных таблиц с полным набором столбцов, удаления — списки id
+    if not isinstance(changes, dict) or not isinstance(changes.get("last_seq"), int) or not all(
+        isinstance(changes.get(part), dict) and set(changes[part]) <= set(SYNC_TABLES) for part in ("upserts", "deletes")
+    ):
+        raise ValueError("Пакет изменений: нужны last_seq, upserts и deletes по таблицам синхронизации")
+    for table, rows in changes["upserts"].items():
+        width = len(SYNC_TABLES[table]["columns"])
+        if not isinstance(rows, list) or not all(
+            isinstance(row, list) and len(row) == width and is_positive_int(row[0])
+            and all(value is None or isinstance(value, (str, int, float)) for value in row)
+            for row in rows
+        ):
+            raise ValueError(f"Пакет изменений: строки {table} не совпадают со столбцами таблицы")
+    for row in changes["upserts"].get("patients", []):
+        validate_sync_patient(row)
+    for table, ids in changes["deletes"].items():
+        if not isinstance(ids, list) or not all(map(is_positive_int, ids)):
+            raise ValueError(f"Пакет изменений: удаления {table} — список id")
+
+def validate_sync_patient(row):
+    # Пациент от узла-партнёра проходит те же проверки, что и форма (validate_patient);
+    # строка заменяется нормализованной. Пакет с неверной строкой отклоняется целиком
+    _, name, age, gender, admission_date, treatment_type, deleted_at, discharge_date = row
+    try:
+        if not all(value is None or isinstance(value, str) for value in (name, admission_date, deleted_at, discharge_date)):
+            raise ValueError("ФИО и даты должны быть строками")
+        row[1:6] = validate_patient(name, age, gender, admission_date, treatment_type)
+        row[6] = deleted_at and normalize_datetime(deleted_at)
+        row[7] = discharge_date and normalize_date(discharge_date)
+    except ValueError as ex:
+        raise ValueError(f"Пакет изменений: пациент {row[0]}: {ex}") from None
+
+def is_positive_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+def count_changes(changes):
+    return sum(map(len, changes["upserts"].values())) + sum(map(len, changes["deletes"].values()))
+
+def default_archive_name(db_name):
+    # medical.db -> medical_archive.db рядом с базой; у базы в памяти и архив в памяти
+    if db_name == ":memory:":
+        return db_name
+    stem, ext = os.path.splitext(db_name)
+    return f"{stem}_archive{ext or '.db'}"
+
+TREATMENT_TYPES = ["Терапия", "Хирургия", "Диагностика"]
+# Начальное содержимое справочника procedures: (название, категория)
+DEFAULT_PROCEDURES = [
+    ("УЗИ брюшной полости", "Диагностика"),
+    ("Электрокардиография", "Диагностика"),
+    ("МРТ", "Диагностика"),
+    ("Физиотерапия", "Терапия"),
+    ("Лазерная терапия", "Терапия"),
+]
+MIGRATIONS[6].extend(
+    f"INSERT OR IGNORE INTO procedures (name, category) VALUES ('{name}', '{category}')"
+    for name, category in DEFAULT_PROCEDURES
+)
+# Процедуры, уже встречающиеся в сеансах, тоже попадают в справочник (и после импорта)
+SYNC_PROCEDURE_CATALOG = "INSERT OR IGNORE INTO procedures (name) SELECT DISTINCT procedure_name FROM session_procedures"
+MIGRATIONS[6].append(SYNC_PROCEDURE_CATALOG)
+
+# Описание представлений вкладки "Просмотр данных". Имена столбцов в SQL берутся
+# только отсюда, значения фильтров и поиска передаются параметрами.
+# filter — (столбец, справочник ReferenceCache со списком значений);
+# search — (столбец с id, вид записи search_index), по которым ищется текст;
+# active — условие, скрывающее удалённых пациентов; history_query — тот же запрос
+# по рабочим и архивным данным (include_archive)
+DATA_VIEW_LIMIT = 500
+DATA_VIEWS = {
+    "Пациенты": {
+        "query": "SELECT id, name, age, gender, admission_date, treatment_type FROM patients",
+        "active": "deleted_at IS NULL",
+        "columns": [
+            ("ID", "id"), ("ФИО", "name"), ("Возраст", "age"), ("Пол", "gender"),
+            ("Дата поступления", "admission_date"), ("Тип лечения", "treatment_type")
+        ],
+        "search": [("id", 1)],
+        "date": "admission_date",
+        "filter": ("treatment_type", "treatment_types"),
+        "order": ("id", False),
+    },
+    "Сеансы": {
+        "query": "SELECT s.id, s.patient_id, p.name, s.session_date, s.diagnosis FROM treatment_sessions s JOIN patients p ON s.patient_id = p.id",
+        "history_query": "SELECT s.id, s.patient_id, p.name, s.session_date, s.diagnosis FROM sessions_history s JOIN patients p ON s.patient_id = p.id",
+        "active": "p.deleted_at IS NULL",
+        "columns": [
+            ("ID", "s.id"), ("ID пациента", "s.patient_id"), ("Пациент", "p.name"),
+            ("Дата сеанса", "s.session_date"), ("Диагноз", "s.diagnosis")
+        ],
+        "search": [("s.patient_id", 1), ("s.id", 2)],
+        "date": "s.session_date",
+        "filter": None,
+        "order": ("s.session_date", True),
+    },
+    "Процедуры": {
+        "query": "SELECT p.id, p.session_id, s.session_date, p.procedure_name, p.parameters FROM session_procedures p "
+                 "JOIN treatment_sessions s ON p.session_id = s.id JOIN patients pt ON pt.id = s.patient_id",
+        "history_query": "SELECT p.id, p.session_id, s.session_date, p.procedure_name, p.parameters FROM procedures_history p "
+                         "JOIN sessions_history s ON p.session_id = s.id JOIN patients pt ON pt.id = s.patient_id",
+        "active": "pt.deleted_at IS NULL",
+        "columns": [
+            ("ID", "p.id"), ("ID сеанса", "p.session_id"), ("Дата сеанса", "s.session_date"),
+            ("Процедура", "p.procedure_name"), ("Параметры", "p.parameters")
+        ],
+        "search": [("p.id", 3)],
+        "date": "s.session_date",
+        "filter": ("p.procedure_name", "procedures"),
+        "order": ("p.id", False),
+    },
+}
+
+# Даты хранятся текстом ISO-8601: поступление "ГГГГ-ММ-ДД", сеанс "ГГГГ-ММ-ДД ЧЧ:ММ".
+# Такой текст сортируется и сравнивается как время, поэтому ORDER BY и диапазоны
+# идут по индексам idx_patients_admission и idx_sessions_date_cover
+ISO_DATE = "%Y-%m-%d"
+ISO_DATETIME = "%Y-%m-%d %H:%M"
+DATE_FORMATS = ("%Y-%m-%d", "%d.%m.%Y", "%d/%m/%Y", "%Y/%m/%d", "%Y.%m.%d")
+DATETIME_FORMATS = (
+    "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S",
+    "%d.%m.%Y %H:%M", "%d/%m/%Y %H:%M", "%d.%m.%Y %H:%M:%S",
+) + DATE_FORMATS
+
+def parse_datetime(text, formats=DATETIME_FORMATS):
+    text = " ".join(str(text or "").split())
+    for fmt in formats:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+    return None
+
+def normalize_date(text):
+    parsed = parse_datetime(text, DATE_FORMATS)
+    if parsed is None:
+        raise ValueError(f"Неверная дата «{text}»: ожидается ГГГГ-ММ-ДД или ДД.ММ.ГГГГ")
+    return parsed.strftime(ISO_DATE)
+
+def normalize_datetime(text):
+    # Дата без времени означает начало дня, секунды отбрасываются
+    parsed = parse_datetime(text)
+    if parsed is None:
+        raise ValueError(f"Неверные дата и время «{text}»: ожидается ГГГГ-ММ-ДД ЧЧ:ММ или ДД.ММ.ГГГГ ЧЧ:ММ")
+    return parsed.strftime(ISO_DATETIME)
+
+def iso_date_or_text(text):
+    # Для миграции: нераспознанное значение остаётся как было, а не роняет её
+    parsed = parse_datetime(text, DATE_FORMATS) if text is not None else None
+    return parsed.strftime(ISO_DATE) if parsed else text
+
+def iso_datetime_or_text(text):
+    parsed = parse_datetime(text) if text is not None else None
+    return parsed.strftime(ISO_DATETIME) if parsed else text
+
+def period_bounds(period, day=None):
+    # Первый и последний день периода ("day", "week", "month"), в который входит day
+    day = day or date.today()
+    if period == "day":
+        start, end = day, day
+    elif period == "week":
+        start = day - timedelta(days=day.weekday())
+        end = start + timedelta(days=6)
+    elif period == "month":
+        start = day.replace(day=1)
+        end = (start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    else:
+        raise ValueError(f"Неизвестный период: {period}")
+    return start.strftime(ISO_DATE), end.strftime(ISO_DATE)
+
+def validate_patient(name, age, gender, admission_date, treatment_type):
+    # Правила те же, что у формы "Добавить пациента"; возвращает нормализованную строку
+    name = (name or "").strip()
+    admission_date = (admission_date or "").strip()
+    if not name or age in (None, "") or not gender or not admission_date or not treatment_type:
+        raise ValueError("Заполните все поля")
+    try:
+        age = int(age)
+    except (TypeError, ValueError):
+        raise ValueError("Возраст должен быть числом") from None
+    if not 0 < age < 120:
+        raise ValueError("Возраст должен быть от 1 до 119")
+    if gender not in ("М", "Ж"):
+        raise ValueError("Пол должен быть М или Ж")
+    if treatment_type not in TREATMENT_TYPES:
+        raise ValueError(f"Неизвестный тип лечения: {treatment_type}")
+    return name, age, gender, normalize_date(admission_date), treatment_type
+
+def validate_session(patient_id, session_date, diagnosis):
+    session_date = (session_date or "").strip()
+    diagnosis = (diagnosis or "").strip()
+    if patient_id in (None, "") or not session_date or not diagnosis:
+        raise ValueError("Заполните пациента, дату и диагноз")
+    return int(patient_id), normalize_datetime(session_date), diagnosis
+
+def validate_procedure(session_id, procedure_name, parameters):
+    procedure_name = (procedure_name or "").strip()
+    if session_id in (None, "") or not procedure_name:
+        raise ValueError("Заполните сеанс и процедуру")
+    return int(session_id), procedure_name, parameters or ""
+
+def optional_id(value):
+    return int(value) if value not in (None, "") else None
+
+# Импорт: столбцы источника совпадают со столбцами таблиц, id необязателен.
+# parent — (столбец ссылки, таблица), существование родителя проверяется порциями
+IMPORT_SPECS = {
+    "patients": {
+        "table": "patients",
+        "columns": ["name", "age", "gender", "admission_date", "treatment_type"],
+        "validate": validate_patient,
+        "parent": None,
+    },
+    "sessions": {
+        "table": "treatment_sessions",
+        "columns": ["patient_id", "session_date", "diagnosis"],
+        "validate": validate_session,
+        "parent": ("patient_id", "patients"),
+    },
+    "procedures": {
+        "table": "session_procedures",
+        "columns": ["session_id", "procedure_name", "parameters"],
+        "validate": validate_procedure,
+        "parent": ("session_id", "treatment_sessions"),
+    },
+}
+IMPORT_CHUNK_SIZE = 10000
+
+EXPORT_FORMATS = ["csv", "jsonl"] + (["parquet"] if pa is not None else [])
+EXPORT_BATCH_SIZE = 5000
+
+def read_records(path, fmt=None):
+    # Потоковое чтение CSV/JSONL: по одной записи (dict, ошибка разбора или None)
+    fmt = fmt or ("jsonl" if path.lower().endswith((".jsonl", ".ndjson")) else "csv")
+    with open(path, encoding="utf-8-sig", newline="") as source:
+        if fmt == "csv":
+            for record in csv.DictReader(source):
+                yield record, None
+            return
+        for line in source:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as ex:
+                yield {"raw": line.rstrip("\n")}, f"Некорректный JSON: {ex}"
+                continue
+            if not isinstance(record, dict):
+                yield {"raw": record}, "Ожидался JSON-объект"
+                continue
+            yield record, None
+
+@contextmanager
+def export_writer(path, fmt, columns):
+    # Отдаёт функцию записи одной порции строк; файл дописывается по мере выборки
+    if fmt not in ("csv", "jsonl", "parquet"):
+        raise ValueError(f"Неизвестный формат экспорта: {fmt}")
+    if fmt == "parquet":
+        if pa is None:
+            raise RuntimeError("Для экспорта в Parquet установите pyarrow")
+        writer = None
+
+        def write_batch(batch):
+            nonlocal writer
+            if writer is None:
+                inferred = pa.Table.from_pylist([dict(zip(columns, row)) for row in batch]).schema
+                # Столбец, пустой в первой порции, сохраняем как строковый
+                writer = pq.ParquetWriter(path, pa.schema([
+                    pa.field(field.name, pa.string() if pa.types.is_null(field.type) else field.type)
+                    for field in inferred
+                ]))
+            writer.write_table(pa.Table.from_pylist([dict(zip(columns, row)) for row in batch], schema=writer.schema))
+
+        try:
+            yield write_batch
+        finally:
+            if writer is None:
+                writer = pq.ParquetWriter(path, pa.schema([pa.field(column, pa.string()) for column in columns]))
+            writer.close()
+        return
+    # utf-8-sig, чтобы Excel правильно открывал кириллицу в CSV
+    with open(path, "w", encoding="utf-8-sig" if fmt == "csv" else "utf-8", newline="") as target:
+        if fmt == "csv":
+            out = csv.writer(target)
+            out.writerow(columns)
+            yield out.writerows
+        else:
+            yield lambda batch: target.writelines(
+                json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in batch
+            )
+
+# Профилирование запросов (включается явно): границы корзин гистограммы задержек, мс
+LATENCY_BUCKETS_MS = (1, 5, 20, 100, 500, 2000)
+SLOW_QUERY_MS = 100
+SLOW_LOG_SIZE = 200
+EXPLAINABLE_STATEMENTS = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+class QueryProfiler:
+    # Статистика по тексту запроса: вызовы, время, строки и гистограмма задержек.
+    # Запросы дольше slow_ms попадают в журнал вместе с EXPLAIN QUERY PLAN
+    # (план снимается один раз на текст запроса). Параметры не сохраняются:
+    # в них ФИО и диагнозы пациентов
+    def __init__(self, explain, slow_ms=SLOW_QUERY_MS, slow_log_size=SLOW_LOG_SIZE):
+        self.explain = explain
+        self.slow_ms = slow_ms
+        self.lock = threading.Lock()
+        self.statements = {}
+        self.plans = {}
+        self.slow_log = deque(maxlen=slow_log_size)
+
+    def record(self, query, params, elapsed, rows):
+        ms = elapsed * 1000
+        sql = " ".join(query.split())
+        with self.lock:
+            stat = self.statements.get(sql)
+            if stat is None:
+                stat = self.statements[sql] = {
+                    "calls": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0,
+                    "histogram": [0] * (len(LATENCY_BUCKETS_MS) + 1)
+                }
+            stat["calls"] += 1
+            stat["total_ms"] += ms
+            stat["max_ms"] = max(stat["max_ms"], ms)
+            stat["rows"] += max(rows or 0, 0)
+            stat["histogram"][bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+            if ms < self.slow_ms:
+                return
+            plan = self.plans.get(sql)
+        if plan is None:
+            plan = self.plans[sql] = self.explain(query, params)
+        with self.lock:
+            self.slow_log.append({
+                "at": datetime.now().isoformat(timespec="seconds"),
+                "sql": sql,
+                "ms": round(ms, 3),
+                "rows": rows,
+                "plan": plan,
+                # "SCAN t" без USING — чтение всей таблицы; обход индекса (SCAN ... USING INDEX) виден в плане
+                "full_scan": any(line.startswith("SCAN ") and " USING " not in line for line in plan),
+            })
+
+    def snapshot(self):
+        labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+        with self.lock:
+            statements = [
+                {
+                    "sql": sql,
+                    "calls": stat["calls"],
+                    "total_ms": round(stat["total_ms"], 3),
+                    "mean_ms": round(stat["total_ms"] / stat["calls"], 3),
+                    "max_ms": round(stat["max_ms"], 3),
+                    "rows": stat["rows"],
+                    "histogram": dict(zip(labels, stat["histogram"])),
+                    "plan": self.plans.get(sql),
+                }
+                for sql, stat in self.statements.items()
+            ]
+            slow = list(self.slow_log)
+        statements.sort(key=lambda stat: stat["total_ms"], reverse=True)
+        return {
+            "generated_at": datetime.now().isoformat(timespec="seconds"),
+            "slow_ms": self.slow_ms,
+            "statements": statements,
+            "slow_queries": slow,
+            "full_scans": sorted({entry["sql"] for entry in slow if entry["full_scan"]}),
+        }
+
+    def dump(self, path):
+        with open(path, "w", encoding="utf-8") as target:
+            json.dump(self.snapshot(), target, ensure_ascii=False, indent=2)
+        return path
+
+    def reset(self):
+        with self.lock:
+            self.statements.clear()
+            self.plans.clear()
+            self.slow_log.clear()
+
+class ConnectionPool:
+    # Писатель один на всё приложение и работает строго под write_lock;
+    # читатели открываются лениво, по одному соединению на поток.
+    # В режиме WAL длинные чтения не блокируют запись и наоборот.
+    def __init__(self, db_name, pragmas=(), archive_name=None):
+        self.db_name = db_name
+        self.pragmas = list(pragmas)
+        self.archive_name = archive_name
+        self.in_memory = db_name == ":memory:"
+        self.write_lock = threading.RLock()
+        self.local = threading.local()
+        self.readers = []
+        self.readers_lock = threading.Lock()
+        self.writer = self.open()
+
+    def open(self):
+        conn = sqlite3.connect(self.db_name, timeout=30, check_same_thread=False)
+        # Нужны миграциям и запросам приложения на каждом соединении
+        conn.create_function("fold_name", 1, fold_name, deterministic=True)
+        conn.create_function("parse_parameters", 1, parameters_json, deterministic=True)
+        conn.create_function("iso_date", 1, iso_date_or_text, deterministic=True)
+        conn.create_function("iso_datetime", 1, iso_datetime_or_text, deterministic=True)
+        for pragma, value in self.pragmas:
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        if self.archive_name:
+            # ATTACH и временные представления действуют только на своё соединение.
+            # Читатель переходит в query_only уже после этого
+            conn.execute("ATTACH DATABASE ? AS archive", (self.archive_name,))
+            for statement in ARCHIVE_SCHEMA:
+                conn.execute(statement)
+        return conn
+
+    def reader(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.open()
+            conn.execute("PRAGMA query_only = ON")
+            self.local.conn = conn
+            with self.readers_lock:
+                self.readers.append(conn)
+        return conn
+
+    def release_reader(self):
+        # Закрывает читателя текущего потока; нужно потокам, которые живут недолго
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            return
+        self.local.conn = None
+        with self.readers_lock:
+            self.readers.remove(conn)
+        conn.close()
+
+    def close(self):
+        with self.readers_lock:
+            for conn in self.readers:
+                conn.close()
+            self.readers.clear()
+        with self.write_lock:
+            self.writer.close()
+
+class CredentialCache:
+    # Недавно проверенные логины. Хранится не пароль, а HMAC от него на случайном ключе
+    # процесса: дамп памяти не даёт ни пароля, ни хеша, который можно перебирать офлайн
+    def __init__(self, ttl=CREDENTIAL_CACHE_TTL):
+        self.ttl = ttl
+        self.key = secrets.token_bytes(32)
+        self.lock = threading.Lock()
+        self.entries = {}  # логин -> (HMAC пароля, (id, роль), истекает)
+
+    def fingerprint(self, username, password):
+        return hmac.new(self.key, f"{username}\0{password}".encode(), hashlib.sha256).digest()
+
+    def lookup(self, username, password):
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is None:
+                return None
+            if entry[2] < time.monotonic():
+                del self.entries[username]
+                return None
+        return entry[1] if hmac.compare_digest(entry[0], self.fingerprint(username, password)) else None
+
+    def remember(self, username, password, user):
+        with self.lock:
+            self.entries[username] = (self.fingerprint(username, password), user, time.monotonic() + self.ttl)
+
+    def forget(self, username):
+        with self.lock:
+            self.entries.pop(username, None)
+
+class SessionExpiredError(PermissionError):
+    pass
+
+class SessionTokens:
+    # Токен сеанса интерфейса -> (id, роль). Проверка роли внутри приложения
+    # идёт по токену, без повторной аутентификации; срок продлевается при каждом обращении
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def issue(self, user):
+        token = secrets.token_urlsafe(32)
+        with self.lock:
+            self.sessions[token] = (user, time.monotonic() + self.ttl)
+        return token
+
+    def resolve(self, token):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.sessions.get(token)
+            if entry is None:
+                return None
+            if entry[1] < now:
+                del self.sessions[token]
+                return None
+            self.sessions[token] = (entry[0], now + self.ttl)
+            return entry[0]
+
+    def revoke(self, token):
+        with self.lock:
+            self.sessions.pop(token, None)
+
+class ReferenceCache:
+    # Справочники для выпадающих списков: читаются из БД при первом обращении,
+    # дальше записи правят их на месте (write-through) или сбрасывают.
+    # Значение заменяется целиком, поэтому уже выданные списки не меняются под читателем.
+    def __init__(self, loaders):
+        self.loaders = loaders
+        self.lock = threading.Lock()
+        self.values = {}
+        self.versions = dict.fromkeys(loaders, 0)
+
+    def get(self, name):
+        with self.lock:
+            if name in self.values:
+                return self.values[name]
+            version = self.versions[name]
+        value = self.loaders[name]()
+        with self.lock:
+            # Если справочник изменили во время загрузки, прочитанное уже устарело
+            if self.versions[name] == version:
+                self.values[name] = value
+        return value
+
+    def version(self, name):
+        with self.lock:
+            return self.versions[name]
+
+    def patch(self, name, change):
+        # change получает текущий список и возвращает новый; незагруженный справочник
+        # просто прочитается заново при следующем get
+        with self.lock:
+            self.versions[name] += 1
+            if name in self.values:
+                self.values[name] = change(self.values[name])
+
+    def invalidate(self, name=None):
+        with self.lock:
+            for key in [name] if name else list(self.versions):
+                self.versions[key] += 1
+                self.values.pop(key, None)
+
+class PrefixCache:
+    # Последние результаты поиска по началу строки (LRU). Если более короткий префикс
+    # вернул меньше limit строк, это все совпадения, и длинный отбирается из них без БД
+    def __init__(self, load, matches, limit, size=256):
+        self.load = load
+        self.matches = matches
+        self.limit = limit
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.version = 0
+
+    def get(self, prefix):
+        with self.lock:
+            rows = self.entries.get(prefix)
+            if rows is not None:
+                self.entries.move_to_end(prefix)
+                return rows
+            for length in range(len(prefix) - 1, 0, -1):
+                shorter = self.entries.get(prefix[:length])
+                if shorter is not None and len(shorter) < self.limit:
+                    rows = [row for row in shorter if self.matches(row, prefix)]
+                    break
+            version = self.version
+        if rows is None:
+            rows = self.load(prefix, self.limit)
+        with self.lock:
+            # Результат, прочитанный до записи, не кэшируем
+            if self.version == version:
+                self.entries[prefix] = rows
+                if len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return rows
+
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+            self.entries.clear()
+
+class DatabaseManager:
+    def __init__(self, db_name='medical.db', profile='default', archive_name=None):
+        if profile not in CONNECTION_PROFILES:
+            raise ValueError(f"Неизвестный профиль подключения: {profile}")
+        self.db_name = db_name
+        self.profile = profile
+        self.archive_name = archive_name or default_archive_name(db_name)
+        self.pool = None
+        self.conn = None
+        self.cursor = None
+        self.transaction_owner = None
+        self.references = ReferenceCache({
+            "procedures": lambda: [row[0] for row in self.execute_query("SELECT name FROM procedures ORDER BY name", fetch_all=True)],
+            "treatment_types": lambda: list(TREATMENT_TYPES),
+        })
+        # Пациентов может быть миллион, поэтому вместо полного списка кэшируются
+        # результаты подбора по началу ФИО
+        self.patient_lookup = PrefixCache(
+            self._find_patients_by_prefix,
+            lambda row, prefix: fold_name(row[1]).startswith(prefix),
+            PATIENT_LOOKUP_LIMIT
+        )
+        # Справочники, изменённые внутри текущей transaction(): сбрасываются после её завершения
+        self.dirty_references = set()
+        self.password_hasher = DEFAULT_PASSWORD_HASHER
+        # QueryProfiler, пока профилирование включено (enable_profiling)
+        self.profiler = None
+        self.credential_cache = CredentialCache()
+        self.sessions = SessionTokens()
+
+    def connect(self):
+        self.pool = ConnectionPool(self.db_name, CONNECTION_PROFILES[self.profile], self.archive_name)
+        # conn/cursor — соединение писателя, использовать только под pool.write_lock
+        self.conn = self.pool.writer
+        self.cursor = self.conn.cursor()
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+
+    @property
+    def in_transaction(self):
+        return self.transaction_owner == threading.get_ident()
+
+    def execute_query(self, query, params=(), fetch_one=False, fetch_all=False, commit=False):
+        if self.profiler is None:
+            return self._run_query(query, params, fetch_one, fetch_all, commit)[0]
+        started = time.perf_counter()
+        result, rows = self._run_query(query, params, fetch_one, fetch_all, commit)
+        self.profiler.record(query, params, time.perf_counter() - started, rows)
+        return result
+
+    def _run_query(self, query, params, fetch_one, fetch_all, commit):
+        # Возвращает (результат, число строк). Чтения идут через соединение текущего потока;
+        # внутри своей транзакции поток читает через писателя, чтобы видеть незафиксированные изменения
+        if not commit and (fetch_one or fetch_all) and not self.in_transaction and not self.pool.in_memory:
+            cursor = self.pool.reader().execute(query, params)
+            if fetch_one:
+                row = cursor.fetchone()
+                return row, int(row is not None)
+            rows = cursor.fetchall()
+            return rows, len(rows)
+        with self.pool.write_lock:
+            self.cursor.execute(query, params)
+            if commit:
+                # Внутри transaction() фиксация откладывается до выхода из блока
+                if not self.in_transaction:
+                    self.conn.commit()
+                return (self.cursor.lastrowid if "INSERT" in query.upper() else None), self.cursor.rowcount
+            if fetch_one:
+                row = self.cursor.fetchone()
+                return row, int(row is not None)
+            if fetch_all:
+                rows = self.cursor.fetchall()
+                return rows, len(rows)
+            return None, self.cursor.rowcount
+
+    def execute_many(self, query, rows, commit=False):
+        started = time.perf_counter()
+        with self.pool.write_lock:
+            self.cursor.executemany(query, rows)
+            if commit and not self.in_transaction:
+                self.conn.commit()
+            rowcount = self.cursor.rowcount
+        if self.profiler is not None:
+            self.profiler.record(query, (), time.perf_counter() - started, rowcount)
+        return rowcount
+
+    def enable_profiling(self, slow_ms=SLOW_QUERY_MS, profiler=None):
+        # profiler — продолжить накопление в уже собранной статистике
+        self.profiler = profiler or QueryProfiler(self.explain_query, slow_ms)
+        self.profiler.slow_ms = slow_ms
+        return self.profiler
+
+    def disable_profiling(self):
+        # Возвращает профилировщик с накопленной статистикой
+        profiler, self.profiler = self.profiler, None
+        return profiler
+
+    def explain_query(self, query, params=()):
+        # Строки EXPLAIN QUERY PLAN; сам запрос при этом не выполняется
+        if not query.lstrip().upper().startswith(EXPLAINABLE_STATEMENTS):
+            return []
+        if not params and "?" in query:
+            params = (None,) * query.count("?")  # execute_many: план не зависит от значений
+        try:
+            if self.pool.in_memory:
+                with self.pool.write_lock:
+                    plan = self.conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+            else:
+                plan = self.pool.reader().execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+        except sqlite3.Error as ex:
+            return [f"план недоступен: {ex}"]
+        return [row[3] for row in plan]
+
+    @contextmanager
+    def transaction(self):
+        # Один COMMIT на всю логическую операцию; при ошибке откатывается всё.
+        # Писатель захвачен на всё время блока, остальные потоки пишут после.
+        # Вложенный transaction() присоединяется к внешней транзакции.
+        if self.in_transaction:
+            yield self
+            return
+        with self.pool.write_lock:
+            self.cursor.execute("BEGIN")
+            self.transaction_owner = threading.get_ident()
+            try:
+                yield self
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+            finally:
+                self.transaction_owner = None
+                for name in self.dirty_references:
+                    self.invalidate_reference(name)
+                self.dirty_references.clear()
+
+    def invalidate_reference(self, name):
+        if name == "patients":
+            self.patient_lookup.invalidate()
+        else:
+            self.references.invalidate(name)
+
+    def reference_changed(self, name, change=None):
+        # Write-through после COMMIT; внутри транзакции правка может откатиться,
+        # поэтому справочник только сбрасывается по её окончании
+        if self.in_transaction:
+            self.dirty_references.add(name)
+        elif change is None:
+            self.invalidate_reference(name)
+        else:
+            self.references.patch(name, change)
+
+    def add_patient(self, name, age, gender, admission_date, treatment_type):
+        with self.transaction():
+            patient_id = self.execute_query(
+                "INSERT INTO patients (id, name, age, gender, admission_date, treatment_type, name_folded) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self._allocate_ids("patients")[0], name, age, gender, admission_date, treatment_type, fold_name(name)),
+                commit=True
+            )
+            self.reference_changed("patients")
+        return patient_id
+
+    def fold_patient_names(self, ids=None):
+        # name_folded (см. миграции 8 и 13) заполняет приложение. Без ids — у строк, где его нет
+        # (импорт, вставки и правки ФИО другими клиентами SQLite), по индексу; с ids — у строк,
+        # чьё ФИО могло измениться
+        if ids is None:
+            self.execute_query("UPDATE patients SET name_folded = fold_name(name) WHERE name_folded IS NULL", commit=True)
+            return
+        self.execute_query(
+            "UPDATE patients SET name_folded = fold_name(name) "
+            "WHERE id IN (SELECT value FROM json_each(?)) AND name_folded IS NOT fold_name(name)",
+            (json.dumps(ids),),
+            commit=True
+        )
+
+    def _allocate_ids(self, table, count=1):
+        # id новых строк из блока своего узла (см. SITE_ID_BLOCK); пока номер узла не задан —
+        # None, то есть обычный AUTOINCREMENT. После синхронизации он не годится: выдаёт id
+        # после самого большого в таблице, а это может быть строка чужого узла.
+        # Вызывается внутри transaction(), чтобы счётчик фиксировался вместе со строками
+        row = self.execute_query("SELECT seq FROM sync_sequences WHERE name = ?", (table,), fetch_one=True)
+        if row is None:
+            return [None] * count
+        self.execute_query("UPDATE sync_sequences SET seq = seq + ? WHERE name = ?", (count, table), commit=True)
+        return list(range(row[0] + 1, row[0] + count + 1))
+
+    def _assign_ids(self, table, rows):
+        # Строкам без id (первый столбец) выдаются id узла
+        ids = iter(self._allocate_ids(table, sum(1 for values in rows if values[0] is None)))
+        return [(next(ids),) + tuple(values[1:]) if values[0] is None else values for values in rows]
+
+    def delete_patient(self, patient_id):
+        # Мягкое удаление: пациент пропадает из списков, подбора и поиска, история остаётся.
+        # restore_patient возвращает его, purge_patient удаляет окончательно
+        self.execute_query(
+            "UPDATE patients SET deleted_at = ? WHERE id = ? AND deleted_at IS NULL",
+            (datetime.now().strftime(ISO_DATETIME), patient_id),
+            commit=True
+        )
+        self.reference_changed("patients")
+
+    def restore_patient(self, patient_id):
+        self.execute_query("UPDATE patients SET deleted_at = NULL WHERE id = ?", (patient_id,), commit=True)
+        self.reference_changed("patients")
+
+    def discharge_patient(self, patient_id, discharge_date):
+        self.execute_query("UPDATE patients SET discharge_date = ? WHERE id = ?", (discharge_date, patient_id), commit=True)
+
+    def purge_patient(self, patient_id):
+        # Окончательное удаление вместе с архивной историей. Рабочие сеансы списывают
+        # из сводок триггеры, архивные — ARCHIVE_STATS_ADJUST
+        with self.transaction():
+            self._fill_archive_batch("SELECT id FROM archive.treatment_sessions WHERE patient_id = ?", (patient_id,))
+            self._adjust_archive_stats(-1)
+            self.execute_query(
+                "DELETE FROM archive.session_procedures WHERE session_id IN (SELECT id FROM temp.archive_batch)",
+                commit=True
+            )
+            self.execute_query("DELETE FROM archive.treatment_sessions WHERE patient_id = ?", (patient_id,), commit=True)
+            self.execute_query("DELETE FROM patients WHERE id = ?", (patient_id,), commit=True)
+            self.reference_changed("patients")
+
+    def archive_sessions(self, horizon_days=ARCHIVE_HORIZON_DAYS, today=None):
+        # Перенос в архив сеансов старше горизонта у пациентов, выписанных (или удалённых)
+        # раньше него. Сначала копия в архив, затем удаление из рабочих таблиц: в режиме
+        # WAL транзакция по двум файлам атомарна только для каждого файла, поэтому сбой
+        # между шагами оставляет лишь лишнюю копию, а повторный запуск доводит перенос до конца.
+        # Возвращает {"sessions": ..., "procedures": ..., "archive": путь архива}
+        cutoff = ((today or date.today()) - timedelta(days=horizon_days)).strftime(ISO_DATE)
+        result = {"sessions": 0, "procedures": 0, "archive": self.archive_name}
+        with self.pool.write_lock:
+            with self.transaction():
+                result["sessions"] = self._fill_archive_batch(
+                    """SELECT s.id FROM patients p JOIN treatment_sessions s ON s.patient_id = p.id
+                       WHERE COALESCE(p.discharge_date, substr(p.deleted_at, 1, 10)) < ? AND s.session_date < ?""",
+                    (cutoff, cutoff)
+                )
+                if not result["sessions"]:
+                    return result
+                self.execute_query(
+                    """INSERT OR IGNORE INTO archive.treatment_sessions
+                           (id, patient_id, session_date, diagnosis, archived_at, treatment_type)
+                       SELECT s.id, s.patient_id, s.session_date, s.diagnosis, ?, COALESCE(p.treatment_type, '')
+                       FROM main.treatment_sessions s JOIN patients p ON p.id = s.patient_id
+                       WHERE s.id IN (SELECT id FROM temp.archive_batch)""",
+                    (datetime.now().strftime(ISO_DATETIME),),
+                    commit=True
+                )
+                self.execute_query(
+                    """INSERT OR IGNORE INTO archive.session_procedures (id, session_id, procedure_name, parameters)
+                       SELECT id, session_id, procedure_name, parameters FROM main.session_procedures
+                       WHERE session_id IN (SELECT id FROM temp.archive_batch)""",
+                    commit=True
+                )
+                result["procedures"] = self.execute_query(
+                    "SELECT COUNT(*) FROM main.session_procedures WHERE session_id IN (SELECT id FROM temp.archive_batch)",
+                    fetch_one=True
+                )[0]
+            with self.changes_from(ARCHIVE_ORIGIN):
+                # Процедуры и их параметры удаляются каскадом; узлам-партнёрам перенос не передаётся
+                self.execute_query(
+                    "DELETE FROM main.treatment_sessions WHERE id IN (SELECT id FROM temp.archive_batch)", commit=True
+                )
+                self._adjust_archive_stats(1)
+        return result
+
+    def _fill_archive_batch(self, select, params=()):
+        # temp.archive_batch — id сеансов, которые переносит или удаляет текущая операция архива.
+        # Временная таблица видна только писателю, поэтому вызывается внутри transaction()
+        self.execute_query("CREATE TEMP TABLE IF NOT EXISTS archive_batch (id INTEGER PRIMARY KEY)", commit=True)
+        self.execute_query("DELETE FROM temp.archive_batch", commit=True)
+        self.execute_query(f"INSERT INTO temp.archive_batch (id) {select}", params, commit=True)
+        return self.execute_query("SELECT COUNT(*) FROM temp.archive_batch", fetch_one=True)[0]
+
+    def _adjust_archive_stats(self, sign):
+        for statement in ARCHIVE_STATS_ADJUST:
+            self.execute_query(statement, (sign,), commit=True)
+
+    @contextmanager
+    def changes_from(self, origin):
+        # Правки внутри блока записываются в change_log с этим источником. Блок — одна
+        # транзакция: при откате change_context возвращается к прежнему значению сам
+        with self.transaction():
+            previous = self.execute_query("SELECT origin FROM change_context", fetch_one=True)[0]
+            self.execute_query("UPDATE change_context SET origin = ?", (origin,), commit=True)
+            yield self
+            self.execute_query("UPDATE change_context SET origin = ?", (previous,), commit=True)
+
+    def site(self):
+        row = self.execute_query("SELECT site FROM sync_site", fetch_one=True)
+        return row[0] if row else None
+
+    def require_site(self):
+        site = self.site()
+        if site is None:
+            raise ValueError("Номер узла не задан: укажите его перед синхронизацией (--site)")
+        return site
+
+    def set_site(self, site):
+        # Номер задаётся один раз; с ним новые строки получают id из блока узла (_allocate_ids)
+        if not isinstance(site, int) or site < 1:
+            raise ValueError("Номер узла — целое число от 1")
+        current = self.site()
+        if current is not None and current != site:
+            raise ValueError(f"Номер узла уже задан: {current}")
+        first_id = site * SITE_ID_BLOCK
+        with self.transaction():
+            self.execute_query("INSERT OR IGNORE INTO sync_site (id, site) VALUES (1, ?)", (site,), commit=True)
+            for table, spec in SYNC_TABLES.items():
+                self.execute_query(
+                    f"""INSERT OR IGNORE INTO sync_sequences (name, seq)
+                        SELECT ?, COALESCE(MAX(id), ?) FROM {spec['source']} WHERE id >= ? AND id < ?""",
+                    (table, first_id, first_id, first_id + SITE_ID_BLOCK),
+                    commit=True
+                )
+
+    def peer_watermarks(self, peer_site):
+        # (последний отправленный seq своего журнала, последний применённый seq журнала партнёра)
+        row = self.execute_query("SELECT sent_seq, received_seq FROM sync_peers WHERE site = ?", (peer_site,), fetch_one=True)
+        return tuple(row) if row else (0, 0)
+
+    def _save_watermark(self, peer_site, column, seq):
+        self.execute_query(
+            f"""INSERT INTO sync_peers (site, {column}, synced_at) VALUES (?, ?, ?)
+                ON CONFLICT(site) DO UPDATE SET {column} = MAX({column}, excluded.{column}), synced_at = excluded.synced_at""",
+            (peer_site, seq, datetime.now().strftime(ISO_DATETIME)),
+            commit=True
+        )
+
+    def changes_since(self, since, exclude_origin, limit=SYNC_BATCH_SIZE):
+        # Изменения после записи журнала since, не больше limit записей. Повторные правки
+        # строки схлопываются: уходит её текущее состояние или удаление. Правки, пришедшие
+        # от exclude_origin, ему же не возвращаются.
+        # Возвращает {"last_seq": ..., "upserts": {таблица: [строки]}, "deletes": {таблица: [id]}}
+        last_seq = self.execute_query(
+            "SELECT MAX(seq) FROM (SELECT seq FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?)",
+            (since, limit),
+            fetch_one=True
+        )[0]
+        changes = {"last_seq": last_seq or since, "upserts": {}, "deletes": {}}
+        if last_seq is None:
+            return changes
+        for table, spec in SYNC_TABLES.items():
+            ids = [row[0] for row in self.execute_query(
+                """SELECT DISTINCT row_id FROM change_log
+                   WHERE seq > ? AND seq <= ? AND table_name = ? AND origin IS NOT ?""",
+                (since, last_seq, table, exclude_origin),
+                fetch_all=True
+            )]
+            if not ids:
+                continue
+            rows = self.execute_query(
+                f"SELECT {', '.join(spec['columns'])} FROM {spec['source']} WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps(ids),),
+                fetch_all=True
+            )
+            found = {row[0] for row in rows}
+            changes["upserts"][table] = [list(row) for row in rows]
+            changes["deletes"][table] = [row_id for row_id in ids if row_id not in found]
+        return changes
+
+    def apply_changes(self, changes, origin, received_seq=None):
+        # Применение пакета changes_since от узла origin одной транзакцией. Удаления идут
+        # от дочерних таблиц к родительским (пациент — через purge_patient, вместе с архивом),
+        # вставки — от родительских. received_seq сохраняется как отметка партнёра в той же транзакции
+        with self.changes_from(origin):
+            for table in reversed(list(SYNC_TABLES)):
+                deleted = changes["deletes"].get(table)
+                if not deleted:
+                    continue
+                if table == "patients":
+                    for patient_id in deleted:
+                        self.purge_patient(patient_id)
+                else:
+                    self.execute_query(
+                        f"DELETE FROM {table} WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(deleted),), commit=True
+                    )
+            for table, spec in SYNC_TABLES.items():
+                rows = changes["upserts"].get(table)
+                if not rows:
+                    continue
+                if spec["parent"]:
+                    parent_index = spec["columns"].index(spec["parent"][1])
+                    rows = [list(row) + [row[parent_index], row[0]] for row in rows]
+                self.execute_many(sync_upsert_query(table), rows, commit=True)
+                if table == "patients":
+                    self.fold_patient_names([row[0] for row in rows])
+                elif table == "session_procedures":
+                    self.index_procedure_parameters(
+                        "id IN (SELECT value FROM json_each(?))", (json.dumps([row[0] for row in rows]),)
+                    )
+            self.execute_query(SYNC_PROCEDURE_CATALOG, commit=True)
+            if received_seq is not None:
+                self._save_watermark(origin, "received_seq", received_seq)
+            self.reference_changed("patients")
+            self.reference_changed("procedures")
+
+    def handle_sync_request(self, request):
+        # Сторона узла-партнёра в обмене: запросы приходят от sync_with через SyncServer или FilePeer.
+        # Партнёр ведёт те же отметки, что и вызывающий узел, поэтому следующий обмен, кто бы
+        # его ни начал, не повторяет уже переданное: запрос changes с since подтверждает
+        # получение всего до since, принятый пакет отмечается вместе с применением
+        validate_sync_request(request)
+        op = request["op"]
+        if op == "hello":
+            return {"site": self.require_site()}
+        if op == "changes":
+            self._save_watermark(request["site"], "sent_seq", request["since"])
+            return self.changes_since(request["since"], request["site"], request.get("limit", SYNC_BATCH_SIZE))
+        self.apply_changes(request["changes"], request["site"], received_seq=request["changes"]["last_seq"])
+        return {"applied": True}
+
+    def sync_with(self, peer, batch_size=SYNC_BATCH_SIZE, progress=None):
+        # Двусторонний обмен с узлом peer (FilePeer, SocketPeer): сначала свои изменения после
+        # отметки sent_seq, затем его изменения после received_seq. Отметки сохраняются после
+        # каждого пакета, поэтому прерванный обмен продолжается с места остановки; повторно
+        # применённый пакет ничего не меняет. При встречной правке одной строки побеждает
+        # вызвавший узел: его версия уходит первой, а вернувшаяся совпадает с ней.
+        # Возвращает {"peer": номер узла, "sent": строк, "received": строк}
+        site = self.require_site()
+        peer_site = peer.call({"op": "hello", "site": site})["site"]
+        if peer_site == site:
+            raise ValueError(f"У узла-партнёра тот же номер {site}")
+        sent, received = self.peer_watermarks(peer_site)
+        result = {"peer": peer_site, "sent": 0, "received": 0}
+        while True:
+            changes = self.changes_since(sent, peer_site, batch_size)
+            if changes["last_seq"] == sent:
+                break
+            peer.call({"op": "apply", "site": site, "changes": changes})
+            sent = changes["last_seq"]
+            self._save_watermark(peer_site, "sent_seq", sent)
+            result["sent"] += count_changes(changes)
+            if progress:
+                progress(result)
+        while True:
+            changes = peer.call({"op": "changes", "site": site, "since": received, "limit": batch_size})
+            validate_changes(changes)
+            if changes["last_seq"] == received:
+                break
+            self.apply_changes(changes, peer_site, received_seq=changes["last_seq"])
+            received = changes["last_seq"]
+            result["received"] += count_changes(changes)
+            if progress:
+                progress(result)
+        return result
+
+    def authenticate(self, username, password):
+        # (id, роль) или None. Удачная проверка запоминается в credential_cache, так что
+        # повторный вход не платит за KDF; хеш устаревшей схемы заменяется текущим
+        user = self.credential_cache.lookup(username, password)
+        if user is not None:
+            return user
+        row = self.execute_query("SELECT id, role, password FROM users WHERE username = ?", (username,), fetch_one=True)
+        if row is None:
+            # Та же работа, что и для существующего логина: время ответа не выдаёт имя
+            self.password_hasher.encode(password)
+            return None
+        valid, stale = check_password(password, row[2], self.password_hasher)
+        if not valid:
+            return None
+        if stale:
+            self.execute_query(
+                "UPDATE users SET password = ? WHERE id = ? AND password = ?",
+                (self.password_hasher.encode(password), row[0], row[2]),
+                commit=True
+            )
+        user = (row[0], row[1])
+        self.credential_cache.remember(username, password, user)
+        return user
+
+    def search_patients(self, text):
+        # Подбор пациента для формы: по началу ФИО без учёта регистра и "ё",
+        # а строка из цифр дополнительно ищется как id
+        prefix = fold_name((text or "").strip())
+        if not prefix:
+            return []
+        rows = list(self.patient_lookup.get(prefix))
+        if prefix.isdigit():
+            by_id = self.execute_query(
+                "SELECT id, name FROM patients WHERE id = ? AND deleted_at IS NULL", (int(prefix),), fetch_one=True
+            )
+            if by_id and by_id not in rows:
+                rows = [by_id] + rows[:PATIENT_LOOKUP_LIMIT - 1]
+        return rows
+
+    def _find_patients_by_prefix(self, prefix, limit):
+        # Диапазон по idx_patients_name_folded: читается не больше limit записей индекса
+        return self.execute_query(
+            "SELECT id, name FROM patients WHERE name_folded >= ? AND name_folded < ? AND deleted_at IS NULL "
+            "ORDER BY name_folded, id LIMIT ?",
+            (prefix, prefix_upper_bound(prefix), limit),
+            fetch_all=True
+        )
+
+    def get_patients_page(self, after_id=None, before_id=None, limit=50):
+        # Keyset-пагинация по id: без OFFSET, цена страницы не зависит от её номера.
+        # Возвращает (строки по возрастанию id, есть ли ещё строки в направлении запроса)
+        columns = "SELECT id, name, age, gender, admission_date, treatment_type FROM patients"
+        if before_id is not None:
+            rows = self.execute_query(
+                f"{columns} WHERE id < ? AND deleted_at IS NULL ORDER BY id DESC LIMIT ?", (before_id, limit + 1), fetch_all=True
+            )
+            return rows[:limit][::-1], len(rows) > limit
+        rows = self.execute_query(
+            f"{columns} WHERE id > ? AND deleted_at IS NULL ORDER BY id LIMIT ?",
+            (after_id if after_id is not None else 0, limit + 1),
+            fetch_all=True
+        )
+        return rows[:limit], len(rows) > limit
+
+    def get_patient_timeline(self, patient_id, before=None, limit=TIMELINE_PAGE_SIZE):
+        # История пациента одним запросом: limit сеансов от новых к старым вместе с процедурами,
+        # из рабочих таблиц и архива. before — (дата, id) последнего показанного сеанса;
+        # каждая часть берёт страницу по ключу через индекс (patient_id, session_date) и
+        # они сливаются, поэтому цена страницы не зависит от длины истории.
+        # DENSE_RANK нумерует сеансы страницы: лишний (limit + 1)-й только сообщает, что есть ещё.
+        # Строки: (id сеанса, дата, диагноз, id процедуры, процедура, параметры); сеанс
+        # без процедур — одна строка с NULL. Возвращает (строки, есть ли более старые сеансы)
+        where, params = ["patient_id = ?"], [patient_id]
+        if before is not None:
+            where.append("(session_date, id) < (?, ?)")
+            params.extend(before)
+        rows = self.execute_query(
+            f"""WITH page AS (
+                    SELECT * FROM (
+                        SELECT id, session_date, diagnosis FROM main.treatment_sessions
+                        WHERE {' AND '.join(where)}
+                        ORDER BY session_date DESC, id DESC
+                        LIMIT ?
+                    )
+                    UNION ALL
+                    SELECT * FROM (
+                        SELECT id, session_date, diagnosis FROM archive.treatment_sessions
+                        WHERE {' AND '.join(where)}
+                        ORDER BY session_date DESC, id DESC
+                        LIMIT ?
+                    )
+                    ORDER BY session_date DESC, id DESC
+                    LIMIT ?
+                ),
+                procedures AS (
+                    SELECT id, session_id, procedure_name, parameters FROM main.session_procedures
+                    WHERE session_id IN (SELECT id FROM page)
+                    UNION ALL
+                    SELECT id, session_id, procedure_name, parameters FROM archive.session_procedures
+                    WHERE session_id IN (SELECT id FROM page)
+                )
+                SELECT page.id, page.session_date, page.diagnosis, p.id, p.procedure_name, p.parameters,
+                       DENSE_RANK() OVER (ORDER BY page.session_date DESC, page.id DESC) AS session_no
+                FROM page LEFT JOIN procedures p ON p.session_id = page.id
+                ORDER BY session_no, p.id""",
+            (params + [limit + 1]) * 2 + [limit + 1],
+            fetch_all=True
+        )
+        page = [row[:6] for row in rows if row[6] <= limit]
+        return page, len(page) < len(rows)
+
+    def build_data_view_query(self, data_type, search="", filter_value=None, date_from=None, date_to=None,
+                              sort_index=None, descending=False, include_archive=False, limit=DATA_VIEW_LIMIT):
+        view = DATA_VIEWS[data_type]
+        where, params = [view["active"]], []
+        if filter_value and view["filter"]:
+            where.append(f"{view['filter'][0]} = ?")
+            params.append(filter_value)
+        # Диапазон дат сравнивается как текст ГГГГ-ММ-ДД..., поэтому работает по индексу
+        if date_from:
+            where.append(f"{view['date']} >= ?")
+            params.append(normalize_date(date_from))
+        if date_to:
+            where.append(f"{view['date']} < ?")
+            params.append((datetime.strptime(normalize_date(date_to), ISO_DATE) + timedelta(days=1)).strftime(ISO_DATE))
+        match = search_match(search)
+        if match:
+            # Слова ищутся по search_index без учёта регистра и "ё", как в search(); подзапрос
+            # отдаёт id найденных записей. Архивных сеансов и процедур в индексе нет,
+            # в истории они находятся только по ФИО пациента
+            where.append("(" + " OR ".join(
+                f"{column} IN (SELECT rowid >> 2 FROM search_index WHERE search_index MATCH ? AND rowid & 3 = {kind})"
+                for column, kind in view["search"]
+            ) + ")")
+            params.extend(match for _ in view["search"])
+        if sort_index is not None:
+            order_column = view["columns"][sort_index][1]
+        else:
+            order_column, descending = view["order"]
+        id_column = view["columns"][0][1]
+        direction = "DESC" if descending else "ASC"
+        # Архивные строки нужны только по запросу: представление *_history читает оба файла
+        query = view.get("history_query", view["query"]) if include_archive else view["query"]
+        query += " WHERE " + " AND ".join(where)
+        query += f" ORDER BY {order_column} {direction}"
+        if order_column != id_column:
+            query += f", {id_column} {direction}"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        return query, params
+
+    def iter_query(self, query, params=(), batch_size=EXPORT_BATCH_SIZE):
+        # Потоковая выборка порциями fetchmany через соединение текущего потока
+        if self.pool.in_memory:
+            with self.pool.write_lock:
+                cursor = self.conn.execute(query, params)
+                while batch := cursor.fetchmany(batch_size):
+                    yield batch
+            return
+        cursor = self.pool.reader().execute(query, params)
+        try:
+            while batch := cursor.fetchmany(batch_size):
+                yield batch
+        finally:
+            cursor.close()
+
+    def export_data_view(self, data_type, path, fmt="csv", progress=None, batch_size=EXPORT_BATCH_SIZE, **options):
+        # Выгрузка представления целиком (с учётом фильтров, без LIMIT) за постоянную память
+        query, params = self.build_data_view_query(data_type, limit=None, **options)
+        columns = [column.split(".")[-1] for _, column in DATA_VIEWS[data_type]["columns"]]
+        written = 0
+        with export_writer(path, fmt, columns) as write_batch:
+            for batch in self.iter_query(query, params, batch_size):
+                write_batch(batch)
+                written += len(batch)
+                if progress:
+                    progress(written)
+        return written
+
+    def query_data_view(self, data_type, **options):
+        query, params = self.build_data_view_query(data_type, **options)
+        return self.execute_query(query, params, fetch_all=True)
+
+    def search(self, text, limit=SEARCH_LIMIT):
+        # Сортировка по bm25. Возвращает (вид, id записи, id пациента, ФИО пациента, найденный текст).
+        # В индексе текст со свёрнутой "ё", поэтому найденный текст берётся из самой записи;
+        # записи удалённых пациентов отсеиваются до LIMIT и не занимают места в выдаче
+        match = search_match(text)
+        if not match:
+            return []
+        rows = self.execute_query(
+            """SELECT h.kind, h.ref_id, pt.id, pt.name,
+                      CASE h.kind WHEN 1 THEN pt.name WHEN 2 THEN s.diagnosis
+                           ELSE sp.procedure_name || ' ' || COALESCE(sp.parameters, '') END
+               FROM (SELECT rowid & 3 AS kind, rowid >> 2 AS ref_id, rank
+                     FROM search_index WHERE search_index MATCH ?) h
+               LEFT JOIN session_procedures sp ON h.kind = 3 AND sp.id = h.ref_id
+               LEFT JOIN treatment_sessions s ON s.id = CASE h.kind WHEN 2 THEN h.ref_id WHEN 3 THEN sp.session_id END
+               LEFT JOIN patients pt ON pt.id = CASE h.kind WHEN 1 THEN h.ref_id ELSE s.patient_id END
+               WHERE pt.deleted_at IS NULL
+               ORDER BY h.rank LIMIT ?""",
+            (match, limit),
+            fetch_all=True
+        )
+        return [(SEARCH_KINDS[kind], ref_id, patient_id, name, body) for kind, ref_id, patient_id, name, body in rows]
+
+    def save_treatment_session(self, patient_id, session_date, diagnosis, procedures):
+        # Сеанс и его процедуры (название, параметры) сохраняются атомарно одним COMMIT
+        with self.transaction():
+            session_id = self.execute_query(
+                "INSERT INTO treatment_sessions (id, patient_id, session_date, diagnosis) VALUES (?, ?, ?, ?)",
+                (self._allocate_ids("treatment_sessions")[0], patient_id, session_date, diagnosis),
+                commit=True
+            )
+            self.execute_many(
+                "INSERT INTO session_procedures (id, session_id, procedure_name, parameters) VALUES (?, ?, ?, ?)",
+                [
+                    (procedure_id, session_id, name, params)
+                    for procedure_id, (name, params) in zip(self._allocate_ids("session_procedures", len(procedures)), procedures)
+                ],
+                commit=True
+            )
+            self.index_procedure_parameters("session_id = ?", (session_id,))
+        return session_id
+
+    def index_procedure_parameters(self, condition, params=()):
+        # procedure_parameters (см. миграцию 9) заполняет приложение: разбор parse_parameters
+        # на Python. condition — условие WHERE по session_procedures, отбирающее добавленные
+        # или изменённые процедуры; их прежние параметры заменяются
+        with self.transaction():
+            procedures = self.execute_query(
+                f"SELECT id, parameters FROM session_procedures WHERE {condition}", params, fetch_all=True
+            )
+            self.execute_query(
+                "DELETE FROM procedure_parameters WHERE procedure_id IN (SELECT value FROM json_each(?))",
+                (json.dumps([procedure_id for procedure_id, _ in procedures]),),
+                commit=True
+            )
+            self.execute_many(
+                "INSERT INTO procedure_parameters (procedure_id, name, value, value_num) VALUES (?, ?, ?, ?)",
+                [(procedure_id,) + parameter for procedure_id, text in procedures for parameter in parse_parameters(text)],
+                commit=True
+            )
+
+    def get_procedure_parameters(self, procedure_id):
+        return self.execute_query(
+            "SELECT name, value, value_num FROM procedure_parameters WHERE procedure_id = ? ORDER BY name",
+            (procedure_id,),
+            fetch_all=True
+        )
+
+    def find_procedures_by_parameter(self, name, low=None, high=None, value=None, limit=DATA_VIEW_LIMIT):
+        # Процедуры, у которых числовой параметр в [low, high] или текстовый равен value.
+        # Отбор идёт по индексу procedure_parameters, текст параметров не разбирается
+        where, params = ["pp.name = ?"], [fold_name(name.strip())]
+        if value is not None:
+            where.append("pp.value = ?")
+            params.append(value)
+        if low is not None:
+            where.append("pp.value_num >= ?")
+            params.append(low)
+        if high is not None:
+            where.append("pp.value_num <= ?")
+            params.append(high)
+        return self.execute_query(
+            f"""SELECT p.id, p.session_id, s.session_date, p.procedure_name, p.parameters
+                FROM procedure_parameters pp
+                JOIN session_procedures p ON p.id = pp.procedure_id
+                JOIN treatment_sessions s ON s.id = p.session_id
+                WHERE {' AND '.join(where)}
+                ORDER BY pp.value_num, pp.procedure_id
+                LIMIT ?""",
+            params + [limit],
+            fetch_all=True
+        )
+
+    def rebuild_stats(self):
+        # STATS_REBUILD считает рабочие таблицы, вклад архива добавляется следом
+        with self.transaction():
+            for statement in STATS_REBUILD:
+                self.execute_query(statement, commit=True)
+            self._fill_archive_batch("SELECT id FROM archive.treatment_sessions")
+            self._adjust_archive_stats(1)
+
+    def get_daily_session_stats(self, days=30):
+        # Последние days дней, в которые были сеансы: (день, тип лечения, количество)
+        return self.execute_query(
+            """SELECT day, treatment_type, sessions FROM stats_daily_sessions
+               WHERE sessions > 0 AND day IN (
+                   SELECT DISTINCT day FROM stats_daily_sessions WHERE sessions > 0 ORDER BY day DESC LIMIT ?
+               )
+               ORDER BY day, treatment_type""",
+            (days,),
+            fetch_all=True
+        )
+
+    def get_procedure_stats(self):
+        return self.execute_query(
+            "SELECT procedure_name, uses FROM stats_procedures WHERE uses > 0 ORDER BY uses DESC, procedure_name",
+            fetch_all=True
+        )
+
+    def get_demographics_stats(self):
+        return self.execute_query(
+            "SELECT age_bucket, gender, patients FROM stats_demographics WHERE patients > 0 ORDER BY age_bucket, gender",
+            fetch_all=True
+        )
+
+    def ensure_indexes(self):
+        # Восстанавливает индексы из миграций, если импорт был прерван до их пересоздания
+        for statements in MIGRATIONS[:self.schema_version()]:
+            for statement in statements:
+                if statement.startswith("CREATE INDEX"):
+                    self.execute_query(statement, commit=True)
+
+    def import_records(self, kind, path, fmt=None, chunk_size=IMPORT_CHUNK_SIZE, reject_path=None,
+                       drop_indexes=True, restart=False, progress=None):
+        # Потоковый импорт: порции по chunk_size строк, executemany и один COMMIT на порцию.
+        # Позиция сохраняется в import_checkpoints той же транзакцией, поэтому повторный
+        # запуск продолжает с первой незафиксированной записи. Отклонённые строки
+        # с причиной пишутся в reject_path (JSONL).
+        spec = IMPORT_SPECS[kind]
+        source = os.path.abspath(path)
+        reject_path = reject_path or f"{path}.rejected.jsonl"
+        if restart:
+            self.execute_query("DELETE FROM import_checkpoints WHERE source = ? AND kind = ?", (source, kind), commit=True)
+        checkpoint = self.execute_query(
+            "SELECT position, imported, rejected FROM import_checkpoints WHERE source = ? AND kind = ?",
+            (source, kind),
+            fetch_one=True
+        )
+        start, imported, rejected = checkpoint or (0, 0, 0)
+        dropped = self._drop_indexes(spec["table"]) if drop_indexes else []
+        position = 0
+        try:
+            with open(reject_path, "a", encoding="utf-8") as rejects:
+                chunk = []
+                for record, error in read_records(path, fmt):
+                    position += 1
+                    if position <= start:
+                        continue
+                    chunk.append((position, record, error))
+                    if len(chunk) >= chunk_size:
+                        imported, rejected = self._import_chunk(spec, source, kind, chunk, imported, rejected, rejects)
+                        chunk = []
+                        if progress:
+                            progress(position, imported, rejected)
+                if chunk:
+                    imported, rejected = self._import_chunk(spec, source, kind, chunk, imported, rejected, rejects)
+                    if progress:
+                        progress(position, imported, rejected)
+        finally:
+            with self.transaction():
+                for statement in dropped:
+                    self.execute_query(statement, commit=True)
+        self.execute_query("DELETE FROM import_checkpoints WHERE source = ? AND kind = ?", (source, kind), commit=True)
+        if kind == "patients":
+            self.fold_patient_names()
+            self.reference_changed("patients")
+        elif kind == "procedures":
+            self.execute_query(SYNC_PROCEDURE_CATALOG, commit=True)
+            self.reference_changed("procedures")
+        return {"processed": max(position, start), "imported": imported, "rejected": rejected, "reject_file": reject_path}
+
+    def _index_imported(self, spec, last_id, rows):
+        if spec["table"] == "session_procedures":
+            self.index_procedure_parameters(
+                "id > ? OR id IN (SELECT value FROM json_each(?))",
+                (last_id, json.dumps([values[0] for values in rows if values[0] is not None]))
+            )
+
+    def _drop_indexes(self, table):
+        indexes = self.execute_query(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+            (table,),
+            fetch_all=True
+        )
+        with self.transaction():
+            for name, _ in indexes:
+                self.execute_query(f'DROP INDEX IF EXISTS "{name}"', commit=True)
+        return [sql for _, sql in indexes]
+
+    def _import_chunk(self, spec, source, kind, chunk, imported, rejected, rejects):
+        columns = ["id"] + spec["columns"]
+        rows, bad = [], []
+        for position, record, error in chunk:
+            if error is None:
+                try:
+                    rows.append((position, record, (optional_id(record.get("id")),) + spec["validate"](
+                        *(record.get(column) for column in spec["columns"])
+                    )))
+                    continue
+                except (TypeError, ValueError) as ex:
+                    error = str(ex)
+            bad.append((position, record, error))
+        if spec["parent"] and rows:
+            # Одна выборка на порцию вместо проверки каждой ссылки отдельно
+            column, parent_table = spec["parent"]
+            index = columns.index(column)
+            wanted = sorted({values[index] for _, _, values in rows})
+            existing = {row[0] for row in self.execute_query(
+                f"SELECT id FROM {parent_table} WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps(wanted),),
+                fetch_all=True
+            )}
+            checked = []
+            for position, record, values in rows:
+                if values[index] in existing:
+                    checked.append((position, record, values))
+                else:
+                    bad.append((position, record, f"Нет записи {parent_table} с id {values[index]}"))
+            rows = checked
+        insert = f"INSERT INTO {spec['table']} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        last_position = chunk[-1][0]
+        # Новые строки порции — с id из записей или выданными AUTOINCREMENT, то есть больше
+        # прежнего максимума: по ним процедурам разбираются параметры (индексы на время импорта сняты)
+        last_id = self.execute_query(f"SELECT COALESCE(MAX(id), 0) FROM {spec['table']}", fetch_one=True)[0]
+        try:
+            with self.transaction():
+                inserted = self._assign_ids(spec["table"], [values for _, _, values in rows])
+                self.execute_many(insert, inserted, commit=True)
+                self._index_imported(spec, last_id, inserted)
+                self._save_checkpoint(source, kind, last_position, imported + len(rows), rejected + len(bad))
+            imported += len(rows)
+        except sqlite3.IntegrityError:
+            # Например, повтор id: порция откачена, вставляем построчно, отбраковывая конфликтующие
+            inserted = []
+            with self.transaction():
+                for position, record, values in rows:
+                    values = self._assign_ids(spec["table"], [values])[0]
+                    try:
+                        self.execute_query(insert, values, commit=True)
+                        inserted.append(values)
+                    except sqlite3.IntegrityError as ex:
+                        bad.append((position, record, str(ex)))
+                self._index_imported(spec, last_id, inserted)
+                self._save_checkpoint(source, kind, last_position, imported + len(inserted), rejected + len(bad))
+            imported += len(inserted)
+        for position, record, error in sorted(bad, key=lambda item: item[0]):
+            rejects.write(json.dumps({"position": position, "error": error, "record": record}, ensure_ascii=False) + "\n")
+        rejects.flush()
+        return imported, rejected + len(bad)
+
+    def _save_checkpoint(self, source, kind, position, imported, rejected):
+        self.execute_query(
+            """INSERT INTO import_checkpoints (source, kind, position, imported, rejected, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT(source, kind) DO UPDATE SET position = excluded.position, imported = excluded.imported,
+                   rejected = excluded.rejected, updated_at = excluded.updated_at""",
+            (source, kind, position, imported, rejected, datetime.now().isoformat(timespec="seconds")),
+            commit=True
+        )
+
+    def table_exists(self, table_name):
+        query = "SELECT name FROM sqlite_master WHERE type='table' AND name=?"
+        result = self.execute_query(query, (table_name,), fetch_one=True)
+        return result is not None
+
+    def create_tables(self):
+        tables = [
+            """CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                password TEXT NOT NULL,
+                role TEXT NOT NULL CHECK(role IN ('admin', 'doctor', 'nurse', 'patient'))
+            )""",
+            """CREATE TABLE IF NOT EXISTS patients (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                age INTEGER,
+                gender TEXT CHECK(gender IN ('М', 'Ж')),
+                admission_date TEXT,
+                treatment_type TEXT
+            )""",
+            """CREATE TABLE IF NOT EXISTS treatment_sessions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                patient_id INTEGER NOT NULL,
+                session_date TEXT NOT NULL,
+                diagnosis TEXT NOT NULL,
+                FOREIGN KEY (patient_id) REFERENCES patients(id) ON DELETE CASCADE
+            )""",
+            """CREATE TABLE IF NOT EXISTS session_procedures (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id INTEGER NOT NULL,
+                procedure_name TEXT NOT NULL,
+                parameters TEXT,
+                FOREIGN KEY (session_id) REFERENCES treatment_sessions(id) ON DELETE CASCADE
+            )"""
+        ]
+        for table in tables:
+            self.execute_query(table, commit=True)
+        self.migrate()
+        self.fold_patient_names()
+        self.ensure_indexes()
+
+    def schema_version(self):
+        return self.execute_query("PRAGMA user_version", fetch_one=True)[0]
+
+    def migrate(self):
+        # Работает и для баз второй недели (patients с CHECK по возрасту):
+        # миграции только добавляют объекты, существующие таблицы не пересоздаются.
+        # Возвращает версию схемы после миграции
+        version = self.schema_version()
+        for target in range(version + 1, len(MIGRATIONS) + 1):
+            with self.transaction():
+                for statement in MIGRATIONS[target - 1]:
+                    self.execute_query(statement, commit=True)
+                self.execute_query(f"PRAGMA user_version = {target}", commit=True)
+            version = target
+        return version
+
+    def add_default_users(self):
+        if not self.table_exists('users'):
+            return
+        users = [
+            ('admin', 'admin123', 'admin'),
+            ('doctor', 'doctor123', 'doctor'),
+            ('nurse', 'nurse123', 'nurse'),
+            ('patient', 'patient123', 'patient')
+        ]
+        with self.transaction():
+            for username, password, role in users:
+                user_exists = self.execute_query("SELECT 1 FROM users WHERE username = ?", (username,), fetch_one=True)
+                if not user_exists:
+                    hashed_password = self.password_hasher.encode(password)
+                    self.execute_query(
+                        "INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
+                        (username, hashed_password, role),
+                        commit=True
+                    )
+
+    def add_sample_data(self):
+        if not self.table_exists('patients'):
+            return
+        with self.transaction():
+            self._add_sample_rows()
+            self.reference_changed("patients")
+
+    def _add_sample_rows(self):
+        if self.execute_query("SELECT COUNT(*) FROM patients", fetch_one=True)[0] == 0:
+            patients = [
+                ("Иванов Иван", 45, "М", "2023-01-10", "Терапия"),
+                ("Петрова Анна", 32, "Ж", "2023-01-15", "Хирургия"),
+                ("Сидоров Владимир", 28, "М", "2023-02-05", "Диагностика")
+            ]
+            self.execute_many(
+                "INSERT INTO patients (name, age, gender, admission_date, treatment_type) VALUES (?, ?, ?, ?, ?)",
+                patients, commit=True
+            )
+            self.fold_patient_names()
+
+        patient_ids = [row[0] for row in self.execute_query("SELECT id FROM patients ORDER BY id", fetch_all=True)]
+        if self.execute_query("SELECT COUNT(*) FROM treatment_sessions", fetch_one=True)[0] == 0 and patient_ids:
+            sessions = [
+                (patient_ids[0], "2023-01-12 10:00", "Гипертония"),
+                (patient_ids[1], "2023-01-16 11:00", "Аппендицит"),
+                (patient_ids[2], "2023-02-06 09:30", "Обследование")
+            ]
+            self.execute_many(
+                "INSERT INTO treatment_sessions (patient_id, session_date, diagnosis) VALUES (?, ?, ?)",
+                sessions, commit=True
+            )
+
+        session_ids = [row[0] for row in self.execute_query("SELECT id FROM treatment_sessions ORDER BY id", fetch_all=True)]
+        if self.execute_query("SELECT COUNT(*) FROM session_procedures", fetch_one=True)[0] == 0 and session_ids:
+            procedures = [
+                (session_ids[0], "УЗИ брюшной полости", "Область: печень"),
+                (session_ids[0], "Электрокардиография", "Давление: 120/80"),
+                (session_ids[1], "МРТ", "Область: брюшная полость"),
+                (session_ids[2], "Физиотерапия", "Курс: 10 сеансов")
+            ]
+            self.execute_many(
+                "INSERT INTO session_procedures (session_id, procedure_name, parameters) VALUES (?, ?, ?)",
+                procedures, commit=True
+            )
+            self.index_procedure_parameters("true")
+
+class KeysetPager:
+    # Окно строк поверх get_patients_page: страницы вперёд/назад и догрузка при прокрутке.
+    # В окне держится не больше max_rows строк, лишние отбрасываются с начала.
+    def __init__(self, fetch_page, page_size=50, max_rows=200):
+        self.fetch_page = fetch_page
+        self.page_size = page_size
+        self.max_rows = max_rows
+        self.rows = []
+        self.has_prev = False
+        self.has_next = False
+
+    def first(self):
+        self.rows, self.has_next = self.fetch_page(limit=self.page_size)
+        self.has_prev = False
+        return self.rows
+
+    def next(self):
+        if not self.rows:
+            return self.first()
+        rows, has_next = self.fetch_page(after_id=self.rows[-1][0], limit=self.page_size)
+        if rows:
+            self.rows, self.has_next, self.has_prev = rows, has_next, True
+        else:
+            self.has_next = False
+        return self.rows
+
+    def prev(self):
+        if not self.rows:
+            return self.first()
+        rows, has_prev = self.fetch_page(before_id=self.rows[0][0], limit=self.page_size)
+        if rows:
+            self.rows, self.has_prev, self.has_next = rows, has_prev, True
+        else:
+            self.has_prev = False
+        return self.rows
+
+    def more(self):
+        # Догрузка следующей страницы в конец окна; возвращает (новые строки, сколько отброшено сверху)
+        if not self.rows:
+            return self.first(), 0
+        rows, self.has_next = self.fetch_page(after_id=self.rows[-1][0], limit=self.page_size)
+        self.rows = self.rows + rows
+        dropped = max(0, len(self.rows) - self.max_rows)
+        if dropped:
+            self.rows = self.rows[dropped:]
+            self.has_prev = True
+        return rows, dropped
+
+    def insert(self, row):
+        # id растут, поэтому новая строка видна, только если окно упирается в конец таблицы
+        if self.has_next or (self.rows and row[0] < self.rows[-1][0]):
+            return False
+        self.rows.append(row)
+        return True
+
+    def remove(self, row_id):
+        for i, row in enumerate(self.rows):
+            if row[0] == row_id:
+                del self.rows[i]
+                return True
+        return False
+
+    def reload(self):
+        # Перечитать текущее окно (после добавления/удаления), не сбрасывая позицию
+        if not self.rows:
+            return self.first()
+        rows, self.has_next = self.fetch_page(
+            after_id=self.rows[0][0] - 1, limit=max(len(self.rows), self.page_size)
+        )
+        if not rows:
+            return self.prev() if self.has_prev else self.first()
+        self.rows = rows
+        return self.rows
+
+# Строки, которые отдаёт ClinicService: NamedTuple без __dict__ (память как у tuple),
+# с доступом по именам полей; распаковка и индексы работают как раньше
+class Patient(NamedTuple):
+    id: int
+    name: str
+    age: int
+    gender: str
+    admission_date: str
+    treatment_type: str
+
+class PatientRef(NamedTuple):
+    id: int
+    name: str
+
+class User(NamedTuple):
+    id: int
+    role: str
+
+class SessionRow(NamedTuple):
+    id: int
+    patient_id: int
+    patient_name: Optional[str]
+    session_date: str
+    diagnosis: str
+
+class ProcedureRow(NamedTuple):
+    id: int
+    session_id: int
+    session_date: Optional[str]
+    procedure_name: str
+    parameters: str
+
+class TimelineProcedure(NamedTuple):
+    id: int
+    procedure_name: str
+    parameters: str
+
+class TimelineSession(NamedTuple):
+    id: int
+    session_date: str
+    diagnosis: str
+    procedures: tuple
+
+class ProcedureParameter(NamedTuple):
+    name: str
+    value: str
+    number: Optional[float]
+
+class SearchHit(NamedTuple):
+    kind: str
+    ref_id: int
+    patient_id: Optional[int]
+    patient_name: Optional[str]
+    text: str
+
+class DailySessions(NamedTuple):
+    day: str
+    treatment_type: str
+    sessions: int
+
+class ProcedureUsage(NamedTuple):
+    procedure_name: str
+    uses: int
+
+class DemographicGroup(NamedTuple):
+    age_bucket: int
+    gender: str
+    patients: int
+
+DATA_VIEW_ROWS = {"Пациенты": Patient, "Сеансы": SessionRow, "Процедуры": ProcedureRow}
+AGE_HISTOGRAM_BINS = 10  # 0-9, 10-19, ..., 90+
+
+class FilePeer:
+    # Узел-партнёр в другом файле SQLite на этой машине: локальная замена второго рабочего
+    # места (проверка синхронизации, перенос базы на флешке). site задаёт его номер узла
+    def __init__(self, path, site=None):
+        self.db = DatabaseManager(path, profile="production")
+        self.db.connect()
+        try:
+            self.db.create_tables()
+            if site is not None:
+                self.db.set_site(site)
+        except Exception:
+            self.db.close()
+            raise
+
+    def call(self, request):
+        return self.db.handle_sync_request(request)
+
+    def close(self):
+        self.db.close()
+
+class SyncAuthError(ValueError):
+    pass
+
+def sync_secret(secret=None):
+    # Общий секрет рабочих мест: явно переданный или из переменной окружения SYNC_SECRET_ENV
+    secret = secret if secret is not None else os.environ.get(SYNC_SECRET_ENV, "")
+    if len(secret) < SYNC_MIN_SECRET:
+        raise ValueError(
+            f"Нужен общий секрет синхронизации не короче {SYNC_MIN_SECRET} символов "
+            f"(--secret-file или переменная {SYNC_SECRET_ENV})"
+        )
+    return secret.encode("utf-8")
+
+def seal_sync_message(secret, message):
+    # Строка для сокета: {"body": JSON сообщения с меткой времени, "mac": HMAC-SHA256 от body}
+    body = json.dumps(dict(message, ts=time.time()), ensure_ascii=False)
+    mac = hmac.new(secret, body.encode("utf-8"), hashlib.sha256).hexdigest()
+    return json.dumps({"body": body, "mac": mac}, ensure_ascii=False).encode("utf-8") + b"\n"
+
+def open_sync_message(secret, line):
+    # Обратное к seal_sync_message. Неверная подпись или старая метка — SyncAuthError
+    try:
+        envelope = json.loads(line)
+    except ValueError:
+        raise SyncAuthError("Сообщение синхронизации не подписано") from None
+    if not isinstance(envelope, dict) or not isinstance(envelope.get("body"), str) or not isinstance(envelope.get("mac"), str):
+        raise SyncAuthError("Сообщение синхронизации не подписано")
+    expected = hmac.new(secret, envelope["body"].encode("utf-8"), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, envelope["mac"]):
+        raise SyncAuthError("Неверная подпись сообщения синхронизации: секреты узлов не совпадают")
+    message = json.loads(envelope["body"])
+    if not isinstance(message, dict):
+        raise ValueError("Сообщение синхронизации должно быть объектом JSON")
+    if not isinstance(message.get("ts"), (int, float)) or abs(time.time() - message.pop("ts")) > SYNC_MAX_SKEW:
+        raise SyncAuthError("Сообщение синхронизации устарело: проверьте часы рабочих мест")
+    return message
+
+class SocketPeer:
+    # Узел-партнёр за SyncServer: запрос и ответ — по подписанной строке JSON
+    def __init__(self, host, port=SYNC_PORT, secret=None, timeout=SYNC_TIMEOUT):
+        self.secret = sync_secret(secret)
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.stream = self.sock.makefile("rwb")
+
+    def call(self, request):
+        self.stream.write(seal_sync_message(self.secret, request))
+        self.stream.flush()
+        line = self.stream.readline(SYNC_MAX_MESSAGE + 1)
+        if not line:
+            raise ConnectionError("Узел синхронизации закрыл соединение")
+        response = json.loads(line)
+        if "error" not in response:
+            response = open_sync_message(self.secret, line)
+        if "error" in response:
+            raise ValueError(f"Ошибка на узле синхронизации: {response['error']['message']}")
+        return response
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+def open_sync_peer(address, site=None, secret=None):
+    # "хост:порт" — SyncServer (нужен общий секрет), иначе путь к файлу базы
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and not os.path.exists(address):
+        return SocketPeer(host or "127.0.0.1", int(port), secret)
+    return FilePeer(address, site)
+
+class SyncRequestHandler(socketserver.StreamRequestHandler):
+    # Ошибки возвращаются узлу как {"error": {"code", "message"}}. На сообщение без верной
+    # подписи отвечает неподписанная ошибка unauthorized, и соединение закрывается
+    def handle(self):
+        try:
+            while line := self.rfile.readline(SYNC_MAX_MESSAGE + 1):
+                if len(line) > SYNC_MAX_MESSAGE:
+                    self.reply_error("too_large", "Сообщение синхронизации слишком большое")
+                    return
+                try:
+                    response = self.server.db.handle_sync_request(open_sync_message(self.server.secret, line))
+                except SyncAuthError as ex:
+                    self.reply_error("unauthorized", str(ex))
+                    return
+                except ValueError as ex:
+                    response = {"error": {"code": "bad_request", "message": str(ex)}}
+                except sqlite3.Error as ex:
+                    response = {"error": {"code": "database", "message": str(ex)}}
+                except Exception as ex:
+                    logger.exception("Sync request failed")
+                    response = {"error": {"code": "internal", "message": "Внутренняя ошибка узла синхронизации"}}
+                self.wfile.write(seal_sync_message(self.server.secret, response))
+        finally:
+            self.server.db.pool.release_reader()  # поток соединения завершается вместе с ним
+
+    def reply_error(self, code, message):
+        self.wfile.write(json.dumps({"error": {"code": code, "message": message}}, ensure_ascii=False).encode("utf-8") + b"\n")
+
+class SyncServer(socketserver.ThreadingTCPServer):
+    # Узел синхронизации по TCP для других рабочих мест (sync_with через SocketPeer).
+    # Принимает только запросы, подписанные общим секретом. Данные идут без шифрования:
+    # за пределами localhost — только в сети клиники или через VPN/SSH-туннель
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, db, address=("127.0.0.1", SYNC_PORT), secret=None):
+        self.db = db
+        self.secret = sync_secret(secret)
+        super().__init__(address, SyncRequestHandler)
+
+class ClinicService:
+    # Операции клиники без интерфейса: пациенты, сеансы, процедуры, просмотр и статистика.
+    # Обе версии интерфейса, импорт и benchmark.py вызывают одни и те же методы,
+    # поэтому горячие пути можно гонять в пакетных задачах и нагрузочных тестах без GUI.
+    # Проверка ввода здесь же: ошибки приходят как ValueError с текстом для пользователя
+    def __init__(self, db):
+        self.db = db
+
+    @classmethod
+    def open(cls, db_name="medical.db", profile="default", sample_data=True, archive_name=None):
+        db = DatabaseManager(db_name, profile=profile, archive_name=archive_name)
+        db.connect()
+        db.create_tables()
+        db.add_default_users()
+        if sample_data:
+            db.add_sample_data()
+        return cls(db)
+
+    def close(self):
+        self.db.close()
+
+    # Пользователи и сеансы интерфейса
+    def login(self, username, password):
+        # Токен сеанса или None при неверном логине/пароле
+        user = self.db.authenticate(username, password)
+        return self.db.sessions.issue(User._make(user)) if user else None
+
+    def current_user(self, token):
+        return self.db.sessions.resolve(token) if token else None
+
+    def require_user(self, token, roles=None):
+        # Проверка перед действием интерфейса: истёкший или отозванный токен —
+        # SessionExpiredError (нужен повторный вход), чужая роль — PermissionError
+        user = self.current_user(token)
+        if user is None:
+            raise SessionExpiredError("Сеанс истёк или завершён, войдите заново")
+        if roles is not None and user.role not in roles:
+            raise PermissionError("Недостаточно прав для этого действия")
+        return user
+
+    def logout(self, token):
+        self.db.sessions.revoke(token)
+
+    # Пациенты
+    def patients_page(self, after_id=None, before_id=None, limit=50):
+        rows, has_more = self.db.get_patients_page(after_id=after_id, before_id=before_id, limit=limit)
+        return [Patient._make(row) for row in rows], has_more
+
+    def iter_patients(self, batch_size=500):
+        # Все пациенты по возрастанию id, страницами по ключу (для пакетных задач и полных списков)
+        after_id = None
+        while True:
+            rows, has_more = self.patients_page(after_id=after_id, limit=batch_size)
+            yield from rows
+            if not has_more:
+                return
+            after_id = rows[-1].id
+
+    def add_patient(self, name, age, gender, admission_date, treatment_type):
+        patient = validate_patient(name, age, gender, admission_date, treatment_type)
+        return Patient(self.db.add_patient(*patient), *patient)
+
+    def delete_patient(self, patient_id):
+        # Мягкое удаление: история остаётся, restore_patient возвращает пациента в списки
+        self.db.delete_patient(patient_id)
+
+    def restore_patient(self, patient_id):
+        self.db.restore_patient(patient_id)
+
+    def purge_patient(self, patient_id):
+        # Окончательно, вместе с сеансами в рабочих таблицах и в архиве
+        self.db.purge_patient(patient_id)
+
+    def discharge_patient(self, patient_id, discharge_date=None):
+        # Выписка (по умолчанию сегодня); сеансы выписанных со временем уходят в архив
+        discharge_date = normalize_date(discharge_date) if discharge_date else date.today().strftime(ISO_DATE)
+        self.db.discharge_patient(patient_id, discharge_date)
+        return discharge_date
+
+    def archive(self, horizon_days=ARCHIVE_HORIZON_DAYS, today=None):
+        if horizon_days < 0:
+            raise ValueError("Горизонт архивации не может быть отрицательным")
+        return self.db.archive_sessions(horizon_days, today)
+
+    def find_patients(self, text):
+        return [PatientRef._make(row) for row in self.db.search_patients(text)]
+
+    def reference(self, name):
+        # Справочник для выпадающего списка (treatment_types, procedures) из кеша
+        return self.db.references.get(name)
+
+    def reference_version(self, name):
+        # Растёт при каждом изменении справочника: по ней интерфейс решает, пересобирать ли список
+        return self.db.references.version(name)
+
+    def treatment_types(self):
+        return self.reference("treatment_types")
+
+    def procedure_catalog(self):
+        return self.reference("procedures")
+
+    # Сеансы и процедуры
+    def save_session(self, patient_id, session_date, diagnosis, procedures):
+        # procedures — пары (название, параметры); параметры — текст "Ключ: значение; ..."
+        # или пары/dict ключ -> значение из формы. Возвращает id сеанса
+        patient_id, session_date, diagnosis = validate_session(patient_id, session_date, diagnosis)
+        procedures = [(name, format_parameters(parameters)) for name, parameters in procedures]
+        if not procedures:
+            raise ValueError("Добавьте хотя бы одну процедуру")
+        return self.db.save_treatment_session(patient_id, session_date, diagnosis, procedures)
+
+    def patient_timeline(self, patient_id, before=None, limit=TIMELINE_PAGE_SIZE):
+        # Страница истории: (сеансы от новых к старым с процедурами, курсор следующей
+        # страницы или None). Курсор передаётся обратно как before
+        rows, has_more = self.db.get_patient_timeline(patient_id, before, limit)
+        sessions = []
+        for session_id, session_date, diagnosis, procedure_id, procedure_name, parameters in rows:
+            if not sessions or sessions[-1].id != session_id:
+                sessions.append(TimelineSession(session_id, session_date, diagnosis, []))
+            if procedure_id is not None:
+                sessions[-1].procedures.append(TimelineProcedure(procedure_id, procedure_name, parameters))
+        sessions = [session._replace(procedures=tuple(session.procedures)) for session in sessions]
+        cursor = (sessions[-1].session_date, sessions[-1].id) if has_more else None
+        return sessions, cursor
+
+    def procedure_parameters(self, procedure_id):
+        return [ProcedureParameter._make(row) for row in self.db.get_procedure_parameters(procedure_id)]
+
+    def procedures_by_parameter(self, name, low=None, high=None, value=None, limit=DATA_VIEW_LIMIT):
+        # Например, procedures_by_parameter("Давление", low=140) — систолическое от 140,
+        # procedures_by_parameter("Курс", high=5) — курсы до 5 сеансов
+        rows = self.db.find_procedures_by_parameter(name, low, high, value, limit)
+        return [ProcedureRow._make(row) for row in rows]
+
+    # Просмотр и поиск
+    def data_view(self, data_type, **options):
+        row_type = DATA_VIEW_ROWS[data_type]
+        return [row_type._make(row) for row in self.db.query_data_view(data_type, **options)]
+
+    # Диапазоны дат, границы включительно: sessions_in_period("week") — сеансы этой недели,
+    # admissions_in_period("month") — поступления этого месяца
+    def sessions_between(self, date_from, date_to, **options):
+        return self.data_view("Сеансы", date_from=date_from, date_to=date_to, **options)
+
+    def admissions_between(self, date_from, date_to, **options):
+        return self.data_view("Пациенты", date_from=date_from, date_to=date_to, **options)
+
+    def sessions_in_period(self, period="week", day=None, **options):
+        return self.sessions_between(*period_bounds(period, day), **options)
+
+    def admissions_in_period(self, period="month", day=None, **options):
+        return self.admissions_between(*period_bounds(period, day), **options)
+
+    def export_data_view(self, data_type, path, fmt="csv", progress=None, **options):
+        return self.db.export_data_view(data_type, path, fmt, progress=progress, **options)
+
+    def search(self, text, limit=SEARCH_LIMIT):
+        return [SearchHit._make(row) for row in self.db.search(text, limit)]
+
+    # Статистика (из сводных таблиц stats_*, без пересчёта по сырым данным)
+    def daily_sessions(self, days=30):
+        return [DailySessions._make(row) for row in self.db.get_daily_session_stats(days)]
+
+    def procedure_usage(self):
+        return [ProcedureUsage._make(row) for row in self.db.get_procedure_stats()]
+
+    def demographics(self):
+        return [DemographicGroup._make(row) for row in self.db.get_demographics_stats()]
+
+    def age_histogram(self):
+        # Пациенты (без удалённых) по десятилетиям возраста; последний столбец — все от 90 лет
+        counts = [0] * AGE_HISTOGRAM_BINS
+        for group in self.demographics():
+            if group.age_bucket >= 0:
+                counts[min(group.age_bucket, AGE_HISTOGRAM_BINS - 1)] += group.patients
+        return counts
+
+    # Синхронизация рабочих мест: номер узла задаётся один раз, затем sync с партнёром
+    # по пути к файлу базы или "хост:порт" SyncServer
+    def set_site(self, site):
+        self.db.set_site(site)
+
+    def sync(self, address, peer_site=None, batch_size=SYNC_BATCH_SIZE, progress=None, secret=None):
+        peer = open_sync_peer(address, peer_site, secret)
+        try:
+            return self.db.sync_with(peer, batch_size, progress)
+        finally:
+            peer.close()
@@ -1,145 +1,127 @@
 import flet as ft
+import argparse
+import asyncio
+import os
 import sqlite3
-import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-class DatabaseManager:
-    def __init__(self, db_name='medical.db'):
-        self.db_name = db_name
-        self.conn = None
-        self.cursor = None
-
-    def connect(self):
-        self.conn = sqlite3.connect(self.db_name)
-        self.cursor = self.conn.cursor()
-
-    def close(self):
-        if self.conn:
-            self.conn.close()
-
-    def execute_query(self, query, params=(), fetch_one=False, fetch_all=False, commit=False):
-        self.cursor.execute(query, params)
-        if commit:
-            self.conn.commit()
-            return self.cursor.lastrowid if "INSERT" in query.upper() else None
-        if fetch_one:
-            return self.cursor.fetchone()
-        if fetch_all:
-            return self.cursor.fetchall()
-        return None
+from clinic import (
+    ARCHIVE_HORIZON_DAYS, DATA_VIEW_LIMIT, DATA_VIEWS, EXPORT_FORMATS, IMPORT_CHUNK_SIZE, IMPORT_SPECS, SLOW_QUERY_MS,
+    SYNC_BATCH_SIZE, SYNC_PORT, SYNC_SECRET_ENV, TAB_ROLES, ClinicService, DatabaseManager, KeysetPager,
+    SessionExpiredError, SyncServer, format_parameters, period_bounds, split_parameters
+)
 
-    def table_exists(self, table_name):
-        query = "SELECT name FROM sqlite_master WHERE type='table' AND name=?"
-        result = self.execute_query(query, (table_name,), fetch_one=True)
-        return result is not None
-
-    def create_tables(self):
-        tables = [
-            """CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                role TEXT NOT NULL CHECK(role IN ('admin', 'doctor', 'nurse', 'patient'))
-            )""",
-            """CREATE TABLE IF NOT EXISTS patients (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                age INTEGER,
-                gender TEXT CHECK(gender IN ('М', 'Ж')),
-                admission_date TEXT,
-                treatment_type TEXT
-            )""",
-            """CREATE TABLE IF NOT EXISTS treatment_sessions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                patient_id INTEGER NOT NULL,
-                session_date TEXT NOT NULL,
-                diagnosis TEXT NOT NULL,
-                FOREIGN KEY (patient_id) REFERENCES patients(id) ON DELETE CASCADE
-            )""",
-            """CREATE TABLE IF NOT EXISTS session_procedures (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id INTEGER NOT NULL,
-                procedure_name TEXT NOT NULL,
-                parameters TEXT,
-                FOREIGN KEY (session_id) REFERENCES treatment_sessions(id) ON DELETE CASCADE
-            )"""
-        ]
-        for table in tables:
-            self.execute_query(table, commit=True)
+PATIENT_LOOKUP_DEBOUNCE = 0.25  # секунд тишины после последнего нажатия
 
-    def add_default_users(self):
-        if not self.table_exists('users'):
-            return
-        users = [
-            ('admin', 'admin123', 'admin'),
-            ('doctor', 'doctor123', 'doctor'),
-            ('nurse', 'nurse123', 'nurse'),
-            ('patient', 'patient123', 'patient')
-        ]
-        for username, password, role in users:
-            user_exists = self.execute_query("SELECT 1 FROM users WHERE username = ?", (username,), fetch_one=True)
-            if not user_exists:
-                hashed_password = hashlib.sha256(password.encode()).hexdigest()
-                self.execute_query(
-                    "INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
-                    (username, hashed_password, role),
-                    commit=True
-                )
+# Быстрый выбор диапазона дат на вкладке "Просмотр данных" (см. period_bounds)
+VIEW_PERIODS = {"Сегодня": "day", "Эта неделя": "week", "Этот месяц": "month"}
 
-    def add_sample_data(self):
-        if not self.table_exists('patients'):
-            return
-        if self.execute_query("SELECT COUNT(*) FROM patients", fetch_one=True)[0] == 0:
-            patients = [
-                ("Иванов Иван", 45, "М", "2023-01-10", "Терапия"),
-                ("Петрова Анна", 32, "Ж", "2023-01-15", "Хирургия"),
-                ("Сидоров Владимир", 28, "М", "2023-02-05", "Диагностика")
-            ]
-            for p in patients:
-                self.execute_query(
-                    "INSERT INTO patients (name, age, gender, admission_date, treatment_type) VALUES (?, ?, ?, ?, ?)",
-                    p, commit=True
-                )
+# Адреса, на которых sync-server можно запускать без --allow-remote
+LOCAL_HOSTS = ("127.0.0.1", "::1", "localhost")
 
-        patient_ids = [row[0] for row in self.execute_query("SELECT id FROM patients ORDER BY id", fetch_all=True)]
-        if self.execute_query("SELECT COUNT(*) FROM treatment_sessions", fetch_one=True)[0] == 0 and patient_ids:
-            sessions = [
-                (patient_ids[0], "2023-01-12 10:00", "Гипертония"),
-                (patient_ids[1], "2023-01-16 11:00", "Аппендицит"),
-                (patient_ids[2], "2023-02-06 09:30", "Обследование")
-            ]
-            for s in sessions:
-                self.execute_query(
-                    "INSERT INTO treatment_sessions (patient_id, session_date, diagnosis) VALUES (?, ?, ?)",
-                    s, commit=True
-                )
+# Путь JSON-файла: профилирование с запуска приложения и дамп при закрытии окна
+QUERY_PROFILE_ENV = "MEDICAL_QUERY_PROFILE"
 
-        session_ids = [row[0] for row in self.execute_query("SELECT id FROM treatment_sessions ORDER BY id", fetch_all=True)]
-        if self.execute_query("SELECT COUNT(*) FROM session_procedures", fetch_one=True)[0] == 0 and session_ids:
-            procedures = [
-                (session_ids[0], "УЗИ брюшной полости", "Область: печень"),
-                (session_ids[0], "Электрокардиография", "Давление: 120/80"),
-                (session_ids[1], "МРТ", "Область: брюшная полость"),
-                (session_ids[2], "Физиотерапия", "Курс: 10 сеансов")
-            ]
-            for proc in procedures:
-                self.execute_query(
-                    "INSERT INTO session_procedures (session_id, procedure_name, parameters) VALUES (?, ?, ?)",
-                    proc, commit=True
-                )
+class StaleQueryError(Exception):
+    pass
+
+class AsyncQueryRunner:
+    # Запросы выполняются в пуле потоков, обработчики интерфейса ждут их через await.
+    # Новый запрос с тем же ключом вытесняет предыдущий: его SQL прерывается через
+    # Connection.interrupt(), а ожидающий обработчик получает StaleQueryError
+    def __init__(self, db_manager, max_workers=4):
+        self.db_manager = db_manager
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+        self.lock = threading.Lock()
+        self.generations = {}
+        self.running = {}  # ключ -> (поколение, соединение потока, выполняющего запрос)
+
+    async def run(self, func, *args, key=None, **kwargs):
+        generation = None
+        if key is not None:
+            with self.lock:
+                generation = self.generations[key] = self.generations.get(key, 0) + 1
+                previous = self.running.pop(key, None)
+                if previous is not None and previous[1] is not None:
+                    previous[1].interrupt()
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(self.executor, self._call, key, generation, func, args, kwargs)
+        except sqlite3.OperationalError:
+            if self.is_stale(key, generation):
+                raise StaleQueryError(key) from None
+            raise
+        if self.is_stale(key, generation):
+            raise StaleQueryError(key)
+        return result
+
+    def is_stale(self, key, generation):
+        with self.lock:
+            return key is not None and self.generations.get(key) != generation
+
+    def _call(self, key, generation, func, args, kwargs):
+        if key is not None:
+            with self.lock:
+                if self.generations.get(key) != generation:
+                    raise StaleQueryError(key)  # вытеснен, не успев начаться
+                pool = self.db_manager.pool
+                self.running[key] = (generation, None if pool.in_memory else pool.reader())
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if key is not None:
+                with self.lock:
+                    if self.running.get(key, (None,))[0] == generation:
+                        del self.running[key]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
 
 def main(page: ft.Page):
     page.title = "Медицинская информационная система"
     page.vertical_alignment = ft.MainAxisAlignment.CENTER
     page.horizontal_alignment = ft.CrossAxisAlignment.CENTER
 
-    db_manager = DatabaseManager()
-    db_manager.connect()
-    db_manager.create_tables()
-    db_manager.add_default_users()
-    db_manager.add_sample_data()
+    # Вся работа с данными идёт через ClinicService; db_manager нужен для профилирования и пула запросов
+    service = ClinicService.open(profile="production")
+    db_manager = service.db
+    query_profile_path = os.environ.get(QUERY_PROFILE_ENV)
+    if query_profile_path:
+        db_manager.enable_profiling()
+
+    # Роль и id пользователя берутся по токену сеанса
+    app_state = {"token": None}
+
+    def current_user():
+        return service.current_user(app_state["token"])
+
+    def authorize(roles):
+        # Токен проверяется при каждом действии и открытии вкладки: истёкший или
+        # отозванный сеанс возвращает на экран входа. Возвращает пользователя или None
+        try:
+            return service.require_user(app_state["token"], roles)
+        except SessionExpiredError as ex:
+            show_login(str(ex))
+        except PermissionError as ex:
+            error_text.value = str(ex)
+            page.update()
+        return None
 
-    app_state = {"user_role": None, "user_id": None}
+    def show_login(message=""):
+        app_state["token"] = None
+        opened_tabs.clear()
+        error_text.value = message
+        page.controls = [login_view]
+        page.update()
+
+    def logout():
+        service.logout(app_state["token"])
+        show_login()
+        print("Logged out")
+    # Запросы обработчиков идут в пул потоков, цикл событий flet не блокируется
+    query_runner = AsyncQueryRunner(db_manager)
 
     # Вкладка "Пациенты"
     selected_patient_id = None  # Переменная для хранения ID выбранного пациента
@@ -155,35 +137,94 @@ def main(page: ft.Page):
         ],
         rows=[],
     )
-    patients_table_container = ft.Column([patients_table], scroll=ft.ScrollMode.AUTO, expand=True)
+    # В таблице живут только строки текущего окна пейджера, а не вся таблица patients
+    patients_pager = KeysetPager(service.patients_page, page_size=50, max_rows=200)
+    patients_page_label = ft.Text("")
+    # Страницы читаются в пуле потоков по одной: окно пейджера и строки таблицы меняются вместе
+    patients_pager_lock = asyncio.Lock()
+    patients_prev_button = ft.IconButton(
+        icon=ft.Icons.CHEVRON_LEFT, tooltip="Назад", on_click=lambda e: page.run_task(show_patients_page, patients_pager.prev)
+    )
+    patients_next_button = ft.IconButton(
+        icon=ft.Icons.CHEVRON_RIGHT, tooltip="Вперёд", on_click=lambda e: page.run_task(show_patients_page, patients_pager.next)
+    )
 
-    def update_patients_list():
-        nonlocal selected_patient_id
-        # Не сбрасываем selected_patient_id, чтобы сохранить выбор
-        patients_data = db_manager.execute_query(
-            "SELECT id, name, age, gender, admission_date, treatment_type FROM patients ORDER BY id",
-            fetch_all=True
+    async def handle_patients_scroll(e):
+        # Бесконечная прокрутка: у нижнего края догружаем следующую страницу.
+        # Пока страница читается, новые события прокрутки пропускаются
+        if not authorize(TAB_ROLES["Пациенты"]):
+            return
+        if patients_pager_lock.locked():
+            return
+        if patients_pager.has_next and e.max_scroll_extent and e.pixels >= e.max_scroll_extent - 100:
+            async with patients_pager_lock:
+                rows, dropped = await query_runner.run(patients_pager.more)
+                for data_row in patients_table.rows[:dropped]:
+                    patient_rows.pop(data_row.data, None)
+                del patients_table.rows[:dropped]
+                patients_table.rows.extend(make_patient_row(row) for row in rows)
+                update_patients_pager_controls()
+            page.update()
+
+    patients_table_container = ft.Column(
+        [patients_table], scroll=ft.ScrollMode.AUTO, expand=True,
+        on_scroll=lambda e: page.run_task(handle_patients_scroll, e), on_scroll_interval=100
+    )
+
+    # Кэш строк окна: id пациента -> DataRow. Выбор, добавление и удаление
+    # правят только затронутые строки, а не перестраивают таблицу
+    patient_rows = {}
+
+    def make_patient_row(row):
+        data_row = ft.DataRow(
+            cells=[
+                ft.DataCell(ft.Text(str(cell), color=ft.colors.BLUE if selected_patient_id == row.id else None))
+                for cell in row
+            ],
+            data=row.id,
+            on_select_changed=lambda e, row_id=row.id: handle_row_selection(row_id),
         )
-        if patients_data is None:
-            patients_data = []
-        patients_table.rows = [
-            ft.DataRow(
-                cells=[
-                    ft.DataCell(ft.Text(str(cell), color=ft.colors.BLUE if selected_patient_id == row[0] else None))
-                    for cell in row
-                ],
-                data=row[0],
-                on_select_changed=lambda e, row_id=row[0]: handle_row_selection(row_id),
-            ) for row in patients_data
-        ]
+        patient_rows[row.id] = data_row
+        return data_row
+
+    def highlight_patient_row(row_id, selected):
+        data_row = patient_rows.get(row_id)
+        if data_row is None:
+            return None
+        for cell in data_row.cells:
+            cell.content.color = ft.colors.BLUE if selected else None
+        return data_row
+
+    def update_patients_pager_controls():
+        rows = patients_pager.rows
+        patients_page_label.value = f"ID {rows[0][0]}–{rows[-1][0]}" if rows else "Нет пациентов"
+        patients_prev_button.disabled = not patients_pager.has_prev
+        patients_next_button.disabled = not patients_pager.has_next
+
+    async def show_patients_page(load_page):
+        # load_page — метод KeysetPager (first/next/prev/reload)
+        if not authorize(TAB_ROLES["Пациенты"]):
+            return
+        async with patients_pager_lock:
+            await query_runner.run(load_page)
+            patient_rows.clear()
+            patients_table.rows = [make_patient_row(row) for row in patients_pager.rows]
+            update_patients_pager_controls()
         page.update()
+
+    async def update_patients_list():
+        # Не сбрасываем selected_patient_id, чтобы сохранить выбор
+        await show_patients_page(patients_pager.reload)
         print("Patients list updated")
 
     def handle_row_selection(row_id):
         nonlocal selected_patient_id
-        selected_patient_id = row_id
+        previous_id, selected_patient_id = selected_patient_id, row_id
         print(f"Row selected: {selected_patient_id}")
-        update_patients_list()  # Обновляем таблицу для отображения выделения
+        # Перекрашиваем только две строки и отправляем диф лишь по ним
+        for data_row in (highlight_patient_row(previous_id, False), highlight_patient_row(row_id, True)):
+            if data_row is not None:
+                data_row.update()
 
     # Панель для добавления пациента
     add_patient_name = ft.TextField(label="ФИО", width=300)
@@ -192,7 +233,7 @@ def main(page: ft.Page):
     add_patient_admission_date = ft.TextField(label="Дата поступления", width=300, value=datetime.now().strftime("%Y-%m-%d"))
     add_patient_treatment_type = ft.Dropdown(
         label="Тип лечения", width=300,
-        options=[ft.dropdown.Option("Терапия"), ft.dropdown.Option("Хирургия"), ft.dropdown.Option("Диагностика")]
+        options=[ft.dropdown.Option(name) for name in service.treatment_types()]
     )
     add_patient_panel = ft.Column(
         [
@@ -203,7 +244,7 @@ def main(page: ft.Page):
             add_patient_admission_date,
             add_patient_treatment_type,
             ft.Row([
-                ft.ElevatedButton("Сохранить", on_click=lambda e: add_patient_action()),
+                ft.ElevatedButton("Сохранить", on_click=lambda e: page.run_task(add_patient_action)),
                 ft.ElevatedButton("Отмена", on_click=lambda e: toggle_add_patient_panel(None))
             ])
         ],
@@ -223,30 +264,26 @@ def main(page: ft.Page):
         page.update()
         print("Add patient panel toggled:", add_patient_panel.visible)
 
-    def add_patient_action():
+    async def add_patient_action():
+        if not authorize(TAB_ROLES["Пациенты"]):
+            return
         print("Adding patient")
         name = add_patient_name.value
         age = add_patient_age.value
         gender = add_patient_gender.value
         admission_date = add_patient_admission_date.value
         treatment_type = add_patient_treatment_type.value
-        if not name or not age or not gender or not admission_date or not treatment_type:
-            error_text.value = "Заполните все поля"
-            page.update()
-            return
         try:
-            age = int(age)
-            db_manager.execute_query(
-                "INSERT INTO patients (name, age, gender, admission_date, treatment_type) VALUES (?, ?, ?, ?, ?)",
-                (name, age, gender, admission_date, treatment_type),
-                commit=True
-            )
+            row = await query_runner.run(service.add_patient, name, age, gender, admission_date, treatment_type)
             error_text.value = "Пациент успешно добавлен"
-            update_patients_list()
+            async with patients_pager_lock:
+                if patients_pager.insert(row):
+                    patients_table.rows.append(make_patient_row(row))
+                update_patients_pager_controls()
             toggle_add_patient_panel(None)  # Закрываем панель
             print("Patient added successfully")
-        except ValueError:
-            error_text.value = "Возраст должен быть числом"
+        except ValueError as ex:
+            error_text.value = str(ex)
         except Exception as ex:
             error_text.value = f"Ошибка при добавлении пациента: {str(ex)}"
         page.update()
@@ -257,7 +294,7 @@ def main(page: ft.Page):
             ft.Text("Подтверждение удаления", weight=ft.FontWeight.BOLD),
             ft.Text(""),
             ft.Row([
-                ft.ElevatedButton("Да", on_click=lambda e: confirm_delete()),
+                ft.ElevatedButton("Да", on_click=lambda e: page.run_task(confirm_delete)),
                 ft.ElevatedButton("Нет", on_click=lambda e: toggle_delete_confirm_panel(None))
             ])
         ],
@@ -267,36 +304,156 @@ def main(page: ft.Page):
 
     def toggle_delete_confirm_panel(e):
         if selected_patient_id:
-            delete_confirm_panel.controls[1] = ft.Text(f"Вы уверены, что хотите удалить пациента с ID {selected_patient_id}?")
+            delete_confirm_panel.controls[1] = ft.Text(
+                f"Удалить пациента с ID {selected_patient_id} из списков? История сеансов сохранится"
+            )
             delete_confirm_panel.visible = not delete_confirm_panel.visible
         else:
             error_text.value = "Выберите пациента для удаления"
         page.update()
         print("Delete confirm panel toggled:", delete_confirm_panel.visible)
 
-    def confirm_delete():
+    async def confirm_delete():
         nonlocal selected_patient_id  # Переместили nonlocal в начало функции
-        print(f"Confirming deletion of patient ID {selected_patient_id}")
-        db_manager.execute_query("DELETE FROM patients WHERE id = ?", (selected_patient_id,), commit=True)
+        if not authorize(TAB_ROLES["Пациенты"]):
+            return
+        patient_id = selected_patient_id
+        print(f"Confirming deletion of patient ID {patient_id}")
+        try:
+            await query_runner.run(service.delete_patient, patient_id)
+        except Exception as ex:
+            error_text.value = f"Ошибка при удалении пациента: {str(ex)}"
+            page.update()
+            return
         error_text.value = "Пациент удален"
-        selected_patient_id = None
-        update_patients_list()
+        # Удаление мягкое: до следующего удаления его можно отменить
+        restore_button.data = patient_id
+        restore_button.visible = True
+        if timeline_state["patient_id"] == patient_id:
+            close_timeline()
+        async with patients_pager_lock:
+            if patients_pager.remove(patient_id):
+                patients_table.rows.remove(patient_rows.pop(patient_id))
+            update_patients_pager_controls()
+        if selected_patient_id == patient_id:
+            selected_patient_id = None
         toggle_delete_confirm_panel(None)
         page.update()
 
+    async def restore_deleted_patient():
+        if not authorize(TAB_ROLES["Пациенты"]):
+            return
+        try:
+            await query_runner.run(service.restore_patient, restore_button.data)
+        except Exception as ex:
+            error_text.value = f"Ошибка при восстановлении пациента: {str(ex)}"
+            page.update()
+            return
+        error_text.value = f"Пациент с ID {restore_button.data} возвращён"
+        restore_button.visible = False
+        await update_patients_list()
+
+    async def discharge_selected_patient(e):
+        if not authorize(TAB_ROLES["Пациенты"]):
+            return
+        patient_id = selected_patient_id
+        if not patient_id:
+            error_text.value = "Выберите пациента для выписки"
+        else:
+            try:
+                discharge_date = await query_runner.run(service.discharge_patient, patient_id)
+                error_text.value = f"Пациент с ID {patient_id} выписан {discharge_date}"
+            except Exception as ex:
+                error_text.value = f"Ошибка при выписке пациента: {str(ex)}"
+        page.update()
+
     # Текст для отображения сообщений
     error_text = ft.Text("", color=ft.colors.RED)
+    restore_button = ft.TextButton("Отменить удаление", visible=False, on_click=lambda e: page.run_task(restore_deleted_patient))
+
+    # Панель истории выбранного пациента: сеансы с процедурами от новых к старым,
+    # по странице за запрос (ClinicService.patient_timeline)
+    timeline_state = {"patient_id": None, "cursor": None}
+    timeline_title = ft.Text("", weight=ft.FontWeight.BOLD)
+    timeline_list = ft.ListView(spacing=5, height=300)
+    timeline_more_button = ft.TextButton(
+        "Показать ещё", visible=False, on_click=lambda e: page.run_task(load_timeline_page)
+    )
+    timeline_panel = ft.Column(
+        [
+            ft.Row([
+                timeline_title,
+                ft.IconButton(icon=ft.Icons.CLOSE, tooltip="Закрыть историю", on_click=lambda e: close_timeline())
+            ]),
+            timeline_list,
+            timeline_more_button
+        ],
+        visible=False
+    )
+
+    async def show_patient_timeline(e):
+        if not authorize(TAB_ROLES["Пациенты"]):
+            return
+        if not selected_patient_id:
+            error_text.value = "Выберите пациента"
+            page.update()
+            return
+        name = next((row.name for row in patients_pager.rows if row.id == selected_patient_id), "")
+        timeline_state.update(patient_id=selected_patient_id, cursor=None)
+        timeline_title.value = f"История: {selected_patient_id} - {name}"
+        timeline_list.controls = []
+        timeline_panel.visible = True
+        await load_timeline_page()
+
+    async def load_timeline_page():
+        if not authorize(TAB_ROLES["Пациенты"]):
+            return
+        timeline_more_button.disabled = True
+        page.update()
+        try:
+            sessions, cursor = await query_runner.run(
+                service.patient_timeline, timeline_state["patient_id"], timeline_state["cursor"], key="timeline"
+            )
+        except StaleQueryError:
+            return
+        finally:
+            timeline_more_button.disabled = False
+        timeline_state["cursor"] = cursor
+        for session in sessions:
+            timeline_list.controls.append(
+                ft.Text(f"{session.session_date} — {session.diagnosis}", weight=ft.FontWeight.BOLD)
+            )
+            timeline_list.controls.extend(
+                ft.Text(f"    {procedure.procedure_name}: {procedure.parameters}") for procedure in session.procedures
+            )
+        if not timeline_list.controls:
+            timeline_list.controls.append(ft.Text("Сеансов нет", italic=True))
+        timeline_more_button.visible = cursor is not None
+        page.update()
+        print("Timeline page loaded")
+
+    def close_timeline():
+        timeline_state.update(patient_id=None, cursor=None)
+        timeline_panel.visible = False
+        timeline_list.controls = []
+        page.update()
 
     patients_tab_content = ft.Column(
         [
             ft.Row([
                 ft.ElevatedButton("Добавить", icon=ft.Icons.ADD, on_click=toggle_add_patient_panel),
                 ft.ElevatedButton("Удалить", icon=ft.Icons.DELETE, on_click=toggle_delete_confirm_panel),
-                ft.ElevatedButton("Обновить", icon=ft.Icons.REFRESH, on_click=lambda e: update_patients_list())
+                ft.ElevatedButton("Выписать", icon=ft.Icons.ASSIGNMENT_TURNED_IN, on_click=discharge_selected_patient),
+                ft.ElevatedButton("Обновить", icon=ft.Icons.REFRESH, on_click=lambda e: page.run_task(update_patients_list)),
+                ft.ElevatedButton("История", icon=ft.Icons.HISTORY, on_click=show_patient_timeline),
+                patients_prev_button,
+                patients_page_label,
+                patients_next_button
             ], alignment=ft.MainAxisAlignment.START),
             add_patient_panel,
             delete_confirm_panel,
-            error_text,
+            ft.Row([error_text, restore_button]),
+            timeline_panel,
             ft.Divider(),
             patients_table_container
         ],
@@ -304,31 +461,79 @@ def main(page: ft.Page):
     )
 
     # Вкладка "Лечебные процедуры"
-    proc_patient_dropdown = ft.Dropdown(label="Пациент", options=[], width=250)
+    # Пациент выбирается подбором: поле ввода и до PATIENT_LOOKUP_LIMIT подсказок под ним
+    proc_patient_id = None
+    proc_patient_field = ft.TextField(
+        label="Пациент (ФИО или ID)", width=250, on_change=lambda e: page.run_task(handle_patient_lookup)
+    )
+    proc_patient_suggestions = ft.Column([], spacing=0, width=250)
+    patient_lookup_keystrokes = 0
     proc_date_entry = ft.TextField(label="Дата и время", value=datetime.now().strftime("%Y-%m-%d %H:%M"), width=200)
     proc_diagnosis_entry = ft.TextField(label="Диагноз", width=250)
     proc_name_dropdown = ft.Dropdown(
         label="Процедура",
         width=250,
-        options=[
-            ft.dropdown.Option("УЗИ брюшной полости"),
-            ft.dropdown.Option("Электрокардиография"),
-            ft.dropdown.Option("МРТ"),
-            ft.dropdown.Option("Физиотерапия"),
-            ft.dropdown.Option("Лазерная терапия")
-        ]
+        options=[],
+        on_focus=lambda e: page.run_task(refresh_procedure_dropdown)
     )
-    proc_params_entry = ft.TextField(label="Параметры", width=300)
+    procedure_options_version = None
+    proc_params_entry = ft.TextField(label="Параметры", hint_text="Давление: 120/80; Температура: 37,5", width=300)
     procedures_list_view = ft.ListView(expand=True, spacing=5)
     temp_procedures = []
 
-    def update_patient_dropdown():
-        patients = db_manager.execute_query("SELECT id, name FROM patients ORDER BY name", fetch_all=True)
-        if patients is None:
-            patients = []
-        proc_patient_dropdown.options = [ft.dropdown.Option(key=str(p[0]), text=f"{p[0]} - {p[1]}") for p in patients]
+    async def handle_patient_lookup():
+        nonlocal proc_patient_id, patient_lookup_keystrokes
+        proc_patient_id = None  # выбор сбрасывается, как только текст правят вручную
+        patient_lookup_keystrokes += 1
+        keystroke = patient_lookup_keystrokes
+        # Запрос уходит, только когда пользователь перестал печатать
+        await asyncio.sleep(PATIENT_LOOKUP_DEBOUNCE)
+        if keystroke != patient_lookup_keystrokes:
+            return
+        if not authorize(TAB_ROLES["Лечебные процедуры"]):
+            return
+        try:
+            patients = await query_runner.run(service.find_patients, proc_patient_field.value, key="patient_lookup")
+        except StaleQueryError:
+            return
+        proc_patient_suggestions.controls = [
+            ft.TextButton(
+                f"{patient.id} - {patient.name}",
+                on_click=lambda e, patient=patient: pick_patient(patient)
+            )
+            for patient in patients
+        ]
+        if proc_patient_field.value and not patients:
+            proc_patient_suggestions.controls = [ft.Text("Пациенты не найдены", italic=True)]
+        page.update()
+
+    def pick_patient(patient):
+        nonlocal proc_patient_id, patient_lookup_keystrokes
+        patient_lookup_keystrokes += 1  # отменяет запрос, ещё ждущий паузы
+        proc_patient_id = patient.id
+        proc_patient_field.value = f"{patient.id} - {patient.name}"
+        proc_patient_suggestions.controls = []
+        page.update()
+
+    def clear_patient_pick():
+        nonlocal proc_patient_id
+        proc_patient_id = None
+        proc_patient_field.value = ""
+        proc_patient_suggestions.controls = []
+
+    async def refresh_procedure_dropdown():
+        # Опции пересобираются, только если справочник процедур изменился (импорт, синхронизация)
+        nonlocal procedure_options_version
+        if not authorize(TAB_ROLES["Лечебные процедуры"]):
+            return
+        version = service.reference_version("procedures")
+        if version == procedure_options_version:
+            return
+        names = await query_runner.run(service.procedure_catalog)
+        proc_name_dropdown.options = [ft.dropdown.Option(name) for name in names]
+        procedure_options_version = version
         page.update()
-        print("Patient dropdown updated")
+        print("Procedure dropdown updated")
 
     def add_procedure_to_temp_list(e):
         proc_name = proc_name_dropdown.value
@@ -337,55 +542,65 @@ def main(page: ft.Page):
             error_text.value = "Выберите процедуру"
             page.update()
             return
+        # Параметры уходят в сеанс парами ключ -> значение, а не исходной строкой
+        proc_params = split_parameters(proc_params)
+        try:
+            params_text = format_parameters(proc_params)
+        except ValueError as ex:
+            error_text.value = str(ex)
+            page.update()
+            return
         temp_procedures.append({"name": proc_name, "params": proc_params})
-        procedures_list_view.controls.append(ft.Text(f"- {proc_name}: {proc_params}"))
+        procedures_list_view.controls.append(ft.Text(f"- {proc_name}: {params_text}"))
         proc_name_dropdown.value = None
         proc_params_entry.value = ""
         page.update()
         print("Procedure added to temp list")
 
-    def save_treatment_session(e):
-        patient_id = proc_patient_dropdown.value
+    async def save_treatment_session(e):
+        if not authorize(TAB_ROLES["Лечебные процедуры"]):
+            return
+        patient_id = proc_patient_id
         session_date = proc_date_entry.value
         diagnosis = proc_diagnosis_entry.value
         if not patient_id or not session_date or not diagnosis or not temp_procedures:
             error_text.value = "Заполните все поля и добавьте хотя бы одну процедуру"
             page.update()
             return
+        save_session_button.disabled = True
+        error_text.value = "Сохранение..."
+        page.update()
         try:
-            session_id = db_manager.execute_query(
-                "INSERT INTO treatment_sessions (patient_id, session_date, diagnosis) VALUES (?, ?, ?)",
-                (int(patient_id), session_date, diagnosis),
-                commit=True
+            await query_runner.run(
+                service.save_session, patient_id, session_date, diagnosis,
+                [(proc["name"], proc["params"]) for proc in temp_procedures]
             )
-            for proc in temp_procedures:
-                db_manager.execute_query(
-                    "INSERT INTO session_procedures (session_id, procedure_name, parameters) VALUES (?, ?, ?)",
-                    (session_id, proc["name"], proc["params"]),
-                    commit=True
-                )
             error_text.value = "Сеанс сохранен"
-            proc_patient_dropdown.value = None
+            clear_patient_pick()
             proc_date_entry.value = datetime.now().strftime("%Y-%m-%d %H:%M")
             proc_diagnosis_entry.value = ""
             proc_name_dropdown.value = None
             proc_params_entry.value = ""
             procedures_list_view.controls.clear()
             temp_procedures.clear()
-            page.update()
             print("Treatment session saved")
+        except ValueError as ex:
+            error_text.value = str(ex)
         except Exception as ex:
             error_text.value = f"Ошибка при сохранении сеанса: {str(ex)}"
-            page.update()
+        save_session_button.disabled = False
+        page.update()
+
+    save_session_button = ft.ElevatedButton("Сохранить сеанс", icon=ft.Icons.SAVE, on_click=save_treatment_session)
 
     procedures_tab_content = ft.Row(
         [
             ft.Column([
                 ft.Text("Информация о сеансе", weight=ft.FontWeight.BOLD),
-                proc_patient_dropdown,
+                proc_patient_field,
+                proc_patient_suggestions,
                 proc_date_entry,
-                proc_diagnosis_entry,
-                ft.ElevatedButton("Обновить список пациентов", on_click=lambda e: update_patient_dropdown())
+                proc_diagnosis_entry
             ], width=300),
             ft.VerticalDivider(),
             ft.Column([
@@ -399,7 +614,7 @@ def main(page: ft.Page):
                 ft.Text("Добавить процедуру", weight=ft.FontWeight.BOLD),
                 ft.Row([proc_name_dropdown, proc_params_entry], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
                 ft.ElevatedButton("Добавить процедуру", icon=ft.Icons.ADD, on_click=add_procedure_to_temp_list),
-                ft.ElevatedButton("Сохранить сеанс", icon=ft.Icons.SAVE, on_click=save_treatment_session)
+                save_session_button
             ], expand=True)
         ],
         expand=True
@@ -410,57 +625,177 @@ def main(page: ft.Page):
         label="Тип данных",
         value="Пациенты",
         width=200,
-        options=[
-            ft.dropdown.Option("Пациенты"),
-            ft.dropdown.Option("Сеансы"),
-            ft.dropdown.Option("Процедуры")
-        ]
+        options=[ft.dropdown.Option(data_type) for data_type in DATA_VIEWS],
+        on_change=lambda e: page.run_task(change_data_view_type)
+    )
+    view_search_field = ft.TextField(label="Поиск", width=220, on_submit=lambda e: page.run_task(update_data_view))
+    view_filter_dropdown = ft.Dropdown(label="Фильтр", width=220, options=[])
+    view_date_from = ft.TextField(label="Дата с (ГГГГ-ММ-ДД)", width=180, on_submit=lambda e: page.run_task(update_data_view))
+    view_date_to = ft.TextField(label="Дата по (ГГГГ-ММ-ДД)", width=180, on_submit=lambda e: page.run_task(update_data_view))
+    view_period_dropdown = ft.Dropdown(
+        label="Период", width=160,
+        options=[ft.dropdown.Option(name) for name in VIEW_PERIODS],
+        on_change=lambda e: page.run_task(apply_view_period)
+    )
+    # Сеансы и процедуры из архива (ClinicService.archive) показываются только по запросу
+    view_archive_checkbox = ft.Checkbox(
+        label="С архивом", value=False, on_change=lambda e: page.run_task(update_data_view)
+    )
+    view_status_text = ft.Text("")
+    view_loading = ft.ProgressRing(width=16, height=16, visible=False)
+    full_text_search_field = ft.TextField(
+        label="Поиск по ФИО, диагнозам и процедурам", width=400, on_submit=lambda e: page.run_task(show_search_results)
     )
     view_data_table = ft.DataTable(columns=[], rows=[])
     view_data_table_container = ft.Column([view_data_table], scroll=ft.ScrollMode.AUTO, expand=True)
+    view_sort = {"index": None, "descending": False}
+
+    async def change_data_view_type():
+        view_sort["index"] = None
+        view_sort["descending"] = False
+        view_filter_dropdown.value = None
+        await update_data_view()
+
+    async def handle_data_view_sort(e):
+        view_sort["index"] = e.column_index
+        view_sort["descending"] = not e.ascending
+        await update_data_view()
+
+    def show_view_loading(loading):
+        view_loading.visible = loading
+        if loading:
+            view_status_text.value = "Загрузка..."
+
+    export_format_dropdown = ft.Dropdown(
+        label="Формат", width=130, value=EXPORT_FORMATS[0],
+        options=[ft.dropdown.Option(fmt) for fmt in EXPORT_FORMATS]
+    )
+    export_progress = ft.ProgressBar(width=200, visible=False)
+    export_status_text = ft.Text("")
+    export_button = ft.ElevatedButton("Экспорт", icon=ft.Icons.DOWNLOAD, on_click=lambda e: choose_export_file())
+
+    def current_view_filters():
+        return dict(
+            search=(view_search_field.value or "").strip(),
+            filter_value=view_filter_dropdown.value,
+            date_from=(view_date_from.value or "").strip() or None,
+            date_to=(view_date_to.value or "").strip() or None,
+            sort_index=view_sort["index"],
+            descending=view_sort["descending"],
+            include_archive=bool(view_archive_checkbox.value),
+        )
+
+    def choose_export_file():
+        if not authorize(TAB_ROLES["Просмотр данных"]):
+            return
+        fmt = export_format_dropdown.value or EXPORT_FORMATS[0]
+        export_file_picker.save_file(
+            dialog_title="Экспорт данных",
+            file_name=f"{view_data_type_dropdown.value}_{datetime.now().strftime('%Y%m%d_%H%M')}.{fmt}",
+            allowed_extensions=[fmt]
+        )
+
+    def handle_export_file(e):
+        if e.path:
+            start_export(e.path, export_format_dropdown.value or EXPORT_FORMATS[0])
 
-    def update_data_view(e=None):
+    def start_export(path, fmt):
+        # Выгрузка идёт в отдельном потоке со своим соединением на чтение, интерфейс не блокируется
+        if not authorize(TAB_ROLES["Просмотр данных"]):
+            return
         data_type = view_data_type_dropdown.value
-        view_data_table.columns = []
-        view_data_table.rows = []
-        if data_type == "Пациенты":
-            view_data_table.columns = [
-                ft.DataColumn(ft.Text("ID")),
-                ft.DataColumn(ft.Text("ФИО")),
-                ft.DataColumn(ft.Text("Возраст")),
-                ft.DataColumn(ft.Text("Пол")),
-                ft.DataColumn(ft.Text("Дата поступления")),
-                ft.DataColumn(ft.Text("Тип лечения"))
-            ]
-            data = db_manager.execute_query("SELECT * FROM patients ORDER BY id", fetch_all=True)
-        elif data_type == "Сеансы":
-            view_data_table.columns = [
-                ft.DataColumn(ft.Text("ID")),
-                ft.DataColumn(ft.Text("ID пациента")),
-                ft.DataColumn(ft.Text("Пациент")),
-                ft.DataColumn(ft.Text("Дата сеанса")),
-                ft.DataColumn(ft.Text("Диагноз"))
-            ]
-            data = db_manager.execute_query(
-                "SELECT s.id, s.patient_id, p.name, s.session_date, s.diagnosis FROM treatment_sessions s JOIN patients p ON s.patient_id = p.id ORDER BY s.session_date DESC",
-                fetch_all=True
-            )
-        elif data_type == "Процедуры":
-            view_data_table.columns = [
-                ft.DataColumn(ft.Text("ID")),
-                ft.DataColumn(ft.Text("ID сеанса")),
-                ft.DataColumn(ft.Text("Дата сеанса")),
-                ft.DataColumn(ft.Text("Процедура")),
-                ft.DataColumn(ft.Text("Параметры"))
-            ]
-            data = db_manager.execute_query(
-                "SELECT p.id, p.session_id, s.session_date, p.procedure_name, p.parameters FROM session_procedures p JOIN treatment_sessions s ON p.session_id = s.id ORDER BY p.id",
-                fetch_all=True
-            )
-        else:
-            data = []
-        if data is None:
-            data = []
+        filters = current_view_filters()
+        export_button.disabled = True
+        export_progress.visible = True
+        export_progress.value = None
+        export_status_text.value = "Экспорт..."
+        page.update()
+
+        def report(written):
+            export_status_text.value = f"Выгружено строк: {written}"
+            page.update()
+
+        def run():
+            try:
+                written = service.export_data_view(data_type, path, fmt, progress=report, **filters)
+                export_status_text.value = f"Готово: {written} строк в {path}"
+            except Exception as ex:
+                export_status_text.value = f"Ошибка экспорта: {str(ex)}"
+            finally:
+                db_manager.pool.release_reader()  # поток одноразовый, его соединение больше не понадобится
+            export_button.disabled = False
+            export_progress.visible = False
+            page.update()
+            print("Export finished")
+
+        threading.Thread(target=run, daemon=True).start()
+
+    export_file_picker = ft.FilePicker(on_result=handle_export_file)
+    page.overlay.append(export_file_picker)
+
+    async def show_search_results(e=None):
+        # Результаты полнотекстового поиска выводятся в ту же таблицу, по убыванию релевантности
+        if not authorize(TAB_ROLES["Просмотр данных"]):
+            return
+        text = (full_text_search_field.value or "").strip()
+        if not text:
+            await update_data_view()
+            return
+        show_view_loading(True)
+        page.update()
+        try:
+            results = await query_runner.run(service.search, text, key="data_view")
+        except StaleQueryError:
+            return  # таблицу уже заняли более новым запросом
+        show_view_loading(False)
+        view_data_table.columns = [
+            ft.DataColumn(ft.Text(title)) for title in ("Тип", "ID", "ID пациента", "Пациент", "Совпадение")
+        ]
+        view_data_table.sort_column_index = None
+        view_data_table.rows = [
+            ft.DataRow(cells=[ft.DataCell(ft.Text("" if cell is None else str(cell))) for cell in row])
+            for row in results
+        ]
+        view_status_text.value = f"Найдено: {len(results)}"
+        page.update()
+        print("Search results shown")
+
+    async def apply_view_period():
+        # Готовый диапазон: поля дат заполняются границами периода, отбор идёт по индексу даты
+        if view_period_dropdown.value not in VIEW_PERIODS:
+            return
+        view_date_from.value, view_date_to.value = period_bounds(VIEW_PERIODS[view_period_dropdown.value])
+        await update_data_view()
+
+    async def update_data_view(e=None):
+        if not authorize(TAB_ROLES["Просмотр данных"]):
+            return
+        data_type = view_data_type_dropdown.value
+        view = DATA_VIEWS[data_type]
+        view_data_table.columns = [
+            ft.DataColumn(ft.Text(title), on_sort=handle_data_view_sort) for title, _ in view["columns"]
+        ]
+        view_data_table.sort_column_index = view_sort["index"]
+        view_data_table.sort_ascending = not view_sort["descending"]
+        view_filter_dropdown.visible = view["filter"] is not None
+        view_archive_checkbox.visible = "history_query" in view
+        show_view_loading(True)
+        page.update()
+        try:
+            # Справочник фильтра при устаревшей версии читается из базы, поэтому тоже в пуле
+            filter_values = await query_runner.run(service.reference, view["filter"][1]) if view["filter"] else []
+            view_filter_dropdown.options = [ft.dropdown.Option(value) for value in filter_values]
+            # Смена типа данных посреди загрузки прерывает предыдущий запрос
+            data = await query_runner.run(service.data_view, data_type, key="data_view", **current_view_filters())
+        except StaleQueryError:
+            return
+        except ValueError as ex:
+            show_view_loading(False)
+            view_status_text.value = str(ex)
+            page.update()
+            return
+        show_view_loading(False)
+        view_status_text.value = f"Показано строк: {len(data)}" + (f" (не более {DATA_VIEW_LIMIT})" if len(data) >= DATA_VIEW_LIMIT else "")
         view_data_table.rows = [
             ft.DataRow(cells=[ft.DataCell(ft.Text(str(cell))) for cell in row])
             for row in data
@@ -468,64 +803,329 @@ def main(page: ft.Page):
         page.update()
         print("Data view updated")
 
-    tabs_control = ft.Tabs(
-        selected_index=0,
-        animation_duration=300,
-        tabs=[
-            ft.Tab(text="Пациенты", content=patients_tab_content),
-            ft.Tab(text="Лечебные процедуры", content=procedures_tab_content),
-            ft.Tab(text="Просмотр данных", content=ft.Column([
+    # Вкладка "Статистика" (администратор и врач): графики строятся по сводным таблицам
+    stats_colors = [ft.Colors.BLUE, ft.Colors.PINK, ft.Colors.GREEN, ft.Colors.ORANGE, ft.Colors.PURPLE]
+    daily_sessions_chart = ft.Container(height=300)
+    procedures_chart = ft.Container(height=300)
+    demographics_chart = ft.Container(height=300)
+    daily_sessions_legend = ft.Row([], wrap=True)
+    demographics_legend = ft.Row([], wrap=True)
+
+    def make_bar_chart(labels, series):
+        # labels — подписи групп по оси X, series — список (название, значения по группам)
+        max_y = max([value for _, values in series for value in values] or [0])
+        return ft.BarChart(
+            bar_groups=[
+                ft.BarChartGroup(
+                    x=i,
+                    bar_rods=[
+                        ft.BarChartRod(
+                            from_y=0, to_y=values[i], width=12, border_radius=2,
+                            color=stats_colors[j % len(stats_colors)], tooltip=f"{name}: {values[i]}"
+                        )
+                        for j, (name, values) in enumerate(series)
+                    ],
+                )
+                for i in range(len(labels))
+            ],
+            bottom_axis=ft.ChartAxis(
+                labels=[ft.ChartAxisLabel(value=i, label=ft.Text(label, size=10)) for i, label in enumerate(labels)],
+                labels_size=32
+            ),
+            left_axis=ft.ChartAxis(labels_size=40),
+            horizontal_grid_lines=ft.ChartGridLines(color=ft.Colors.OUTLINE_VARIANT, width=1),
+            max_y=max_y * 1.1 or 1,
+            expand=True
+        )
+
+    def make_legend(names):
+        return [
+            ft.Row([ft.Container(width=12, height=12, bgcolor=stats_colors[j % len(stats_colors)]), ft.Text(name or "—")])
+            for j, name in enumerate(names)
+        ]
+
+    def load_stats():
+        return service.daily_sessions(), service.procedure_usage(), service.demographics()
+
+    async def update_stats_view():
+        if not authorize(TAB_ROLES["Статистика"]):
+            return
+        try:
+            daily, procedures, demographics = await query_runner.run(load_stats, key="stats")
+        except StaleQueryError:
+            return
+        days = sorted({row.day for row in daily})
+        types = sorted({row.treatment_type for row in daily})
+        counts = {(row.day, row.treatment_type): row.sessions for row in daily}
+        daily_sessions_chart.content = make_bar_chart(
+            [day[5:] for day in days],
+            [(treatment_type or "—", [counts.get((day, treatment_type), 0) for day in days]) for treatment_type in types]
+        )
+        daily_sessions_legend.controls = make_legend(types)
+
+        procedures_chart.content = make_bar_chart(
+            [row.procedure_name for row in procedures], [("Назначений", [row.uses for row in procedures])]
+        )
+
+        buckets = sorted({row.age_bucket for row in demographics})
+        genders = sorted({row.gender for row in demographics})
+        patients = {(row.age_bucket, row.gender): row.patients for row in demographics}
+        demographics_chart.content = make_bar_chart(
+            [f"{bucket * 10}–{bucket * 10 + 9}" if bucket >= 0 else "?" for bucket in buckets],
+            [(gender or "—", [patients.get((bucket, gender), 0) for bucket in buckets]) for gender in genders]
+        )
+        demographics_legend.controls = make_legend(genders)
+        page.update()
+        print("Stats view updated")
+
+    stats_tab_content = ft.Column([
+        ft.ElevatedButton("Обновить статистику", icon=ft.Icons.REFRESH, on_click=lambda e: page.run_task(update_stats_view)),
+        ft.Text("Сеансы по дням и типам лечения", weight=ft.FontWeight.BOLD),
+        daily_sessions_legend,
+        daily_sessions_chart,
+        ft.Text("Частота процедур", weight=ft.FontWeight.BOLD),
+        procedures_chart,
+        ft.Text("Пациенты по возрасту и полу", weight=ft.FontWeight.BOLD),
+        demographics_legend,
+        demographics_chart
+    ], scroll=ft.ScrollMode.AUTO, expand=True)
+
+    data_view_tab_content = ft.Column([
                 ft.Row([
                     view_data_type_dropdown,
                     ft.ElevatedButton("Обновить", icon=ft.Icons.REFRESH, on_click=update_data_view)
                 ]),
+                ft.Row([
+                    view_search_field,
+                    view_filter_dropdown,
+                    view_period_dropdown,
+                    view_date_from,
+                    view_date_to,
+                    view_archive_checkbox,
+                    ft.ElevatedButton("Применить", icon=ft.Icons.FILTER_ALT, on_click=update_data_view)
+                ], wrap=True),
+                ft.Row([
+                    full_text_search_field,
+                    ft.ElevatedButton("Найти", icon=ft.Icons.SEARCH, on_click=show_search_results)
+                ]),
+                ft.Row([export_format_dropdown, export_button, export_progress, export_status_text]),
+                ft.Row([view_loading, view_status_text]),
                 ft.Divider(),
                 view_data_table_container
-            ], expand=True))
+            ], expand=True)
+
+    # Вкладка "Диагностика" (администратор): профиль запросов и журнал медленных запросов
+    query_profiler = db_manager.profiler
+    profiling_switch = ft.Switch(
+        label="Профилирование запросов", value=query_profiler is not None, on_change=lambda e: toggle_profiling()
+    )
+    slow_ms_field = ft.TextField(label="Порог медленного запроса, мс", width=240, value=str(SLOW_QUERY_MS))
+    diagnostics_status_text = ft.Text("")
+    diagnostics_table = ft.DataTable(
+        columns=[
+            ft.DataColumn(ft.Text(title))
+            for title in ("Запрос", "Вызовов", "Всего, мс", "Среднее, мс", "Макс., мс", "Строк", "Задержки")
         ],
-        expand=1
+        rows=[]
     )
+    slow_queries_view = ft.ListView(spacing=10, height=300)
+
+    def toggle_profiling():
+        nonlocal query_profiler
+        if not authorize(TAB_ROLES["Диагностика"]):
+            return
+        if profiling_switch.value:
+            try:
+                slow_ms = float(slow_ms_field.value)
+            except (TypeError, ValueError):
+                profiling_switch.value = False
+                diagnostics_status_text.value = "Порог должен быть числом"
+                page.update()
+                return
+            # Повторное включение продолжает накопленную статистику
+            query_profiler = db_manager.enable_profiling(slow_ms, query_profiler)
+        else:
+            db_manager.disable_profiling()
+        update_diagnostics_view()
 
-    def create_main_interface():
+    def update_diagnostics_view():
+        if not authorize(TAB_ROLES["Диагностика"]):
+            return
+        if query_profiler is None:
+            diagnostics_table.rows = []
+            slow_queries_view.controls = []
+            diagnostics_status_text.value = "Профилирование выключено"
+            page.update()
+            return
+        snapshot = query_profiler.snapshot()
+        diagnostics_table.rows = [
+            ft.DataRow(cells=[
+                ft.DataCell(ft.Text(stat["sql"][:80], tooltip=stat["sql"])),
+                ft.DataCell(ft.Text(str(stat["calls"]))),
+                ft.DataCell(ft.Text(f"{stat['total_ms']:.1f}")),
+                ft.DataCell(ft.Text(f"{stat['mean_ms']:.2f}")),
+                ft.DataCell(ft.Text(f"{stat['max_ms']:.1f}")),
+                ft.DataCell(ft.Text(str(stat["rows"]))),
+                ft.DataCell(ft.Text(" ".join(f"{label}:{count}" for label, count in stat["histogram"].items() if count))),
+            ])
+            for stat in snapshot["statements"][:100]
+        ]
+        slow_queries_view.controls = [
+            ft.Text(
+                f"{entry['at']}  {entry['ms']} мс, строк: {entry['rows']}"
+                + ("  ПОЛНЫЙ ПРОСМОТР" if entry["full_scan"] else "")
+                + f"\n{entry['sql']}\n" + "\n".join(f"  {line}" for line in entry["plan"]),
+                color=ft.Colors.RED if entry["full_scan"] else None,
+                selectable=True
+            )
+            for entry in reversed(snapshot["slow_queries"])
+        ]
+        diagnostics_status_text.value = (
+            f"Запросов: {len(snapshot['statements'])}, медленных: {len(snapshot['slow_queries'])}, "
+            f"с полным просмотром: {len(snapshot['full_scans'])}"
+        )
+        page.update()
+        print("Diagnostics view updated")
+
+    def dump_query_profile():
+        if not authorize(TAB_ROLES["Диагностика"]):
+            return
+        if query_profiler is None:
+            diagnostics_status_text.value = "Профилирование выключено"
+        else:
+            path = query_profiler.dump(f"query_profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+            diagnostics_status_text.value = f"Профиль сохранён: {os.path.abspath(path)}"
+        page.update()
+
+    def reset_query_profile():
+        if not authorize(TAB_ROLES["Диагностика"]):
+            return
+        if query_profiler is not None:
+            query_profiler.reset()
+        update_diagnostics_view()
+
+    diagnostics_tab_content = ft.Column([
+        ft.Row([
+            profiling_switch,
+            slow_ms_field,
+            ft.ElevatedButton("Обновить", icon=ft.Icons.REFRESH, on_click=lambda e: update_diagnostics_view()),
+            ft.ElevatedButton("Сбросить", icon=ft.Icons.DELETE_SWEEP, on_click=lambda e: reset_query_profile()),
+            ft.ElevatedButton("Сохранить JSON", icon=ft.Icons.SAVE, on_click=lambda e: dump_query_profile())
+        ], wrap=True),
+        diagnostics_status_text,
+        ft.Text("Запросы по суммарному времени", weight=ft.FontWeight.BOLD),
+        ft.Row([diagnostics_table], scroll=ft.ScrollMode.AUTO),
+        ft.Text("Медленные запросы и планы выполнения", weight=ft.FontWeight.BOLD),
+        slow_queries_view
+    ], scroll=ft.ScrollMode.AUTO, expand=True)
+
+    # Вкладка: (название, содержимое, загрузка данных). Содержимое попадает на страницу
+    # и данные загружаются при первом открытии вкладки, а не все сразу после входа
+    tab_specs = [
+        ("Пациенты", patients_tab_content, update_patients_list),
+        ("Лечебные процедуры", procedures_tab_content, refresh_procedure_dropdown),
+        ("Просмотр данных", data_view_tab_content, update_data_view),
+        ("Статистика", stats_tab_content, update_stats_view),
+        ("Диагностика", diagnostics_tab_content, update_diagnostics_view),
+    ]
+    visible_tabs = []
+    opened_tabs = set()
+
+    async def open_tab(index):
+        title, content, load = visible_tabs[index]
+        if not authorize(TAB_ROLES[title]):
+            return
+        if title in opened_tabs:
+            return
+        opened_tabs.add(title)
+        tabs_control.tabs[index].content = content
+        page.update()
+        if load is None:
+            return
+        # Загрузчики с запросами — корутины, сами запросы идут через query_runner;
+        # синхронный загрузчик (диагностика) читает только память процесса
+        try:
+            if asyncio.iscoroutinefunction(load):
+                await load()
+            else:
+                load()
+        except Exception as ex:
+            # Вкладка откроется заново при следующем выборе
+            opened_tabs.discard(title)
+            tabs_control.tabs[index].content = ft.Text(f"Ошибка загрузки вкладки «{title}»: {str(ex)}", color=ft.colors.RED)
+            page.update()
+            return
+        print(f"Tab opened: {title}")
+
+    tabs_control = ft.Tabs(
+        selected_index=0,
+        animation_duration=300,
+        tabs=[],
+        expand=1,
+        on_change=lambda e: page.run_task(open_tab, tabs_control.selected_index)
+    )
+
+    async def create_main_interface():
         print("Creating main interface")
-        page.controls = [tabs_control]
-        update_data_view()
-        update_patients_list()
-        update_patient_dropdown()
+        user = current_user()
+        role = user.role if user else None
+        visible_tabs[:] = [spec for spec in tab_specs if role in TAB_ROLES[spec[0]]]
+        opened_tabs.clear()
+        logout_row = ft.Row(
+            [ft.TextButton("Выйти", icon=ft.Icons.LOGOUT, on_click=lambda e: logout())],
+            alignment=ft.MainAxisAlignment.END
+        )
+        if not visible_tabs:
+            page.controls = [logout_row, ft.Text("Для вашей роли нет доступных разделов", size=18)]
+            page.update()
+            return
+        tabs_control.tabs = [
+            ft.Tab(text=title, content=ft.Container(ft.ProgressRing(), alignment=ft.alignment.center))
+            for title, _, _ in visible_tabs
+        ]
+        tabs_control.selected_index = 0
+        page.controls = [logout_row, tabs_control]
         page.update()
+        await open_tab(0)
         print("Main interface created")
 
     login_field = ft.TextField(label="Логин", width=300)
     password_field = ft.TextField(label="Пароль", password=True, can_reveal_password=True, width=300)
 
-    def authenticate(e):
+    async def authenticate(e):
         username = login_field.value.strip()
         password = password_field.value.strip()
         if not username or not password:
             error_text.value = "Введите логин и пароль"
             page.update()
             return
-        hashed_password = hashlib.sha256(password.encode()).hexdigest()
-        user_data = db_manager.execute_query(
-            "SELECT id, role FROM users WHERE username = ? AND password = ?",
-            (username, hashed_password),
-            fetch_one=True
-        )
-        if user_data:
-            app_state["user_id"] = user_data[0]
-            app_state["user_role"] = user_data[1]
-            create_main_interface()
-        else:
-            error_text.value = "Неверный логин или пароль"
+        login_button.disabled = True
+        error_text.value = "Проверка..."
         page.update()
+        # Проверка пароля (scrypt/PBKDF2) идёт в пуле потоков
+        try:
+            token = await query_runner.run(service.login, username, password)
+            if token:
+                error_text.value = ""
+                app_state["token"] = token
+                await create_main_interface()
+            else:
+                error_text.value = "Неверный логин или пароль"
+        except Exception as ex:
+            error_text.value = f"Ошибка входа: {str(ex)}"
+        finally:
+            login_button.disabled = False
+            page.update()
         print("Authentication attempted")
 
+    login_button = ft.ElevatedButton("Войти", on_click=authenticate, width=300)
+
     login_view = ft.Column(
         [
             ft.Text("Авторизация", size=24, weight=ft.FontWeight.BOLD),
             login_field,
             password_field,
-            ft.ElevatedButton("Войти", on_click=authenticate, width=300),
+            login_button,
             error_text
         ],
         alignment=ft.MainAxisAlignment.CENTER,
@@ -536,7 +1136,10 @@ def main(page: ft.Page):
 
     def window_event_handler(e):
         if e.data == "close":
-            db_manager.close()
+            query_runner.shutdown()
+            if query_profile_path and query_profiler is not None:
+                query_profiler.dump(query_profile_path)
+            service.close()
             page.window_destroy()
 
     page.window_prevent_close = True
@@ -544,5 +1147,131 @@ def main(page: ft.Page):
     page.controls = [login_view]
     page.update()
 
+def run_import(args):
+    db_manager = DatabaseManager(args.db, profile="production")
+    db_manager.connect()
+    try:
+        db_manager.create_tables()
+        result = db_manager.import_records(
+            args.kind, args.path, fmt=args.format, chunk_size=args.chunk_size, reject_path=args.reject_file,
+            drop_indexes=not args.keep_indexes, restart=args.restart,
+            progress=lambda position, imported, rejected: print(
+                f"Обработано {position}: импортировано {imported}, отклонено {rejected}", flush=True
+            )
+        )
+    finally:
+        db_manager.close()
+    print(f"Готово: импортировано {result['imported']}, отклонено {result['rejected']} ({result['reject_file']})")
+
+def open_cli_service(db_name, archive_name=None):
+    # Команды работают через ClinicService, как интерфейс, но без пользователей и тестовых данных
+    db_manager = DatabaseManager(db_name, profile="production", archive_name=archive_name)
+    db_manager.connect()
+    db_manager.create_tables()
+    return ClinicService(db_manager)
+
+def run_archive(args):
+    service = open_cli_service(args.db, args.archive)
+    try:
+        result = service.archive(args.horizon_days)
+    except ValueError as ex:
+        raise SystemExit(str(ex))
+    finally:
+        service.close()
+    print(f"Перенесено в архив {result['archive']}: сеансов {result['sessions']}, процедур {result['procedures']}")
+
+def read_sync_secret(args):
+    # Секрет из файла, иначе sync_secret возьмёт его из переменной окружения
+    if args.secret_file is None:
+        return None
+    with open(args.secret_file, encoding="utf-8") as file:
+        return file.read().strip()
+
+def run_sync(args):
+    service = open_cli_service(args.db)
+    try:
+        if args.site is not None:
+            service.set_site(args.site)
+        result = service.sync(
+            args.peer, args.peer_site, args.batch_size,
+            progress=lambda result: print(f"Отправлено {result['sent']}, получено {result['received']}", flush=True),
+            secret=read_sync_secret(args)
+        )
+    finally:
+        service.close()
+    print(f"Синхронизация с узлом {result['peer']} завершена: отправлено {result['sent']}, получено {result['received']}")
+
+def run_sync_server(args):
+    if args.host not in LOCAL_HOSTS and not args.allow_remote:
+        raise SystemExit(
+            f"sync-server на {args.host} доступен из сети без шифрования; "
+            "добавьте --allow-remote, если сеть доверенная, или используйте SSH-туннель"
+        )
+    secret = read_sync_secret(args)
+    db_manager = DatabaseManager(args.db, profile="production")
+    db_manager.connect()
+    try:
+        db_manager.create_tables()
+        if args.site is not None:
+            db_manager.set_site(args.site)
+        site = db_manager.require_site()
+        with SyncServer(db_manager, (args.host, args.port), secret) as server:
+            print(f"Узел {site} ожидает синхронизации на {args.host}:{args.port} (Ctrl+C — остановить)", flush=True)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+    finally:
+        db_manager.close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Медицинская информационная система. Без команды запускается интерфейс.")
+    commands = parser.add_subparsers(dest="command")
+    import_parser = commands.add_parser("import", help="потоковый импорт пациентов, сеансов или процедур из CSV/JSONL")
+    import_parser.add_argument("kind", choices=list(IMPORT_SPECS))
+    import_parser.add_argument("path")
+    import_parser.add_argument("--db", default="medical.db")
+    import_parser.add_argument("--format", choices=["csv", "jsonl"], help="по умолчанию определяется по расширению")
+    import_parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+    import_parser.add_argument("--reject-file", help="по умолчанию <path>.rejected.jsonl")
+    import_parser.add_argument("--keep-indexes", action="store_true", help="не удалять индексы таблицы на время импорта")
+    import_parser.add_argument("--restart", action="store_true", help="начать сначала, игнорируя контрольную точку")
+    archive_parser = commands.add_parser(
+        "archive", help="перенести старые сеансы выписанных и удалённых пациентов в архивную базу"
+    )
+    archive_parser.add_argument("--db", default="medical.db")
+    archive_parser.add_argument("--archive", help="файл архива, по умолчанию <db>_archive.db")
+    archive_parser.add_argument(
+        "--horizon-days", type=int, default=ARCHIVE_HORIZON_DAYS,
+        help="переносить сеансы старше стольких дней, если пациент выписан раньше этого срока"
+    )
+    sync_parser = commands.add_parser("sync", help="обменяться изменениями с другим рабочим местом")
+    sync_parser.add_argument("peer", help="файл базы узла-партнёра или хост:порт его sync-server")
+    sync_parser.add_argument("--db", default="medical.db")
+    sync_parser.add_argument("--site", type=int, help="номер этого узла (задаётся один раз)")
+    sync_parser.add_argument("--peer-site", type=int, help="номер узла-партнёра в файле, если ещё не задан")
+    sync_parser.add_argument("--batch-size", type=int, default=SYNC_BATCH_SIZE)
+    sync_parser.add_argument("--secret-file", help=f"общий секрет для sync-server, по умолчанию из {SYNC_SECRET_ENV}")
+    server_parser = commands.add_parser("sync-server", help="принимать синхронизацию от других рабочих мест по TCP")
+    server_parser.add_argument("--db", default="medical.db")
+    server_parser.add_argument("--site", type=int, help="номер этого узла (задаётся один раз)")
+    server_parser.add_argument("--host", default="127.0.0.1", help="адрес вне localhost требует --allow-remote")
+    server_parser.add_argument("--port", type=int, default=SYNC_PORT)
+    server_parser.add_argument("--secret-file", help=f"общий секрет узлов, по умолчанию из {SYNC_SECRET_ENV}")
+    server_parser.add_argument(
+        "--allow-remote", action="store_true", help="слушать не только localhost: трафик не шифруется"
+    )
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
-    ft.app(target=main)
\ No newline at end of file
+    cli_args = parse_args()
+    if cli_args.command == "import":
+        run_import(cli_args)
+    elif cli_args.command == "archive":
+        run_archive(cli_args)
+    elif cli_args.command == "sync":
+        run_sync(cli_args)
+    elif cli_args.command == "sync-server":
+        run_sync_server(cli_args)
+    else:
+        ft.app(target=main)
\ No newline at end of file
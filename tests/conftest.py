@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# clinic.py лежит в папке третьей недели и импортируется как модуль верхнего уровня
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "3 неделя", "practica pitonchik"))
+
+from clinic import ClinicService  # noqa: E402
+
+
+@pytest.fixture
+def service(tmp_path):
+    # Пустая база во временном каталоге: схема и пользователи, без тестовых данных
+    clinic = ClinicService.open(str(tmp_path / "medical.db"), sample_data=False)
+    yield clinic
+    clinic.close()
@@ -0,0 +1,60 @@
+import os
+import shutil
+import sqlite3
+
+from clinic import MIGRATIONS, ClinicService
+
+WEEK2_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "2 неделя", "practica pitonchik", "medical.db")
+
+
+def user_version(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_fresh_database_reaches_latest_version(tmp_path):
+    path = str(tmp_path / "medical.db")
+    ClinicService.open(path, sample_data=False).close()
+    assert user_version(path) == len(MIGRATIONS)
+
+
+def test_week2_database_is_upgraded(tmp_path):
+    path = str(tmp_path / "medical.db")
+    shutil.copyfile(WEEK2_DB, path)
+    assert user_version(path) == 0
+
+    service = ClinicService.open(path, sample_data=False)
+    try:
+        patients = list(service.iter_patients())
+        assert patients
+        assert sum(service.age_histogram()) == len(patients)
+        assert service.find_patients(patients[0].name[:3])
+    finally:
+        service.close()
+    assert user_version(path) == len(MIGRATIONS)
+
+
+def test_schema_triggers_run_without_app_functions(tmp_path):
+    path = str(tmp_path / "medical.db")
+    service = ClinicService.open(path, sample_data=True)
+    service.close()
+
+    # Сторонний клиент SQLite не регистрирует fold_name и другие функции приложения
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "INSERT INTO patients (name, age, gender, admission_date, treatment_type) "
+        "VALUES ('Петров Пётр', 41, 'М', '2024-01-01', 'Терапия')"
+    )
+    patient_id = conn.execute("SELECT max(id) FROM patients").fetchone()[0]
+    conn.execute("UPDATE patients SET name = 'Петров Павел', age = 52 WHERE id = ?", (patient_id,))
+    conn.execute(
+        "INSERT INTO treatment_sessions (patient_id, session_date, diagnosis) VALUES (?, '2024-01-02 10:00', 'ОРВИ')",
+        (patient_id,)
+    )
+    conn.execute("DELETE FROM treatment_sessions WHERE patient_id = ?", (patient_id,))
+    conn.execute("DELETE FROM patients WHERE id = ?", (patient_id,))
+    conn.commit()
+    conn.close()
@@ -0,0 +1,49 @@
+import pytest
+
+from clinic import format_parameters, parse_parameters, split_parameters
+
+
+def test_decimal_comma_stays_in_value():
+    assert split_parameters("Температура: 37,5") == [("Температура", "37,5")]
+    assert parse_parameters("Температура: 37,5") == [("температура", "37,5", 37.5)]
+
+
+def test_legacy_comma_separates_only_before_key():
+    assert split_parameters("Давление: 120/80, Пульс: 72, ритмичный") == [
+        ("Давление", "120/80"), ("Пульс", "72, ритмичный")
+    ]
+    assert split_parameters("хорошо, Курс: 10 сеансов") == [("примечание", "хорошо"), ("Курс", "10 сеансов")]
+
+
+def test_semicolon_and_newline_separate_pairs():
+    assert split_parameters("Давление: 120,5/80; Заметка: а, б: в\nПульс: 72") == [
+        ("Давление", "120,5/80"), ("Заметка", "а, б: в"), ("Пульс", "72")
+    ]
+    assert parse_parameters("Давление: 120,5/80,5")[1] == ("давление.2", "80,5", 80.5)
+
+
+@pytest.mark.parametrize("text", [
+    "Температура: 37,5",
+    "примечание: 10:30",
+    "Заметка: а, б: в",
+    "Давление: 120/80, Курс: 10 сеансов",
+    "утром, Пульс: 72",
+])
+def test_format_round_trips(text):
+    pairs = split_parameters(text)
+    assert split_parameters(format_parameters(pairs)) == pairs
+
+
+def test_format_rejects_separator_in_value():
+    with pytest.raises(ValueError):
+        format_parameters({"Заметка": "а; б"})
+
+
+def test_saved_parameters_are_indexed(service):
+    patient = service.add_patient("Иванов Иван", 30, "М", "2024-01-01", "Терапия")
+    service.save_session(patient.id, "2024-01-02 10:00", "ОРВИ", [
+        ("Физиотерапия", split_parameters("Температура: 37,5, Курс: 10 сеансов")),
+    ])
+    rows = service.procedures_by_parameter("температура", low=37.2)
+    assert len(rows) == 1
+    assert service.procedures_by_parameter("курс", high=5) == []
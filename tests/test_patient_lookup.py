@@ -0,0 +1,40 @@
+import sqlite3
+
+from clinic import ClinicService
+
+
+def names(service, text):
+    return [patient.name for patient in service.find_patients(text)]
+
+
+def test_lookup_ignores_case_and_yo(service):
+    service.add_patient("Семёнов Пётр", 40, "М", "2024-01-01", "Терапия")
+    assert names(service, "СЕМЕН") == ["Семёнов Пётр"]
+    assert names(service, "семён") == ["Семёнов Пётр"]
+
+
+def test_name_changed_by_another_client_is_refolded(tmp_path):
+    path = str(tmp_path / "medical.db")
+    service = ClinicService.open(path, sample_data=False)
+    patient = service.add_patient("Иванов Иван", 30, "М", "2024-01-01", "Терапия")
+    service.close()
+
+    # Клиент без функций приложения: триггеры схемы обходятся встроенными функциями SQLite
+    conn = sqlite3.connect(path)
+    conn.execute("UPDATE patients SET name = 'Ёлкин Иван' WHERE id = ?", (patient.id,))
+    conn.execute(
+        "INSERT INTO patients (name, age, gender, admission_date, treatment_type) "
+        "VALUES ('Сидоров Пётр', 50, 'М', '2024-01-01', 'Терапия')"
+    )
+    conn.commit()
+    stale = conn.execute("SELECT name_folded FROM patients WHERE id = ?", (patient.id,)).fetchone()[0]
+    conn.close()
+    assert stale is None
+
+    service = ClinicService.open(path, sample_data=False)
+    try:
+        assert names(service, "иванов") == []
+        assert names(service, "елкин") == ["Ёлкин Иван"]
+        assert names(service, "сидоров") == ["Сидоров Пётр"]
+    finally:
+        service.close()
@@ -0,0 +1,24 @@
+def test_search_returns_stored_text(service):
+    patient = service.add_patient("Семёнов Пётр", 40, "М", "2024-01-01", "Терапия")
+    service.save_session(patient.id, "2024-02-01 10:00", "Ушиб плечевого сустава", [("Рентгенография", "")])
+    hits = service.search("семенов")
+    assert [(hit.kind, hit.ref_id, hit.text) for hit in hits] == [("Пациент", patient.id, "Семёнов Пётр")]
+    hits = service.search("ушиб")
+    assert hits[0].text == "Ушиб плечевого сустава"
+    assert hits[0].patient_name == "Семёнов Пётр"
+
+
+def test_search_skips_deleted_patients_before_limit(service):
+    deleted = [service.add_patient(f"Иванов {i}", 30, "М", "2024-01-01", "Терапия") for i in range(3)]
+    kept = service.add_patient("Иванов Живой", 30, "М", "2024-01-01", "Терапия")
+    for patient in deleted:
+        service.delete_patient(patient.id)
+    hits = service.search("иванов", limit=1)
+    assert [hit.patient_id for hit in hits] == [kept.id]
+
+
+def test_search_finds_procedure_parameters(service):
+    patient = service.add_patient("Петров Олег", 50, "М", "2024-01-01", "Терапия")
+    service.save_session(patient.id, "2024-02-01 10:00", "Гипертония", [("Электрокардиография", "Давление: 150/90")])
+    hits = service.search("давление")
+    assert [(hit.kind, hit.text) for hit in hits] == [("Процедура", "Электрокардиография Давление: 150/90")]
@@ -0,0 +1,20 @@
+import pytest
+
+from clinic import TAB_ROLES, SessionExpiredError, SessionTokens, User
+
+
+def test_require_user_checks_role_and_revocation(service):
+    token = service.login("nurse", "nurse123")
+    assert service.require_user(token, TAB_ROLES["Пациенты"]).role == "nurse"
+    with pytest.raises(PermissionError):
+        service.require_user(token, TAB_ROLES["Статистика"])
+    service.logout(token)
+    with pytest.raises(SessionExpiredError):
+        service.require_user(token, TAB_ROLES["Пациенты"])
+
+
+def test_expired_token_is_dropped():
+    sessions = SessionTokens(ttl=-1)
+    token = sessions.issue(User(1, "admin"))
+    assert sessions.resolve(token) is None
+    assert token not in sessions.sessions
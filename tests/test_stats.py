@@ -0,0 +1,42 @@
+def add_patients(service):
+    return [
+        service.add_patient("Иванов Иван", 34, "М", "2024-01-01", "Терапия"),
+        service.add_patient("Петрова Анна", 37, "Ж", "2024-01-01", "Терапия"),
+        service.add_patient("Сидоров Олег", 95, "М", "2024-01-01", "Хирургия"),
+    ]
+
+
+def test_age_histogram_counts_patients(service):
+    add_patients(service)
+    histogram = service.age_histogram()
+    assert histogram[3] == 2
+    assert histogram[-1] == 1
+    assert sum(histogram) == 3
+
+
+def test_soft_deleted_patients_leave_demographics(service):
+    patients = add_patients(service)
+    service.delete_patient(patients[0].id)
+    assert service.age_histogram()[3] == 1
+    assert [(g.age_bucket, g.gender, g.patients) for g in service.demographics()] == [(3, "Ж", 1), (9, "М", 1)]
+
+    service.restore_patient(patients[0].id)
+    service.restore_patient(patients[0].id)
+    assert service.age_histogram()[3] == 2
+
+    service.delete_patient(patients[1].id)
+    service.purge_patient(patients[1].id)
+    assert sum(service.age_histogram()) == 2
+
+
+def test_rebuild_matches_triggers(service):
+    patients = add_patients(service)
+    service.save_session(patients[0].id, "2024-01-02 10:00", "ОРВИ", [("Электрокардиография", "Пульс: 72")])
+    service.save_session(patients[1].id, "2024-01-02 11:00", "ОРВИ", [("Электрокардиография", "Пульс: 80")])
+    service.delete_patient(patients[2].id)
+    before = (service.demographics(), service.daily_sessions(), service.procedure_usage())
+
+    service.db.rebuild_stats()
+    assert (service.demographics(), service.daily_sessions(), service.procedure_usage()) == before
+    assert before[1][0].sessions == 2
+    assert before[2][0].uses == 2
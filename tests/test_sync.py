@@ -0,0 +1,63 @@
+import pytest
+
+from clinic import ClinicService
+
+
+@pytest.fixture
+def peer_path(tmp_path):
+    return str(tmp_path / "peer.db")
+
+
+def peer_names(path):
+    peer = ClinicService.open(path, sample_data=False)
+    try:
+        return sorted(patient.name for patient in peer.iter_patients())
+    finally:
+        peer.close()
+
+
+def test_sync_copies_changes_both_ways(service, peer_path):
+    service.set_site(1)
+    patient = service.add_patient("Иванов Иван", 30, "М", "2024-01-01", "Терапия")
+    service.save_session(patient.id, "2024-01-02 10:00", "ОРВИ", [("Электрокардиография", "Пульс: 72")])
+
+    result = service.sync(peer_path, peer_site=2)
+    assert result["peer"] == 2 and result["sent"] > 0
+    assert peer_names(peer_path) == ["Иванов Иван"]
+
+    peer = ClinicService.open(peer_path, sample_data=False)
+    try:
+        peer.add_patient("Петрова Анна", 37, "Ж", "2024-01-01", "Хирургия")
+        peer.delete_patient(patient.id)
+        sessions, _ = peer.patient_timeline(patient.id)
+        assert sessions[0].procedures[0].parameters == "Пульс: 72"
+    finally:
+        peer.close()
+
+    assert service.sync(peer_path)["received"] > 0
+    assert [p.name for p in service.iter_patients()] == ["Петрова Анна"]
+    assert sum(service.age_histogram()) == 1
+    assert service.sync(peer_path) == {"peer": 2, "sent": 0, "received": 0}
+
+
+def apply_request(patient_row):
+    return {
+        "op": "apply", "site": 2,
+        "changes": {"last_seq": 1, "upserts": {"patients": [patient_row]}, "deletes": {}},
+    }
+
+
+def test_invalid_patient_rows_are_rejected(service):
+    service.set_site(1)
+    with pytest.raises(ValueError, match="пациент 5"):
+        service.db.handle_sync_request(apply_request([5, "Иванов Иван", 300, "М", "2024-01-01", "Терапия", None, None]))
+    with pytest.raises(ValueError, match="пациент 5"):
+        service.db.handle_sync_request(apply_request([5, 42, 30, "М", "2024-01-01", "Терапия", None, None]))
+    assert list(service.iter_patients()) == []
+
+
+def test_patient_rows_are_normalized(service):
+    service.set_site(1)
+    service.db.handle_sync_request(apply_request([5, " Иванов Иван ", "30", "М", "01.02.2024", "Терапия", None, None]))
+    [patient] = service.iter_patients()
+    assert (patient.name, patient.age, patient.admission_date) == ("Иванов Иван", 30, "2024-02-01")